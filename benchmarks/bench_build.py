@@ -0,0 +1,115 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Time the startup of a large generated experiment: generating its trial
+# lists, fresh and loaded from the build cache, and building its states in
+# debug mode, finding where each was made with inspect.stack() as before
+# and by walking the frames as now.
+#
+#   python benchmarks/bench_build.py [n_blocks]
+
+import inspect
+import random
+import sys
+import tempfile
+import time
+
+# read before smile takes over the command line
+N_BLOCKS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+from smile.common import *
+from smile.state import State, StateConstructionError
+from smile.buildcache import build_cache, cached
+
+
+def old_set_instantiation_context(self, obj=None):
+    """set_instantiation_context as it was, with inspect.stack()."""
+    if obj is None:
+        obj = self
+    mro = inspect.getmro(type(obj))
+    for (frame, filename, lineno,
+         fname, fcode, index) in inspect.stack()[1:]:
+        if fname == "__init__" and type(frame.f_locals["self"]) in mro:
+            continue
+        self._instantiation_filename = filename
+        self._instantiation_lineno = lineno
+        break
+    else:
+        raise StateConstructionError(
+            "Can't figure out where instantiation took place!")
+
+
+@cached
+def make_trials(n_blocks, n_trials=200, seed=0):
+    """Balanced blocks of word trials, no word repeated within 10 trials."""
+    rng = random.Random(seed)
+    words = ["word%04d" % i for i in range(2000)]
+    blocks = []
+    for block in range(n_blocks):
+        while True:
+            trials = [{"word": rng.choice(words),
+                       "cond": ("congruent", "incongruent")[i % 2],
+                       "isi": rng.uniform(0.5, 1.0)}
+                      for i in range(n_trials)]
+            rng.shuffle(trials)
+            if all(trials[i]["word"] not in
+                   [t["word"] for t in trials[max(0, i - 10):i]]
+                   for i in range(n_trials)):
+                break
+        blocks.append(trials)
+    return blocks
+
+
+def build(blocks):
+    exp = Experiment(name="BenchBuild", data_dir=tempfile.mkdtemp(),
+                     show_splash=False, debug=True)
+    for trials in blocks:
+        Label(text="Press a key to start the block")
+        KeyPress()
+        with Loop(trials) as trial:
+            Wait(trial.current["isi"])
+            stim = Label(text=trial.current["word"], duration=1.0)
+            with UntilDone():
+                kp = KeyPress(keys=["J", "K"], base_time=stim.appear_time)
+            Log(name="trials", word=trial.current["word"], rt=kp.rt)
+    return exp
+
+
+def contexts(state):
+    """Where each state in the tree under *state* was made."""
+    found = [(state._instantiation_filename, state._instantiation_lineno)]
+    for child in getattr(state, "_children", ()):
+        found.extend(contexts(child))
+    return found
+
+
+def timed(func, *pargs):
+    start = time.perf_counter()
+    result = func(*pargs)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    build_cache.directory = tempfile.mkdtemp()
+    t_fresh, blocks = timed(make_trials, N_BLOCKS)
+    t_cached, cached_blocks = timed(make_trials, N_BLOCKS)
+    assert cached_blocks == blocks and build_cache.stats["hits"] == 1
+    print("%d blocks of trials: generated in %.3f s, loaded in %.3f s "
+          "(%.0fx)" % (N_BLOCKS, t_fresh, t_cached, t_fresh / t_cached))
+
+    new_set_instantiation_context = State.set_instantiation_context
+    State.set_instantiation_context = old_set_instantiation_context
+    t_old, exp = timed(build, blocks)
+    old_contexts = contexts(exp._root_state)
+    State.set_instantiation_context = new_set_instantiation_context
+    t_new, exp = timed(build, blocks)
+    assert contexts(exp._root_state) == old_contexts
+    print("%d states built in debug mode: inspect.stack() %.3f s, frames "
+          "%.3f s (%.0fx)" % (len(old_contexts), t_old, t_new,
+                              t_old / t_new))
@@ -0,0 +1,102 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Compare the clock's heap scheduler with the sorted list it replaced, for
+# queues of different lengths: schedule a mix of immediate and timed
+# events, unschedule some of them, and tick until every one has been
+# called, checking both call them in the same order.
+#
+#   python benchmarks/bench_clock.py
+
+import random
+import time
+from functools import partial
+
+from smile.clock import Clock, _ClockEvent
+
+
+class ListClock(Clock):
+    """The clock as it was, keeping its events in a sorted list."""
+    def __init__(self):
+        self._events = []
+
+    def tick(self):
+        now = self.now()
+        while len(self._events):
+            event = self._events[0]
+            if event.event_time is None or now >= event.event_time:
+                del self._events[0]
+                if event.repeat_interval is not None:
+                    if event.event_time is None:
+                        event.event_time = now + event.repeat_interval
+                    else:
+                        event.event_time += event.repeat_interval
+                    self._schedule(event)
+                event.func()
+            else:
+                break
+
+    def _schedule(self, event):
+        for n, cmp_event in enumerate(self._events):
+            if ((event.event_time is None and
+                 cmp_event.event_time is not None) or
+                (event.event_time is not None and
+                 cmp_event.event_time is not None and
+                 event.event_time < cmp_event.event_time)):
+                self._events.insert(n, event)
+                break
+        else:
+            self._events.append(event)
+
+    def schedule(self, func, event_delay=None, event_time=None,
+                 repeat_interval=None):
+        self._schedule(_ClockEvent(self, func, event_time, repeat_interval))
+        return func
+
+    def unschedule(self, func):
+        self._events = [event for event in self._events if event.func != func]
+
+
+class Fake(object):
+    """Virtual time, so both clocks see the same times."""
+    def __init__(self):
+        self.time = 0.0
+
+
+def run(clock_class, n_events, seed=0):
+    rng = random.Random(seed)
+    fake = Fake()
+    clock = clock_class()
+    clock.now = lambda: fake.time
+    calls = []
+    funcs = [partial(calls.append, i) for i in range(n_events)]
+
+    start = time.perf_counter()
+    for i, func in enumerate(funcs):
+        if i % 4 == 0:
+            # like the enter and leave callbacks states schedule
+            clock.schedule(func)
+        else:
+            # several events land on the same times
+            clock.schedule(func, event_time=rng.randrange(n_events) * .001)
+    for func in funcs[::10]:
+        clock.unschedule(func)
+    while len(calls) < n_events - len(funcs[::10]):
+        clock.tick()
+        fake.time += .001
+    return time.perf_counter() - start, calls
+
+
+for n_events in (10, 100, 1000, 10000):
+    t_list, list_calls = run(ListClock, n_events)
+    t_heap, heap_calls = run(Clock, n_events)
+    assert list_calls == heap_calls
+    print("%6d events: list %8.2f us  heap %6.2f us per event  (%.1fx)" %
+          (n_events, t_list / n_events * 1e6, t_heap / n_events * 1e6,
+           t_list / t_heap))
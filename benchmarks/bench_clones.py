@@ -0,0 +1,102 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Run the trial loop of docs/examples/timing_test.py headless, with and
+# without recycle_clones, and compare how many states are made, how much
+# is allocated per trial, and how often the garbage collector runs,
+# checking both runs log the same trials.
+#
+#   python benchmarks/bench_clones.py [n_reps]
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# read before smile takes over the command line
+N_REPS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+from smile.common import *
+from smile.headless import run_headless
+from smile.log import log2dl
+from smile.state import State, clone_pool
+
+
+def build(recycle_clones, n_reps):
+    exp = Experiment(name="BenchClones", data_dir=tempfile.mkdtemp(),
+                     show_splash=False, recycle_clones=recycle_clones)
+    trials = [{'dur': d, 'isi': d}
+              for d in [.005, .010, 1.0/60.0, .020, .050, .100, .200]]
+    trials = ([{'dur': .005, 'isi': .005}] * 10 + trials) * n_reps
+
+    with Loop(trials) as trial:
+        Wait(trial.current['isi'])
+        bg = BackgroundColor(color=(1, 1, 1, 1.0))
+        with UntilDone():
+            Wait(until=bg.on_screen)
+            ResetClock(bg.appear_time['time'])
+            Wait(trial.current['dur'])
+        Wait(until=bg.disappear_time)
+        ResetClock(bg.disappear_time['time'])
+        Log(name="flipping",
+            on=bg.appear_time['time'],
+            off=bg.disappear_time['time'],
+            dur=trial.current['dur'])
+    return exp, len(trials)
+
+
+class Counter(object):
+    """Counts the states made and the collections of each generation."""
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.states = 0
+
+    def gc_callback(self, phase, info):
+        if phase == "start":
+            self.collections[info["generation"]] += 1
+
+
+def run(recycle_clones, n_reps):
+    exp, n_trials = build(recycle_clones, n_reps)
+    counter = Counter()
+    state_new = State.__new__
+
+    def counting_new(cls, *pargs, **kwargs):
+        counter.states += 1
+        return state_new(cls, *pargs, **kwargs)
+
+    gc.collect()
+    State.__new__ = counting_new
+    gc.callbacks.append(counter.gc_callback)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        run_headless(exp)
+    finally:
+        elapsed = time.perf_counter() - start
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.callbacks.remove(counter.gc_callback)
+        State.__new__ = state_new
+    rows = log2dl(os.path.join(exp.session_dir, "log_flipping_0.slog"))
+    print("recycle_clones=%-5s  %5d trials  %6.2f s  %7d states made  "
+          "%6.1f KiB peak  collections %s  %s" %
+          (recycle_clones, n_trials, elapsed, counter.states, peak / 1024.,
+           counter.collections,
+           clone_pool.stats if recycle_clones else ""))
+    return rows
+
+
+if __name__ == "__main__":
+    plain = run(False, N_REPS)
+    recycled = run(True, N_REPS)
+    assert [(row["on"], row["off"], row["dur"]) for row in plain] == \
+        [(row["on"], row["off"], row["dur"]) for row in recycled]
@@ -0,0 +1,63 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Compare evaluating Ref expressions with val against their compiled
+# evaluators, for a few expressions like the ones experiments use.
+#
+#   python benchmarks/bench_ref.py
+
+import timeit
+
+from smile.ref import Ref, val, compile_ref, jitter
+
+
+class Widget(object):
+    def __init__(self):
+        self.x = 100.0
+        self.y = 200.0
+        self.width = 50.0
+        self.height = 30.0
+
+
+class Trial(object):
+    def __init__(self):
+        self.current = {"stim": "dog", "dur": 1.0, "pos": (10, 20)}
+        self.i = 3
+
+
+def mouse_within(widget, pos):
+    # the same chain of Refs MouseWithin builds
+    return ((pos[0] >= widget.x) & (pos[1] >= widget.y) &
+            (pos[0] <= widget.x + widget.width) &
+            (pos[1] <= widget.y + widget.height))
+
+
+def expressions():
+    widget = Ref.object(Widget())
+    trial = Ref.object(Trial())
+    pos = Ref.object([110.0, 210.0])
+    return {
+        "attr": trial.i,
+        "duration": trial.current["dur"] + jitter(0.5, 0.25),
+        "text": Ref(str, trial.current["stim"]) + " " + Ref(str, trial.i),
+        "within": mouse_within(widget, pos),
+        "record": (trial.current["pos"], pos, {"i": trial.i}),
+    }
+
+N = 100000
+
+for name, expr in sorted(expressions().items()):
+    # separate trees, so the val run doesn't pick up the compiled one
+    other = expressions()[name]
+    evaluate = compile_ref(other)
+    assert type(val(expr)) is type(evaluate())
+    t_val = min(timeit.repeat(lambda: val(expr), number=N, repeat=3))
+    t_new = min(timeit.repeat(evaluate, number=N, repeat=3))
+    print("%-8s val %6.2f us  compiled %6.2f us  (%.1fx)" %
+          (name, t_val / N * 1e6, t_new / N * 1e6, t_val / t_new))
@@ -0,0 +1,105 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Build the Refs of a large generated experiment and measure how much
+# memory they take, how long they take to build, and how long watching and
+# unwatching them takes, as Record and Wait(until=...) do every trial.
+#
+#   python benchmarks/bench_ref_memory.py [n_blocks]
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from smile.ref import Ref, val
+
+
+class Screen(object):
+    def __init__(self):
+        self.center_x = 400.0
+        self.center_y = 300.0
+        self.mouse_pos = (10.0, 20.0)
+
+
+class Trial(object):
+    def __init__(self):
+        self.current = {"stim": "dog", "dur": 1.0, "resp": "j", "i": 3}
+        self.i = 3
+
+
+def build_block(screen, trial):
+    """The Refs of one block of states: labels placed around the screen
+    center, a timed response, and a mouse check."""
+    refs = []
+    for n in range(10):
+        refs.append(Ref(str, trial.current["stim"]) + " " +
+                    Ref(str, trial.i))
+        refs.append(screen.center_x + 50 * n)
+        refs.append(screen.center_y - trial.current["i"] * 10)
+        refs.append(trial.current["dur"] + 0.5)
+    pos = screen.mouse_pos
+    refs.append((pos[0] >= screen.center_x - 50) &
+                (pos[0] <= screen.center_x + 50) &
+                (pos[1] >= screen.center_y - 50) &
+                (pos[1] <= screen.center_y + 50))
+    return refs
+
+
+def count_refs(refs):
+    seen = set()
+    stack = list(refs)
+    while stack:
+        ref = stack.pop()
+        if id(ref) in seen:
+            continue
+        seen.add(id(ref))
+        stack.extend(dep for dep in (ref.func,) + ref.pargs +
+                     tuple(ref.kwargs.values()) if isinstance(dep, Ref))
+    return len(seen)
+
+
+def callback():
+    pass
+
+
+n_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+screen = Ref.object(Screen())
+trial = Ref.object(Trial())
+
+start = time.perf_counter()
+blocks = [build_block(screen, trial) for i in range(n_blocks)]
+t_build = time.perf_counter() - start
+del blocks
+
+gc.collect()
+tracemalloc.start()
+blocks = [build_block(screen, trial) for i in range(n_blocks)]
+memory = tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+n_refs = count_refs([ref for block in blocks for ref in block])
+print("%d Refs: %.1f MB, %.0f bytes each, built in %.2f s" %
+      (n_refs, memory / 1e6, memory / float(n_refs), t_build))
+
+# watch and unwatch every Ref of the block, like a Record state per trial
+watched = [ref for block in blocks[:200] for ref in block]
+start = time.perf_counter()
+for rep in range(5):
+    for ref in watched:
+        ref.add_change_callback(callback)
+    for ref in watched:
+        ref.remove_change_callback(callback)
+t_watch = (time.perf_counter() - start) / (5 * len(watched))
+print("watch + unwatch: %.2f us per Ref" % (t_watch * 1e6))
+
+start = time.perf_counter()
+for ref in watched:
+    val(ref)
+t_eval = (time.perf_counter() - start) / len(watched)
+print("evaluate: %.2f us per Ref" % (t_eval * 1e6))
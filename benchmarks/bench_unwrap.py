@@ -0,0 +1,61 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+# Compare unwrapping records with the cached flattening plans against the
+# generic recursive _unwrap, for a few typical record shapes.
+#
+#   python benchmarks/bench_unwrap.py
+
+import os
+import tempfile
+import timeit
+
+from smile.log import LogWriter, LogReader, _unwrap, _flatten
+
+RECORDS = {
+    "flat": {"stim": "dog", "resp": "j", "rt": 0.523, "correct": True,
+             "trial": 12},
+    "log": {"stim": "dog", "resp": "j", "rt": 0.523,
+            "appear_time": {"time": 12.3456, "error": 0.0001},
+            "press_time": {"time": 12.8691, "error": 0.0004},
+            "trial": 12},
+    "state": {"instantiation_filename": "exp.py", "instantiation_lineno": 42,
+              "name": "Label", "start_time": 10.0, "end_time": 11.0,
+              "enter_time": 9.99, "leave_time": 11.0,
+              "appear_time": {"time": 10.0, "error": 0.0001},
+              "disappear_time": {"time": 11.0, "error": 0.0001},
+              "text": "dog", "color": (1.0, 1.0, 1.0, 1.0),
+              "pos": (400, 300)},
+    "mouse": {"record_time": {"time": 5.0, "error": 0.0}, "pos": (10, 20),
+              "button": None},
+}
+
+N = 100000
+
+for name, record in sorted(RECORDS.items()):
+    assert _flatten(record) == _unwrap(record)
+    t_old = min(timeit.repeat(lambda: _unwrap(record), number=N, repeat=3))
+    t_new = min(timeit.repeat(lambda: _flatten(record), number=N, repeat=3))
+    print("%-6s _unwrap %6.2f us  _flatten %6.2f us  (%.1fx)" %
+          (name, t_old / N * 1e6, t_new / N * 1e6, t_old / t_new))
+
+# end to end, reading a log with unwrap=True
+filename = os.path.join(tempfile.mkdtemp(), "bench_0.slog")
+lw = LogWriter(filename)
+for i in range(N):
+    record = dict(RECORDS["state"])
+    record["start_time"] = i * 0.1
+    lw.write_record(record)
+lw.close()
+t_read = min(timeit.repeat(lambda: list(LogReader(filename, unwrap=True)),
+                           number=1, repeat=3))
+t_raw = min(timeit.repeat(lambda: [_unwrap(r) for r in LogReader(filename)],
+                          number=1, repeat=3))
+print("read %d state records: %.2f s with plans, %.2f s with _unwrap" %
+      (N, t_read, t_raw))
@@ -11,7 +11,7 @@ import sys
 import site
 
 from .state import Wait
-from .clock import clock
+from .clock import clock, CRITICAL
 from kivy.logger import Logger
 
 # add in system site-packages if necessary
@@ -190,10 +190,12 @@ class Beep(Wait):
                                      fadeout=self._fadeout,
                                      mul=self._volume)
             self.__sine = pyo.Sine(freq=self._freq, mul=self.__fader)
-            clock.schedule(self._start_sound, event_time=self._start_time)
+            clock.schedule(self._start_sound, event_time=self._start_time,
+                           priority=CRITICAL)
             if self._end_time is not None:
                 clock.schedule(self._stop_sound,
-                               event_time=self._end_time-self._fadeout)
+                               event_time=self._end_time-self._fadeout,
+                               priority=CRITICAL)
 
     def _start_sound(self):
         self.__sine.out()
@@ -211,7 +213,8 @@ class Beep(Wait):
         super(Beep, self).cancel(cancel_time)
         clock.unschedule(self._stop_sound)
         clock.schedule(self._stop_sound,
-                       event_time=self._end_time-self._fadeout)
+                       event_time=self._end_time-self._fadeout,
+                       priority=CRITICAL)
 
 
 class SoundFile(Wait):
@@ -329,11 +332,13 @@ class SoundFile(Wait):
                                    self._filename)
 
             # schedule playing the sound
-            clock.schedule(self._start_sound, event_time=self._start_time)
+            clock.schedule(self._start_sound, event_time=self._start_time,
+                           priority=CRITICAL)
 
             # schedule stopping the sound
             if self._end_time is not None:
-                    clock.schedule(self._stop_sound, event_time=self._end_time)
+                    clock.schedule(self._stop_sound, event_time=self._end_time,
+                                   priority=CRITICAL)
         else:
             if (self._duration is None) & (not self._loop):
                 # Leave, much like an autofinalize state
@@ -352,7 +357,8 @@ class SoundFile(Wait):
     def cancel(self, cancel_time):
         super(SoundFile, self).cancel(cancel_time)
         clock.unschedule(self._stop_sound)
-        clock.schedule(self._stop_sound, event_time=self._end_time)
+        clock.schedule(self._stop_sound, event_time=self._end_time,
+                       priority=CRITICAL)
 
 
 class RecordSoundFile(Wait):
@@ -442,9 +448,11 @@ class RecordSoundFile(Wait):
             else:
                 self._filename = self._exp.reserve_data_filename(
                     self._filename, "wav", use_timestamp=False)
-            clock.schedule(self._start_recording, event_time=self._start_time)
+            clock.schedule(self._start_recording, event_time=self._start_time,
+                           priority=CRITICAL)
             if self._end_time is not None:
-                clock.schedule(self._stop_recording, event_time=self._end_time)
+                clock.schedule(self._stop_recording, event_time=self._end_time,
+                               priority=CRITICAL)
         else:
             if self._duration is None:
                 # Leave, much like an autofinalize state
@@ -465,4 +473,5 @@ class RecordSoundFile(Wait):
     def cancel(self, cancel_time):
         super(RecordSoundFile, self).cancel(cancel_time)
         clock.unschedule(self._stop_recording)
-        clock.schedule(self._stop_recording, event_time=self._end_time)
+        clock.schedule(self._stop_recording, event_time=self._end_time,
+                       priority=CRITICAL)
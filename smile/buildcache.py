@@ -0,0 +1,192 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+from functools import partial, wraps
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+
+# Generating the trial lists of a large experiment, sampling stimuli and
+# balancing conditions, can take longer than building the states that run
+# them. Decorating the function that makes them with **cached** saves what
+# it returns to a cache file the first time, and loads it from there on
+# later launches, for as long as the source of the file defining the
+# function and the arguments it is called with stay the same:
+#
+#   @cached
+#   def make_trials(n_blocks, seed):
+#       ...
+#       return trials
+#
+#   trials = make_trials(40, seed=7)
+#
+# Only use it for functions whose result depends on nothing but their
+# source and arguments. A function drawing random numbers without a seed
+# returns the same draw on every launch once it is cached. Changes to
+# other modules it imports, or to files it reads, aren't noticed unless
+# they are listed in *depends*:
+#
+#   @cached(depends=["words.txt", "helpers.py"])
+#   def make_trials(n_blocks, seed):
+#       ...
+
+
+class _BuildCache(object):
+    """Caches the results of **cached** functions in files.
+
+    The files go in *directory*, by default a .smile_cache directory next
+    to the script being run. While *enabled* is False, cached functions
+    are just called.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.directory = None
+        self._stats = {"hits": 0,
+                       "misses": 0,
+                       "uncacheable": 0}
+
+    @property
+    def stats(self):
+        """Dict of counters: *hits* is the number of calls loaded from a
+        cache file, *misses* the number that made one, and *uncacheable*
+        the number whose arguments or result couldn't be pickled."""
+        return self._stats.copy()
+
+    def reset_stats(self):
+        for key in self._stats:
+            self._stats[key] = 0
+
+    def _directory(self):
+        if self.directory is not None:
+            return self.directory
+        script = getattr(sys.modules.get("__main__"), "__file__", None)
+        if script is None:
+            base = os.getcwd()
+        else:
+            base = os.path.dirname(os.path.abspath(script))
+        return os.path.join(base, ".smile_cache")
+
+    def _filename(self, func, pargs, kwargs, depends=()):
+        # keyed by the source of the function's file, the files it
+        # depends on, and the arguments
+        key = hashlib.sha1()
+        try:
+            source_file = inspect.getsourcefile(func)
+        except TypeError:
+            source_file = None
+        if source_file is not None and os.path.exists(source_file):
+            with open(source_file, "rb") as f:
+                key.update(f.read())
+        for path in depends:
+            if source_file is not None:
+                # relative to the file defining the function
+                path = os.path.join(os.path.dirname(source_file), path)
+            key.update(path.encode("utf-8"))
+            try:
+                with open(path, "rb") as f:
+                    key.update(f.read())
+            except OSError:
+                # keyed as missing, until it shows up
+                key.update(b"\0")
+        key.update(func.__module__.encode("utf-8"))
+        key.update(func.__qualname__.encode("utf-8"))
+        key.update(pickle.dumps((pargs, sorted(kwargs.items())),
+                                protocol=pickle.HIGHEST_PROTOCOL))
+        return os.path.join(self._directory(), "%s-%s.pickle" %
+                            (func.__qualname__, key.hexdigest()))
+
+    def call(self, func, *pargs, **kwargs):
+        """Return *func(\\*pargs, \\*\\*kwargs)*, from its cache file if
+        there is one."""
+        return self._call(func, (), pargs, kwargs)
+
+    def _call(self, func, depends, pargs, kwargs):
+        if not self.enabled:
+            return func(*pargs, **kwargs)
+        try:
+            filename = self._filename(func, pargs, kwargs, depends)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self._stats["uncacheable"] += 1
+            return func(*pargs, **kwargs)
+        try:
+            with open(filename, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # left by an older version of the code it pickled, or damaged,
+            # so it is made again
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        else:
+            self._stats["hits"] += 1
+            return result
+
+        result = func(*pargs, **kwargs)
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self._stats["uncacheable"] += 1
+            return result
+        # write it whole, or not at all, so a half-written file is never
+        # loaded
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_name, filename)
+        finally:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+        self._stats["misses"] += 1
+        return result
+
+    def cached(self, func=None, depends=()):
+        """Decorate *func* so its results are cached.
+
+        Parameters
+        ----------
+        func : function
+            The function to cache the results of.
+        depends : list of strings
+            Paths of other files the results depend on, such as modules
+            the function imports or stimulus lists it reads, relative to
+            the file defining the function. Their contents are part of
+            the key, so editing one makes the results anew.
+
+        Use as *@cached*, or as *@cached(depends=[...])*.
+        """
+        if func is None:
+            return partial(self.cached, depends=tuple(depends))
+
+        @wraps(func)
+        def cached_func(*pargs, **kwargs):
+            return self._call(func, depends, pargs, kwargs)
+        return cached_func
+
+    def clear(self):
+        """Remove the cache files."""
+        directory = self._directory()
+        if not os.path.isdir(directory):
+            return
+        for filename in os.listdir(directory):
+            if filename.endswith(".pickle"):
+                os.remove(os.path.join(directory, filename))
+
+
+# caches the results of functions building experiments
+build_cache = _BuildCache()
+cached = build_cache.cached
@@ -1,63 +1,407 @@
 from . import kivy_overrides
 import kivy.clock
+import heapq
+import itertools
+from array import array
+from bisect import bisect_right
+from collections import deque
+from functools import partial
+from types import ModuleType
 
 _get_time = kivy.clock._default_time
 _kivy_clock = kivy.clock.Clock
 
+# priorities of scheduled events
+CRITICAL = 0  # presenting stimuli: appear, disappear, pulses, sounds
+NORMAL = 1  # entering and leaving states
+BACKGROUND = 2  # work the order of the states doesn't depend on, such as
+                # preparing them ahead, which can wait a frame
+
+def _owner_name(func):
+    """The class, and name if it has one, of the object whose method
+    *func* calls, or the name of the function."""
+    while isinstance(func, partial):
+        func = func.func
+    owner = getattr(func, "__self__", None)
+    if owner is None or isinstance(owner, ModuleType):
+        return getattr(func, "__qualname__", type(func).__name__)
+    name = getattr(owner, "_name", None)
+    if name is None:
+        return type(owner).__name__
+    return "%s (%s)" % (type(owner).__name__, name)
+
+class _Lateness(object):
+    """Records when each event was due, when it was called and how long
+    it took.
+
+    The latest *size* events are kept in preallocated arrays used as a
+    ring buffer. Every event also goes into histograms of its lateness
+    and duration for the object it belongs to, such as a state, which
+    cover the whole session.
+    """
+    # upper edges, in seconds, of the histogram bins but the last
+    bin_edges = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066)
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.count = 0
+        self._due = array("d", bytes(8 * size))
+        self._called = array("d", bytes(8 * size))
+        self._duration = array("d", bytes(8 * size))
+        self._owner = array("l", bytes(array("l").itemsize * size))
+        # owner name -> index, and the name and histograms of each index
+        self._owner_index = {}
+        self._owners = []
+        self._lateness_hist = []
+        self._duration_hist = []
+        # index -> [max lateness, total lateness, total duration]
+        self._totals = []
+
+    def call(self, event, due, now):
+        """Call *event*, which was due at *due*, recording it."""
+        start = now()
+        event.func()
+        duration = now() - start
+
+        name = _owner_name(event.func)
+        owner = self._owner_index.get(name)
+        if owner is None:
+            owner = self._owner_index[name] = len(self._owners)
+            self._owners.append(name)
+            n_bins = len(self.bin_edges) + 1
+            self._lateness_hist.append(array("l", bytes(
+                array("l").itemsize * n_bins)))
+            self._duration_hist.append(array("l", bytes(
+                array("l").itemsize * n_bins)))
+            self._totals.append([0.0, 0.0, 0.0])
+        slot = self.count % self.size
+        self._due[slot] = due
+        self._called[slot] = start
+        self._duration[slot] = duration
+        self._owner[slot] = owner
+        self.count += 1
+
+        lateness = start - due
+        self._lateness_hist[owner][bisect_right(self.bin_edges,
+                                                lateness)] += 1
+        self._duration_hist[owner][bisect_right(self.bin_edges,
+                                                duration)] += 1
+        totals = self._totals[owner]
+        if lateness > totals[0]:
+            totals[0] = lateness
+        totals[1] += lateness
+        totals[2] += duration
+
+    def events(self):
+        """Return a list of dicts of the events still in the buffer,
+        oldest first."""
+        first = max(0, self.count - self.size)
+        rows = []
+        for n in range(first, self.count):
+            slot = n % self.size
+            rows.append({"owner": self._owners[self._owner[slot]],
+                         "due_time": self._due[slot],
+                         "call_time": self._called[slot],
+                         "lateness": self._called[slot] - self._due[slot],
+                         "duration": self._duration[slot]})
+        return rows
+
+    def summary(self):
+        """Return a list of dicts, one per owner, with the number of its
+        events, their mean and max lateness, mean duration, and histograms
+        of lateness and duration over *bin_edges*."""
+        rows = []
+        for owner, name in enumerate(self._owners):
+            n_events = sum(self._lateness_hist[owner])
+            max_lateness, lateness, duration = self._totals[owner]
+            rows.append({"owner": name,
+                         "events": n_events,
+                         "mean_lateness": lateness / n_events,
+                         "max_lateness": max_lateness,
+                         "mean_duration": duration / n_events,
+                         "lateness_hist": list(self._lateness_hist[owner]),
+                         "duration_hist": list(self._duration_hist[owner])})
+        return rows
+
 class _ClockEvent(object):
-    def __init__(self, clock, func, event_time, repeat_interval):
+    __slots__ = ("clock", "func", "event_time", "repeat_interval",
+                 "priority", "cancelled", "forgotten")
+
+    def __init__(self, clock, func, event_time, repeat_interval,
+                 priority=NORMAL):
         self.clock = clock
         self.func = func
         self.event_time = event_time
         self.repeat_interval = repeat_interval
+        self.priority = priority
+        self.cancelled = False
+        # set once the event is out of the queues for good
+        self.forgotten = False
+
+    def cancel(self):
+        """Unschedule this event, leaving other events for the same
+        function alone. Does nothing once the event has been called."""
+        self.clock._cancel(self)
 
 class Clock(object):
+    """Calls scheduled functions from **tick**.
+
+    Events without an event time are called first, in the order they
+    were scheduled. The rest are called once their time has come, the
+    earliest first and in the order they were scheduled for equal times.
+    Immediate events wait in a queue of their own and timed ones in a
+    heap, so scheduling and calling an event doesn't depend on how many
+    are waiting. Unscheduled events are only marked, and dropped when
+    they come up or when too many have piled up.
+
+    Each event has a priority. Given a *deadline*, **tick** puts off the
+    BACKGROUND events that come up once the deadline has passed, and
+    calls them, in order, from the next ticks that have time for them.
+    CRITICAL and NORMAL events are always called when they come up, in
+    the order they were scheduled.
+
+    With **use_virtual_time**, the clock's time only moves when
+    **advance** moves it, so an experiment can run faster than real time
+    by jumping from one event to the next; see :py:mod:`smile.headless`.
+    """
     def __init__(self):
-        self._events = []
+        # events with no event time, in the order they were scheduled
+        self._immediate = deque()
+        # (event_time, sequence number, event) of the timed events
+        self._heap = []
+        self._sequence = itertools.count()
+        # func -> list of its scheduled events, for unschedule
+        self._by_func = {}
+        # events for funcs that can't be hashed
+        self._unhashable = []
+        # BACKGROUND events put off by ticks that ran out of time
+        self._deferred = deque()
+        # records how late each event is called, if enabled
+        self.lateness = None
+        # the time, when it's virtual
+        self._virtual_time = None
+        # number of cancelled events still in the queues
+        self._n_cancelled = 0
+        self._stats = {"ticks": 0,
+                       "overruns": 0,
+                       "deferred": 0,
+                       "max_backlog": 0,
+                       "late_critical": 0}
 
     def now(self):
-        return _get_time()
+        if self._virtual_time is None:
+            return _get_time()
+        return self._virtual_time
+
+    def use_virtual_time(self, start=0.0):
+        """Stop following real time, starting from *start* seconds."""
+        self._virtual_time = start
+
+    def use_real_time(self):
+        self._virtual_time = None
+
+    def advance(self, to):
+        """Move virtual time forward to *to*."""
+        if self._virtual_time is None:
+            raise RuntimeError("advance needs the clock in virtual time")
+        if to > self._virtual_time:
+            self._virtual_time = to
+
+    def next_event_time(self, deferred=True):
+        """Return when the next event is due, now if any are ready
+        regardless of time, or None if none are scheduled.
+
+        If *deferred* is False, the BACKGROUND events put off by earlier
+        ticks don't count, as they wait for a tick with time for them.
+        """
+        heap = self._heap
+        # cancelled events don't count
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._n_cancelled -= 1
+        if self._immediate or (deferred and self._deferred):
+            return self.now()
+        if heap:
+            return heap[0][0]
+        return None
+
+    def __len__(self):
+        """The number of scheduled events."""
+        return (len(self._immediate) + len(self._heap) +
+                len(self._deferred) - self._n_cancelled)
 
-    def tick(self):
-        #TODO: limit time spent in each tick?
+    @property
+    def stats(self):
+        """Dict of counters.
+
+        *ticks* is the number of ticks given a deadline and *overruns*
+        the number of those still running at their deadline. *deferred*
+        counts the BACKGROUND events put off to a later tick, and
+        *max_backlog* is the most waiting at once. *late_critical*
+        counts the CRITICAL events called after the deadline.
+        """
+        stats = self._stats.copy()
+        stats["backlog"] = len(self._deferred)
+        return stats
+
+    def reset_stats(self):
+        for key in self._stats:
+            self._stats[key] = 0
+
+    def record_lateness(self, size=65536):
+        """Start recording how late each event is called, keeping the
+        latest *size* events, in **lateness**.
+
+        Immediate events count as due when the first tick to come to
+        them starts.
+        """
+        self.lateness = _Lateness(size)
+
+    def tick(self, deadline=None):
+        """Call the events that are ready.
+
+        If *deadline* is given, BACKGROUND events are put off once the
+        clock reaches it, rather than called.
+        """
         now = self.now()
-        while len(self._events):
-            event = self._events[0]
-            if event.event_time is None or now >= event.event_time:
-                del self._events[0]
-                if event.repeat_interval is not None:
-                    if event.event_time is None:
-                        event.event_time = now + event.repeat_interval
-                    else:
-                        event.event_time += event.repeat_interval
-                    self._schedule(event)
-                event.func()
+        immediate = self._immediate
+        heap = self._heap
+        deferred = self._deferred
+        lateness = self.lateness
+        overran = False
+        if deadline is not None:
+            self._stats["ticks"] += 1
+            # what earlier ticks put off goes first, while there's time
+            while deferred:
+                if self.now() >= deadline:
+                    overran = True
+                    break
+                event = deferred.popleft()
+                if event.cancelled:
+                    self._n_cancelled -= 1
+                    continue
+                self._forget(event)
+                if lateness is None:
+                    event.func()
+                else:
+                    lateness.call(event, event.event_time, self.now)
+        while True:
+            if immediate:
+                event = immediate.popleft()
+            elif heap and now >= heap[0][0]:
+                event = heapq.heappop(heap)[2]
             else:
                 break
+            if event.cancelled:
+                self._n_cancelled -= 1
+                continue
+            due = now if event.event_time is None else event.event_time
+            if event.repeat_interval is not None:
+                if event.event_time is None:
+                    event.event_time = now + event.repeat_interval
+                else:
+                    event.event_time += event.repeat_interval
+                self._push(event)
+            elif deadline is not None and event.priority != NORMAL:
+                if not overran and self.now() >= deadline:
+                    overran = True
+                if event.priority == BACKGROUND and (overran or deferred):
+                    # behind the ones already waiting, to keep their order
+                    event.event_time = due
+                    deferred.append(event)
+                    self._stats["deferred"] += 1
+                    continue
+                if overran and event.priority == CRITICAL:
+                    self._stats["late_critical"] += 1
+                self._forget(event)
+            else:
+                self._forget(event)
+            if lateness is None:
+                event.func()
+            else:
+                lateness.call(event, due, self.now)
+        if deadline is not None:
+            if overran or self.now() >= deadline:
+                self._stats["overruns"] += 1
+            if len(deferred) > self._stats["max_backlog"]:
+                self._stats["max_backlog"] = len(deferred)
 
     def usleep(self, usec):
-        _kivy_clock.usleep(usec)
+        if self._virtual_time is None:
+            _kivy_clock.usleep(usec)
 
-    def _schedule(self, event):
-        for n, cmp_event in enumerate(self._events):
-            if ((event.event_time is None and
-                 cmp_event.event_time is not None) or
-                (event.event_time is not None and
-                 cmp_event.event_time is not None and
-                 event.event_time < cmp_event.event_time)):
-                self._events.insert(n, event)
-                break
+    def _push(self, event):
+        if event.event_time is None:
+            self._immediate.append(event)
         else:
-            self._events.append(event)
+            heapq.heappush(self._heap, (event.event_time,
+                                        next(self._sequence), event))
 
-    def schedule(self, func, event_delay=None, event_time=None,
-                 repeat_interval=None):
+    def _schedule(self, event):
+        self._push(event)
+        try:
+            self._by_func.setdefault(event.func, []).append(event)
+        except TypeError:
+            self._unhashable.append(event)
+
+    def _forget(self, event):
+        # the event won't be called again
+        event.forgotten = True
+        try:
+            events = self._by_func.get(event.func)
+        except TypeError:
+            self._unhashable.remove(event)
+            return
+        if events is not None:
+            events.remove(event)
+            if not events:
+                del self._by_func[event.func]
+
+    def _cancel(self, event):
+        if event.cancelled or event.forgotten:
+            return
+        event.cancelled = True
+        self._forget(event)
+        self._n_cancelled += 1
+        # drop the cancelled events once they are most of the heap
+        if self._n_cancelled > 64 and self._n_cancelled * 2 > len(self._heap):
+            self._compact()
+
+    def _compact(self):
+        # in place, as tick may be working through them
+        self._heap[:] = [entry for entry in self._heap
+                         if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        for queue in (self._immediate, self._deferred):
+            live = [event for event in queue if not event.cancelled]
+            queue.clear()
+            queue.extend(live)
+        self._n_cancelled = 0
+
+    def schedule_event(self, func, event_delay=None, event_time=None,
+                       repeat_interval=None, priority=NORMAL):
+        """Schedule *func* like **schedule**, returning the event, which
+        can be cancelled on its own with its *cancel* method."""
         if event_delay is not None:
             event_time = self.now() + event_delay
-        self._schedule(_ClockEvent(self, func, event_time, repeat_interval))
+        event = _ClockEvent(self, func, event_time, repeat_interval,
+                            priority)
+        self._schedule(event)
+        return event
+
+    def schedule(self, func, event_delay=None, event_time=None,
+                 repeat_interval=None, priority=NORMAL):
+        self.schedule_event(func, event_delay, event_time, repeat_interval,
+                            priority)
         return func
 
     def unschedule(self, func):
-        self._events = [event for event in self._events if event.func != func]
+        try:
+            events = self._by_func.pop(func, ())
+        except TypeError:
+            events = [event for event in self._unhashable
+                      if event.func == func]
+        for event in list(events):
+            self._cancel(event)
 
 clock = Clock()
@@ -81,6 +81,7 @@ from .dotbox import DotBox, DynamicDotBox
 from .moving_dots import MovingDots
 from .grating import Grating
 from .ref import Ref, val, jitter, shuffle
+from .trials import TrialSource
 from .audio import Beep, SoundFile, RecordSoundFile
 from .freekey import FreeKey
 from .questionnaire import Questionnaire
@@ -15,6 +15,7 @@ import sys
 
 import weakref
 import time
+import operator
 import threading
 import pathlib
 
@@ -26,10 +27,12 @@ from kivy.utils import platform
 import kivy.clock
 
 # local imports
-from .state import Serial, AutoFinalizeState, Wait
-from .ref import Ref
+from .state import (Serial, AutoFinalizeState, Wait, clone_pool,
+                    LeadTimes)
+from .ref import Ref, propagation, interning, profiler
 from .clock import clock
-from .log import LogWriter, log2csv
+from .log import LogWriter, FlushPolicy, logs2csv, _SLOG_NAME
+from .logdb import SQLiteStore
 from .event import event_time
 from .scale import scale
 from . import version
@@ -90,15 +93,15 @@ class Screen(object):
     def __init__(self):
         # set up the values of interest and their refs
         self._width = 0.0
-        self._width_ref = Ref.getattr(self, "_width")
+        self._width_ref = Ref(getattr, self, "_width", _source=True)
         self._height = 0.0
-        self._height_ref = Ref.getattr(self, "_height")
+        self._height_ref = Ref(getattr, self, "_height", _source=True)
         self._last_flip = event_time(0.0, 0.0)
-        self._last_flip_ref = Ref.getattr(self, "_last_flip")
+        self._last_flip_ref = Ref(getattr, self, "_last_flip", _source=True)
         self._mouse_pos = (0, 0)
-        self._mouse_pos_ref = Ref.getattr(self, "_mouse_pos")
+        self._mouse_pos_ref = Ref(getattr, self, "_mouse_pos", _source=True)
         self._mouse_button = None
-        self._mouse_button_ref = Ref.getattr(self, "_mouse_button")
+        self._mouse_button_ref = Ref(getattr, self, "_mouse_button", _source=True)
         self._keys_down = set()
         self._issued_key_refs = weakref.WeakValueDictionary()
         self._joybuttons_down = set()
@@ -139,7 +142,7 @@ class Screen(object):
         try:
             return self._issued_key_refs[name]
         except KeyError:
-            ref = Ref(self._is_key_down, name)
+            ref = Ref(self._is_key_down, name, _source=True)
             self._issued_key_refs[name] = ref
             return ref
 
@@ -150,7 +153,7 @@ class Screen(object):
         try:
             return self._issued_joybutton_refs[buttonid]
         except KeyError:
-            ref = Ref(self._is_joybutton_down, buttonid)
+            ref = Ref(self._is_joybutton_down, buttonid, _source=True)
             self._issued_joybutton_refs[buttonid] = ref
             return ref
 
@@ -172,7 +175,8 @@ class Screen(object):
         try:
             self._joyaxis_value_refs[axisid].dep_changed()
         except KeyError:
-            self._joyaxis_value_refs[axisid] = Ref.getitem(self._joyaxis_value, axisid)
+            self._joyaxis_value_refs[axisid] = Ref(
+                operator.getitem, self._joyaxis_value, axisid, _source=True)
             self._joyaxis_value_refs[axisid].dep_changed()
 
     def get_joyhat_value(self, hatid):
@@ -193,7 +197,8 @@ class Screen(object):
         try:
             self._joyhat_value_refs[hatid].dep_changed()
         except KeyError:
-            self._joyhat_value_refs[hatid] = Ref.getitem(self._joyhat_value, hatid)
+            self._joyhat_value_refs[hatid] = Ref(
+                operator.getitem, self._joyhat_value, hatid, _source=True)
             self._joyhat_value_refs[hatid].dep_changed()
 
     @property
@@ -308,6 +313,81 @@ class Experiment(object):
     background_color : string (default = 'BLACK')
         If given a string color name, see colors in video.py, the
         background of the window will be set to that color
+    threaded_logging : boolean (default = False)
+        If True, every .slog writer pickles and compresses its records on
+        a background thread instead of inside the frame loop.
+    flush_policy : string or FlushPolicy (default = 'log')
+        When the .slog files are synced to disk, applied to every log of
+        the session. Either a FlushPolicy or one of its mode names
+        ('log', 'record', 'group', 'idle', 'exit'); see
+        :py:class:`~smile.log.FlushPolicy` for how much data each mode
+        can lose in a crash. The policy is saved in the sysinfo log.
+    log_sink : string (default = 'slog')
+        Where the *Log*, *Record* and state logs go. With 'slog' each log
+        is its own .slog file. With 'sqlite' they all go into one
+        database in the session directory, with a table per log title;
+        see :py:class:`~smile.logdb.SQLiteStore`. The sysinfo log is
+        always a .slog file.
+    coalesce_changes : boolean (default = False)
+        If True, while the experiment runs, the Ref changes made by the
+        scheduled events and input of each frame are delivered together, so anything watching a Ref,
+        such as *Wait(until=...)* or *Record*, is told once per frame
+        rather than once per change. See
+        :py:data:`~smile.ref.propagation`.
+    intern_refs : boolean (default = False)
+        If True, identical Ref expressions built after this point and
+        until the session ends, such as `exp.screen.center_x` used by
+        several states, share one Ref and its cache. The sysinfo log records how many Refs were shared. See
+        :py:data:`~smile.ref.interning` for when this can change what a
+        Ref evaluates to.
+    profile_refs : boolean (default = False)
+        If True, every evaluation of a Ref while the experiment runs is
+        counted and timed against
+        the state it belongs to, and a report of the expressions that took
+        the most time is written to a ref_profile .tsv file in the session
+        directory when the session ends. Evaluation is slower meanwhile.
+        See :py:data:`~smile.ref.profiler`.
+    tick_margin : float (default = None)
+        If given, scheduled background work, such as preparing states
+        ahead with *lead_time*, stops once each frame's events run to
+        within this many seconds of the time the frame is drawn, and picks
+        up in the next ticks with time to spare, so a burst of it can't
+        hold up the draw. Stimuli, and entering, leaving and finalizing
+        states, are never held back, as the order of the states depends on
+        them. How much work was put off is saved to a clock .slog when the
+        session ends.
+    record_lateness : boolean or int (default = False)
+        If True, or the number of events to keep, the clock records, while
+        the experiment runs, when each scheduled event was due, when it was called, and how long it
+        took. When the session ends, a clock_lateness .slog gets a record
+        per state (or other owner of the events) with histograms of their
+        lateness and duration, binned at 0.5, 1, 2, 4, 8, 16, 33 and 66
+        ms, and a clock_events .slog gets the latest events themselves.
+    recycle_clones : boolean (default = False)
+        If True, the clones states make as they run, such as those for each
+        trial of a Loop, are reused once they have finalized and a newer
+        clone has taken their place, instead of being made anew, so long
+        experiments make far less garbage. A state that holds on to the
+        clone of another state, rather than a Ref to it, can see a later
+        run's values once that clone is reused. See
+        :py:data:`~smile.state.clone_pool`.
+    lead_time : float (default = None)
+        If given, the next state of a *Serial* (including the body of a
+        *Loop*) is readied this many seconds before the state ahead of it
+        ends, rather than when that state leaves: its attributes are
+        evaluated and, for visual states, its widget is built, laying out
+        text and loading images. This changes when they are evaluated:
+        functions called by its Refs, such as *Ref(random.choice, ...)*,
+        run once, while the state before it is still running, and see
+        anything that isn't a state attribute or variable as it was then.
+        Attributes are only evaluated again on entering if a state
+        attribute or variable they read changed in between, and the
+        widget is rebuilt if that changed its parameters. States using
+        *jitter*, *shuffle* or *Ref.object* aren't readied ahead, as they
+        are evaluated anew each time. For a frame-based horizon,
+        give a number of frames times the frame interval. How long before
+        its start time each state was ready is saved to a lead_time .slog
+        when the session ends.
 
     Properties
     ----------
@@ -359,7 +439,12 @@ class Experiment(object):
                  background_color=None, name="SMILE", debug=False, Touch=None,
                  save_private_computer_info=False, data_dir=None,
                  working_dir=None,
-                 local_crashlog=False, cmd_traceback=True, show_splash=True):
+                 local_crashlog=False, cmd_traceback=True, show_splash=True,
+                 threaded_logging=False, flush_policy=None,
+                 log_sink="slog", coalesce_changes=False,
+                 intern_refs=False, profile_refs=False, tick_margin=None,
+                 record_lateness=False, recycle_clones=False,
+                 lead_time=None):
 
         self._sysinfo = {}
         self._sysinfo['DEFAULTDATADIR'] = kivy_overrides._get_config()['default_data_dir']
@@ -379,6 +464,37 @@ class Experiment(object):
         self._exp_name = name
         self._session = time.strftime("%Y%m%d_%H%M%S")
         self._debug = debug
+        self._threaded_logging = threaded_logging
+        if not isinstance(flush_policy, FlushPolicy):
+            if flush_policy is None:
+                flush_policy = FlushPolicy()
+            else:
+                flush_policy = FlushPolicy(flush_policy)
+        self._flush_policy = flush_policy
+        if log_sink not in ("slog", "sqlite"):
+            raise ValueError("log_sink must be 'slog' or 'sqlite', not %r" %
+                             (log_sink,))
+        self._log_sink = log_sink
+        self._log_store = None
+        self._log_store_filename = None
+        self._log_writers = weakref.WeakSet()
+        # these set module singletons, from _apply_settings at the start
+        # of each run until _restore_settings puts back the defaults,
+        # except for interning, which the building that follows needs
+        self._coalesce_changes = coalesce_changes
+        self._intern_refs = intern_refs
+        interning.enabled = intern_refs
+        if intern_refs:
+            interning.reset_stats()
+        self._profile_refs = profile_refs
+        self._tick_margin = tick_margin
+        self._record_lateness = record_lateness
+        self._recycle_clones = recycle_clones
+        self._lead_time = lead_time
+        if lead_time is None:
+            self._lead_times = None
+        else:
+            self._lead_times = LeadTimes()
         self._process_args()
 
         # handle fullscreen before Window is imported
@@ -429,6 +545,16 @@ class Experiment(object):
         self._sysinfo.update({"fullscreen":self._fullscreen,
                               "data_time":self._session,
                               "debug":self._debug,
+                              "threaded_logging":self._threaded_logging,
+                              "flush_policy":self._flush_policy.describe(),
+                              "log_sink":self._log_sink,
+                              "coalesce_changes":self._coalesce_changes,
+                              "intern_refs":self._intern_refs,
+                              "profile_refs":self._profile_refs,
+                              "tick_margin":self._tick_margin,
+                              "record_lateness":self._record_lateness,
+                              "recycle_clones":self._recycle_clones,
+                              "lead_time":self._lead_time,
                               "background_color":self._background_color,
                               "scale_box":scale_box,
                               "scale_up":scale_up,
@@ -451,6 +577,7 @@ class Experiment(object):
         self._reserved_data_filenames = set(os.listdir(os.path.join(self._session_dir)))
         self._reserved_data_filenames_lock = threading.Lock()
         self._state_loggers = {}
+        self._csv_queue = []
 
     def _change_smile_subj(self, subj_id):
         #kconfig = kivy_overrides._get_config()
@@ -499,7 +626,7 @@ class Experiment(object):
             return self.__issued_refs[name]
         except KeyError:
             # ref = Ref.getitem(self._vars, name)
-            ref = Ref(self.get_var, name, _parent_state=self)
+            ref = Ref(self.get_var, name, _parent_state=self, _source=True)
             self.__issued_refs[name] = ref
             return ref
 
@@ -608,33 +735,151 @@ class Experiment(object):
                 raise RuntimeError(
                     "Too many data files with the same title, extension, and timestamp!")
 
+    def create_log_writer(self, filename):
+        """Open a LogWriter for a data file in the session directory using
+        this experiment's logging settings.
+
+        With the 'sqlite' log sink, the records go into the session
+        database instead, in the table named after the file's title.
+        """
+        if self._log_sink == "sqlite":
+            match = _SLOG_NAME.match(os.path.basename(filename))
+            if match is None:
+                title, log_num = os.path.splitext(
+                    os.path.basename(filename))[0], 0
+            else:
+                title, log_num = match.group(1), int(match.group(2))
+            return self._get_log_store().log_writer(title, log_num)
+        log_writer = LogWriter(filename, threaded=self._threaded_logging,
+                               flush_policy=self._flush_policy)
+        self._log_writers.add(log_writer)
+        return log_writer
+
+    def _get_log_store(self):
+        if self._log_store is None:
+            # reruns add to the same database
+            if self._log_store_filename is None:
+                self._log_store_filename = self.reserve_data_filename(
+                    "session", "sqlite")
+            self._log_store = SQLiteStore(self._log_store_filename,
+                                          flush_policy=self._flush_policy)
+        return self._log_store
+
     def setup_state_logger(self, state_class_name):
         if state_class_name in self._state_loggers:
             filename, logger = self._state_loggers[state_class_name]
         else:
             title = "state_" + state_class_name
             filename = self.reserve_data_filename(title, "slog")
-            logger = LogWriter(filename)
+            logger = self.create_log_writer(filename)
             self._state_loggers[state_class_name] = filename, logger
         return filename
 
+    def _queue_log2csv(self, filename):
+        # convert this closed slog with the rest in close_state_loggers
+        if self._log_sink == "slog":
+            self._csv_queue.append(filename)
+
+    def _apply_settings(self):
+        # set the singletons this experiment's settings live in for a run
+        propagation.coalesce = self._coalesce_changes
+        interning.enabled = self._intern_refs
+        if self._profile_refs:
+            profiler.reset()
+            profiler.current_state = lambda: getattr(
+                self, "_current_state", None)
+            profiler.enable()
+        elif profiler.enabled:
+            profiler.disable()
+        clock.reset_stats()
+        if self._record_lateness is True:
+            clock.record_lateness()
+        elif self._record_lateness:
+            clock.record_lateness(self._record_lateness)
+        else:
+            clock.lateness = None
+        clone_pool.enabled = self._recycle_clones
+        clone_pool.reset_stats()
+
+    def _restore_settings(self):
+        # put the singletons back as they are by default, leaving their
+        # counters to be read
+        propagation.coalesce = False
+        interning.enabled = False
+        if profiler.enabled:
+            profiler.disable()
+        profiler.current_state = None
+        clock.lateness = None
+        clone_pool.enabled = False
+
     def close_state_loggers(self, to_csv):
         for dict_key, items in iter(self._state_loggers.items()):
             filename, logger = items
             logger.close()
             if to_csv:
-                csv_filename = (os.path.splitext(filename)[0] + ".csv")
-                log2csv(filename, csv_filename)
+                self._queue_log2csv(filename)
         self._state_loggers = {}
+        self._write_run_stats(to_csv)
+        self._restore_settings()
+        if self._log_store is not None:
+            self._log_store.close()
+            self._log_store = None
+
+        # convert every log closed this session at once, in threads, as
+        # forking while kivy's and the log writers' threads run can hang
+        if to_csv:
+            logs2csv(self._csv_queue, processes=False)
+        self._csv_queue = []
+
+    def _write_run_stats(self, to_csv):
+        # the logs of what the settings asked to measure during the run
+        if self._tick_margin is not None and clock.stats["ticks"]:
+            # how much background work the tick deadline put off
+            log_writer = self.create_log_writer(
+                self.reserve_data_filename("clock", "slog"))
+            log_writer.write_record(clock.stats)
+            log_writer.close()
+            if to_csv:
+                self._queue_log2csv(log_writer.filename)
+        if clock.lateness is not None and clock.lateness.count:
+            # when each event was called, and a summary per state
+            for title, records in (("clock_lateness",
+                                    clock.lateness.summary()),
+                                   ("clock_events",
+                                    clock.lateness.events())):
+                log_writer = self.create_log_writer(
+                    self.reserve_data_filename(title, "slog"))
+                for record in records:
+                    log_writer.write_record(record)
+                log_writer.close()
+                if to_csv:
+                    self._queue_log2csv(log_writer.filename)
+        if self._lead_times is not None and self._lead_times.summary():
+            # how long before their start times states were ready
+            log_writer = self.create_log_writer(
+                self.reserve_data_filename("lead_time", "slog"))
+            for record in self._lead_times.summary():
+                log_writer.write_record(record)
+            log_writer.close()
+            if to_csv:
+                self._queue_log2csv(log_writer.filename)
+            self._lead_times = LeadTimes()
+        if self._profile_refs and profiler.report():
+            # each run gets its own report
+            profiler.write_report(self.reserve_data_filename("ref_profile",
+                                                             "tsv"))
 
     def write_to_state_log(self, state_class_name, record):
         self._state_loggers[state_class_name][1].write_record(record)
 
     def _flush_state_loggers(self):
-        # Fix this for py3
-        for key in self._state_loggers.keys():
-            self._state_loggers[key][1]._file.flush()
-            os.fsync(self._state_loggers[key][1]._file)
+        for filename, logger in self._state_loggers.values():
+            logger.request_flush()
+
+    def _idle_flush_logs(self):
+        # give every open log a chance to run syncs its policy deferred
+        for log_writer in list(self._log_writers):
+            log_writer.idle()
 
     def _write_sysinfo(self, save_private=None, filename=None):
         if filename is None:
@@ -642,6 +887,9 @@ class Experiment(object):
         if save_private is None:
             save_private = self._save_private_computer_info
         logged_info = self._sysinfo.copy()
+        if self._intern_refs:
+            # the experiment is built by now
+            logged_info["ref_interning"] = interning.stats
         if not save_private:
             logged_info.pop('uname')
             logged_info.pop('DEFAULTDATADIR')
@@ -683,6 +931,8 @@ class Experiment(object):
         return self._info
 
     def start(self):
+        self._apply_settings()
+
         # open all the logs
         # (this will call begin_log for entire state machine)
         self._root_state.begin_log()
@@ -702,6 +952,7 @@ class Experiment(object):
         self._current_state = None
         if trace:
             self._root_state.tron()
+        self._apply_settings()
 
         # open all the logs
         # (this will call begin_log for entire state machine)
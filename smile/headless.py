@@ -0,0 +1,303 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import heapq
+import itertools
+import math
+
+from kivy.uix.floatlayout import FloatLayout
+
+from .clock import clock
+from .event import event_time
+from .ref import propagation
+
+
+# Runs an experiment without a window, in virtual time. Instead of
+# waiting for real time to pass, the clock jumps straight to whatever is
+# due next: a scheduled event, a scripted key press, or the next flip of
+# a simulated screen that shows visual states' changes on a regular frame
+# grid. A 45 minute experiment runs to completion in seconds, writing the
+# same logs it would with a subject in front of it, which makes it useful
+# for testing an experiment's flow and what it logs:
+#
+#   exp = Experiment(name="Stroop")
+#   ... build the experiment ...
+#   run_headless(exp, respond=lambda state: ("J", 0.45))
+#
+# Widgets are still built and added to a layout, but nothing is drawn.
+
+
+class _VideoChange(object):
+    """A change to the screen waiting for its flip."""
+    def __init__(self, update_cb, flip_time, flip_time_cb):
+        self.update_cb = update_cb
+        self.flip_time = flip_time
+        self.flip_time_cb = flip_time_cb
+
+
+class HeadlessApp(object):
+    """Stands in for the SmileApp of an experiment run by
+    **run_headless**.
+
+    Visual changes are shown on simulated flips, every *flip_interval*
+    seconds, at the first flip no more than half a frame before the time
+    they were scheduled for, as SmileApp draws them.
+
+    Key presses come from *keys*, a list of (time, key) pairs with times
+    in seconds after the experiment starts, and from *respond*, which is
+    called with each state that starts listening for keys and returns
+    None or a (key, delay) pair to press *key* *delay* seconds later.
+    Each press is released after *key_duration* seconds.
+    """
+    def __init__(self, exp, width=800, height=600, frame_rate=60.,
+                 keys=(), respond=None, key_duration=0.1):
+        self.exp = exp
+        self.callbacks = {}
+        self.pending_flip_time = None
+        self.video_queue = []
+        self.force_blocking_flip = False
+        self.force_nonblocking_flip = False
+        self.flip_interval = 1. / frame_rate
+        self.background_color = None
+        self.flips = 0
+
+        self.event_time = event_time(clock.now(), 0.0)
+        self.dispatch_input_event_time = self.event_time
+        self.last_flip = event_time(clock.now(), 0.0)
+
+        # stands in for both the window and the base layout
+        self.wid = FloatLayout(size=(width, height))
+        self._Window = self.wid
+        self.width = width
+        self.height = height
+
+        self._respond = respond
+        self._key_duration = key_duration
+        # (time, sequence number, event name, key) of the scripted input
+        self._input = []
+        self._sequence = itertools.count()
+        self._keys = keys
+
+    def add_callback(self, event_name, func):
+        self.callbacks.setdefault(event_name, []).append(func)
+        if (event_name == "KEY_DOWN" and self._respond is not None and
+            hasattr(func, "__self__")):
+            response = self._respond(func.__self__)
+            if response is not None:
+                key, delay = response
+                self.press_key(key, clock.now() + delay)
+
+    def remove_callback(self, event_name, event_func):
+        try:
+            callbacks = self.callbacks[event_name]
+        except KeyError:
+            return
+        self.callbacks[event_name] = [func for func in callbacks
+                                      if func != event_func]
+
+    def _trigger_callback(self, event_name, *pargs, **kwargs):
+        for func in self.callbacks.get(event_name, ()):
+            func(*pargs, **kwargs)
+
+    def press_key(self, key, press_time):
+        """Press *key* at *press_time*, releasing it *key_duration*
+        seconds later."""
+        for name, time in (("KEY_DOWN", press_time),
+                           ("KEY_UP", press_time + self._key_duration)):
+            heapq.heappush(self._input, (time, next(self._sequence),
+                                         name, key))
+
+    def _dispatch_input(self, now):
+        screen = self.exp.screen
+        while self._input and self._input[0][0] <= now:
+            time, n, name, key = heapq.heappop(self._input)
+            key = key.upper()
+            keycode = (ord(key.lower()) if len(key) == 1 else 0, key.lower())
+            if name == "KEY_DOWN":
+                screen._keys_down.add(key)
+            else:
+                screen._keys_down.discard(key)
+            try:
+                screen._issued_key_refs[key].dep_changed()
+            except KeyError:
+                pass
+            if name == "KEY_DOWN":
+                self._trigger_callback(name, keycode, key.lower(), [],
+                                       self.event_time)
+            else:
+                self._trigger_callback(name, keycode, self.event_time)
+
+    def schedule_video(self, update_cb, flip_time=None, flip_time_cb=None):
+        if flip_time is None:
+            flip_time = self.last_flip["time"] + self.flip_interval
+        new_video = _VideoChange(update_cb, flip_time, flip_time_cb)
+        for n, video in enumerate(self.video_queue):
+            if video.flip_time > flip_time:
+                self.video_queue.insert(n, new_video)
+                break
+        else:
+            self.video_queue.append(new_video)
+        return new_video
+
+    def cancel_video(self, video):
+        try:
+            self.video_queue.remove(video)
+        except ValueError:
+            pass
+
+    def screenshot(self, filename=None):
+        pass
+
+    def set_background_color(self, color=None):
+        self.background_color = color
+
+    def _next_flip_time(self):
+        # the flip a SmileApp would show the first change on
+        flip_time = self.video_queue[0].flip_time - self.flip_interval / 2.
+        frames = math.ceil((flip_time - self.last_flip["time"]) /
+                           self.flip_interval)
+        return self.last_flip["time"] + max(frames, 1) * self.flip_interval
+
+    def _flip(self, now):
+        if not self.video_queue:
+            return
+        flip_time = self._next_flip_time()
+        if flip_time > now:
+            return
+        videos = []
+        while (self.video_queue and
+               self.video_queue[0].flip_time - self.flip_interval / 2. <=
+               flip_time):
+            video = self.video_queue.pop(0)
+            video.update_cb()
+            videos.append(video)
+        self.last_flip = event_time(flip_time, 0.0)
+        self.flips += 1
+        for video in videos:
+            if video.flip_time_cb is not None:
+                video.flip_time_cb(self.last_flip)
+        self.exp._screen._set_last_flip(self.last_flip)
+        self.exp._idle_flush_logs()
+
+    def _next_frame_time(self, now):
+        # when the frame after the one now is drawn
+        last_flip = self.last_flip["time"]
+        frames = math.floor((now - last_flip) / self.flip_interval) + 1
+        frame_time = last_flip + frames * self.flip_interval
+        if frame_time <= now:
+            # rounded down onto now
+            frame_time += self.flip_interval
+        return frame_time
+
+    def _next_time(self):
+        if self.exp._tick_margin is None:
+            times = [clock.next_event_time()]
+        else:
+            # work put off past a frame's deadline waits for the next frame
+            times = [clock.next_event_time(deferred=False)]
+            if clock.stats["backlog"]:
+                times.append(self._next_frame_time(clock.now()))
+        if self._input:
+            times.append(self._input[0][0])
+        if self.video_queue:
+            times.append(self._next_flip_time())
+        times = [time for time in times if time is not None]
+        return min(times) if times else None
+
+    def run(self, max_time=None):
+        exp = self.exp
+        root = exp._root_executor
+        start_time = clock.now()
+        for time, key in self._keys:
+            self.press_key(key, start_time + time)
+        root.enter(start_time + 0.25)
+        while True:
+            now = clock.now()
+            self.event_time = event_time(now, 0.0)
+            self.dispatch_input_event_time = self.event_time
+            with propagation.batch():
+                if exp._tick_margin is None:
+                    clock.tick()
+                else:
+                    # as SmileApp does, before the next frame is drawn
+                    clock.tick(self._next_frame_time(now) - exp._tick_margin)
+                self._dispatch_input(now)
+            self._flip(now)
+
+            if not root._active:
+                break
+            next_time = self._next_time()
+            if next_time is None:
+                raise RuntimeError(
+                    "The experiment stopped %.3f s in with nothing left "
+                    "to happen. Is it waiting for input that was never "
+                    "scripted?" % (now - start_time))
+            if max_time is not None and next_time - start_time > max_time:
+                raise RuntimeError("The experiment ran past max_time "
+                                   "(%r s)" % (max_time,))
+            clock.advance(next_time)
+        return clock.now() - start_time
+
+
+def run_headless(exp, keys=(), respond=None, width=800, height=600,
+                 frame_rate=60., key_duration=0.1, max_time=None,
+                 start_time=0.0):
+    """Run an experiment to completion without a window, in virtual time.
+
+    Parameters
+    ----------
+    exp : Experiment
+        The experiment, already built.
+    keys : list of (float, str)
+        Keys to press, and when, in seconds after the experiment starts.
+    respond : function
+        Called with every state that starts listening for key presses,
+        such as a *KeyPress*. It returns None to leave the state be, or a
+        (key, delay) pair to press *key* *delay* seconds later.
+    width, height : int
+        The size of the simulated screen.
+    frame_rate : float
+        How often the simulated screen flips.
+    key_duration : float
+        How long each key is held down.
+    max_time : float
+        If given, stop with a RuntimeError if the experiment runs longer
+        than this many seconds of virtual time.
+    start_time : float
+        The virtual time the run starts at.
+
+    Returns the length of the experiment in seconds of virtual time. The
+    logs are written to the session directory, as with *Experiment.run*.
+    If the experiment has a *tick_margin*, each tick gets the deadline it
+    would have before the next frame, and work put off waits for the
+    next frame, as no time passes during a tick.
+    """
+    clock.use_virtual_time(start_time)
+    try:
+        exp._current_state = None
+        exp._apply_settings()
+        exp._root_state.begin_log()
+        exp._root_executor = exp._root_state._clone(None)
+        exp._app = app = HeadlessApp(exp, width=width, height=height,
+                                     frame_rate=frame_rate, keys=keys,
+                                     respond=respond,
+                                     key_duration=key_duration)
+        exp._screen._set_width(width)
+        exp._screen._set_height(height)
+        exp._sysinfo.update({"screen_size": [width, height],
+                             "headless": True})
+        exp._write_sysinfo()
+        try:
+            duration = app.run(max_time=max_time)
+        finally:
+            exp._root_state.end_log(exp._csv)
+            exp.close_state_loggers(exp._csv)
+    finally:
+        clock.use_real_time()
+    return duration
@@ -13,7 +13,6 @@ from .state import CallbackState
 from .ref import val, NotAvailable
 from .clock import clock
 from .experiment import Experiment
-from .log import LogWriter, log2csv
 
 
 def Key(name):
@@ -246,13 +245,15 @@ class KeyRecord(KeyState):
             self._instantiation_lineno,
             self._name)
 
-        if self.__log_filename is not None:
+        # the 'sqlite' log sink never creates the file
+        if self.__log_filename is not None and \
+           os.path.exists(self.__log_filename):
             os.remove(self.__log_filename)
         self.__log_filename = self._exp.reserve_data_filename(title, "slog")
 
         if self.__log_writer is not None:
             self.__log_writer.close()
-        self.__log_writer = LogWriter(self.__log_filename)
+        self.__log_writer = self._exp.create_log_writer(self.__log_filename)
 
     def end_log(self, to_csv=False):
         super(KeyRecord, self).end_log(to_csv)
@@ -260,9 +261,8 @@ class KeyRecord(KeyState):
             self.__log_writer.close()
             self.__log_writer = None
             if to_csv:
-                csv_filename = (os.path.splitext(self.__log_filename)[0] +
-                                ".csv")
-                log2csv(self.__log_filename, csv_filename)
+                # converted along with the other logs once all are closed
+                self._exp._queue_log2csv(self.__log_filename)
 
     def _on_key_down(self, keycode, text, modifiers, event_time):
         self.__log_writer.write_record({
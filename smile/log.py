@@ -8,34 +8,371 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
 import gzip
+import zlib
+import struct
+import io
+import mmap
+import bisect
+import re
+import fnmatch
 import csv
 import os
+import sys
+import json
+import array
+import zipfile
+import time
+import shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import atexit
+import weakref
+import threading
+import warnings
+from collections import deque
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+
+# The current .slog format version. Version 1 files are a gzipped stream
+# of pickled record dicts. Version 2 files start with a header entry and
+# write each distinct set of record keys once as a schema entry, followed
+# by rows pickled as tuples of the schema id and the values in key order:
+#
+#   ("SLOG", 2)                 header
+#   ("K", 0, ("a", "b"))        schema 0 has keys a and b
+#   (0, 1.0, "x")               row {"a": 1.0, "b": "x"}
+#
+# Entries whose first item is an unknown tag are skipped by readers.
+#
+# Version 3 files hold the same entries, but each pickle is framed by its
+# length as a little-endian uint32, so that a reader can tell a complete
+# entry from one cut off by a crash. Every *sync_records* records, and at
+# the end of each block, a check entry holds the CRC-32 of the frames
+# written since the last one:
+#
+#   ("C", crc, n_entries)
+#
+# A CRC per record would make the files about 46% larger, as most records
+# compress to only a few bytes.
+#
+# Version 2 and later files are written in blocks of records, each one its
+# own gzip member, so that a reader can decompress any block without the
+# ones before it. Plain gzip readers see a single stream. After every
+# *checkpoint_blocks* blocks, and when the file is closed, an index entry
+# is written as a member of its own:
+#
+#   ("I", blocks, schemas)      blocks is a tuple of
+#                               (offset, length, first_record, n_records,
+#                                min_time, max_time)
+#
+# and a closed file ends with a fixed-size footer member pointing at the
+# final index:
+#
+#   ("X", b"SLOGIDX1" + index offset as a little-endian uint64)
+#
+# The index and footer are framed too in version 3 files.
+SLOG_VERSION = 3
+_HEADER_TAG = "SLOG"
+_SCHEMA_TAG = "K"
+_INDEX_TAG = "I"
+_FOOTER_TAG = "X"
+_FOOTER_MAGIC = b"SLOGIDX1"
+_CHECK_TAG = "C"
+_FRAME = struct.Struct("<I")
+
+# fields, in order of preference, that give the time of a record for the
+# block index
+_TIME_FIELDS = ("log_time", "record_time", "start_time")
+
+
+
+def _gzip_member(data, level=9):
+    """Compress data as a complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _frame(data):
+    """Prefix pickled data with its length."""
+    return _FRAME.pack(len(data)) + data
+
+
+def _is_framed(data):
+    """Whether decompressed slog data starts with a framed header."""
+    if len(data) < _FRAME.size:
+        return False
+    length = _FRAME.unpack_from(data)[0]
+    try:
+        entry = pickle.loads(data[_FRAME.size:_FRAME.size + length])
+    except Exception:
+        return False
+    return type(entry) is tuple and len(entry) == 2 and \
+        entry[0] == _HEADER_TAG
+
+
+def _encode_entry(entry, framed):
+    data = pickle.dumps(entry, protocol=3)
+    if framed:
+        return _frame(data)
+    return data
+
+
+def _footer(index_offset, framed=False):
+    # stored without compression, so every footer has the same size
+    return _gzip_member(_encode_entry(
+        (_FOOTER_TAG, _FOOTER_MAGIC + struct.pack("<Q", index_offset)),
+        framed), level=0)
+
+
+_FOOTER_SIZES = (len(_footer(0, framed=True)), len(_footer(0)))
+
+# how every pickled index entry, footer, and check entry starts
+_INDEX_PREFIX = pickle.dumps((_INDEX_TAG, (), {}), protocol=3)[:9]
+_FOOTER_PREFIX = pickle.dumps((_FOOTER_TAG, b""), protocol=3)[:9]
+_CHECK_PREFIX = pickle.dumps((_CHECK_TAG, 0, 0), protocol=3)[:9]
+
+
+def _record_time(record):
+    """Return the time of a record for the block index, or None."""
+    for field in _TIME_FIELDS:
+        t = record.get(field)
+        if t is None:
+            continue
+        if isinstance(t, dict):
+            t = t.get("time")
+        if isinstance(t, (int, float)) and not isinstance(t, bool):
+            return t
+        return None
+    return None
+
+
+# sentinels passed through the writer queue in place of records
+_FLUSH = object()
+_CLOSE = object()
+
+# threaded writers that still need to be drained at interpreter exit
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    """Drain and close any threaded writers that were never closed."""
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+class FlushPolicy(object):
+    """When LogWriters push their records to disk (flush + fsync).
+
+    Parameters
+    ----------
+    mode : string
+        One of:
+
+        'log'
+            Records are synced whenever a *Log* state with flush=True
+            runs, which also syncs every state log. This is the
+            original SMILE behavior.
+        'record'
+            Every record is synced as soon as it is written.
+        'group'
+            Records are synced in groups, once *interval* seconds have
+            passed or *max_records* records are waiting, whichever comes
+            first.
+        'idle'
+            Records are synced whenever the writer has nothing else to
+            do: when a threaded writer's queue runs dry, or right after
+            a screen flip for unthreaded writers.
+        'exit'
+            Records are only synced when the log is closed.
+    interval : float
+        Maximum time in seconds a record may wait in 'group' mode.
+    max_records : int
+        Maximum number of records that may wait in 'group' mode.
+
+    For unthreaded writers the 'group' and 'idle' syncs are run right
+    after a screen flip (see **LogWriter.idle**) rather than inside
+    **write_record**, so they are not on the path to the next flip.
+    """
+    MODES = ("log", "record", "group", "idle", "exit")
+
+    def __init__(self, mode="log", interval=0.5, max_records=100):
+        if mode not in self.MODES:
+            raise ValueError("Invalid flush policy mode %r, must be one "
+                             "of %r" % (mode, self.MODES))
+        self.mode = mode
+        self.interval = interval
+        self.max_records = max_records
+
+    def __repr__(self):
+        return "FlushPolicy(%r, interval=%r, max_records=%r)" % (
+            self.mode, self.interval, self.max_records)
+
+    @property
+    def guarantee(self):
+        """Plain description of how much data a crash can lose."""
+        if self.mode == "log":
+            return ("records written since the last Log state with "
+                    "flush=True")
+        elif self.mode == "record":
+            return "none beyond the record being written"
+        elif self.mode == "group":
+            return ("at most %gs or %d records per log (plus one frame "
+                    "for unthreaded writers)" % (self.interval,
+                                                 self.max_records))
+        elif self.mode == "idle":
+            return ("records written since the writer was last idle "
+                    "(at most one frame for unthreaded writers)")
+        else:
+            return "everything since the log was opened"
+
+    def describe(self):
+        """Dict describing the policy, suitable for logging in sysinfo."""
+        return {"mode": self.mode,
+                "interval": self.interval,
+                "max_records": self.max_records,
+                "guarantee": self.guarantee}
+
+
 class LogWriter(object):
     """An object that handles the writing of .slog files.
 
     *LogWriter* is what we use to write data to a .slog file. The
     *Log* state relies heavily on this object.
 
+    When *threaded* is True, **write_record** only places the record on a
+    bounded queue and a dedicated writer thread does the pickling and
+    compression, keeping that work off the frame loop. If the queue is
+    full the caller waits for the writer thread to catch up (this is
+    counted in **stats**). The queue is always drained on **close**, and
+    any threaded writers still open at interpreter exit are drained and
+    closed as well.
+
     Parameters
     ----------
     filename : string
         The filename that you would like to write to. Must end in .slog.
     protocol : int
         The pickle protocol to use. Defaults to 3.
+    threaded : boolean
+        Whether to write records from a background thread. Defaults to
+        False.
+    queue_size : int
+        Maximum number of records waiting on the writer thread before
+        **write_record** blocks. Only used when *threaded* is True.
+    flush_policy : FlushPolicy
+        When to sync written records to disk. Defaults to
+        FlushPolicy('log').
+    version : int
+        The .slog format version to write. Version 3 (the default) frames
+        every record with its length, and adds a CRC-32 of the frames
+        every *sync_records* records and at the end of each block, so
+        that damaged files can be recovered. Version 2 stores the field names once per schema
+        instead of once per record. Version 1 writes plain record dicts
+        for older readers, as a single gzip stream without a block index.
+    block_records : int
+        Number of records per independently compressed block. Smaller
+        blocks make random access cheaper and compress less well.
+    checkpoint_blocks : int
+        Write the block index every this many blocks, so that a file that
+        was never closed can still be read without a full scan.
+    sync_records : int
+        Hand the compressed records to the operating system every this
+        many records, so that a process that gets killed loses at most
+        that many. None to only do so when flushed.
 
     """
 
-    def __init__(self, filename, protocol=3):
-        self._file = gzip.open(filename, "wb")
-        self._pickler = pickle.Pickler(self._file, protocol=protocol)
+    def __init__(self, filename, protocol=3, threaded=False, queue_size=4096,
+                 flush_policy=None, version=SLOG_VERSION, block_records=1000,
+                 checkpoint_blocks=64, sync_records=100):
+        if version not in (1, 2, 3):
+            raise ValueError("Unsupported slog version %r" % version)
+        self._version = version
+        self._framed = version > 2
+        self._check_crc = 0
+        self._check_entries = 0
+        self._schemas = {}
+        self._sync_records = sync_records
+        self._since_sync_point = 0
+
+        # version 1 files are one block that is never indexed
+        self._indexed = version > 1
+        self._block_records = block_records
+        self._checkpoint_blocks = checkpoint_blocks
+        self._blocks = []
+        self._block = None
+        self._compressor = None
+        self._protocol = protocol
+
+        if flush_policy is None:
+            flush_policy = FlushPolicy()
+        self._policy = flush_policy
+        self._unsynced = 0
+        self._last_sync = time.perf_counter()
+
+        self._filename = filename
+        self._file = open(filename, "wb")
+        # records are pickled into a buffer and compressed into the
+        # current block one at a time
+        self._buffer = io.BytesIO()
+        self._pickler = pickle.Pickler(self._buffer, protocol=protocol)
         self._pickler.fast = True
 
+        # back-pressure and throughput counters
+        self._stats = {"records": 0,
+                       "blocks": 0,
+                       "syncs": 0,
+                       "max_queue_depth": 0,
+                       "blocked_writes": 0,
+                       "blocked_time": 0.0}
+
+        self._threaded = threaded
+        self._closed = False
+        self._error = None
+        if threaded:
+            # deque append/popleft are atomic, so the producer never takes
+            # a lock unless it has to wake the writer or wait for space
+            self._queue = deque()
+            self._queue_size = queue_size
+            self._has_data = threading.Event()
+            self._has_space = threading.Event()
+            self._flushed = threading.Event()
+            self._thread = threading.Thread(
+                target=self._writer_loop,
+                name="LogWriter(%s)" % os.path.basename(filename))
+            self._thread.daemon = True
+            self._thread.start()
+            _open_writers.add(self)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def stats(self):
+        """Dict of counters for this writer.
+
+        *records* is the number of records written, *blocks* the number
+        of complete compressed blocks, *max_queue_depth* the
+        most records ever waiting on the writer thread, and
+        *blocked_writes*/*blocked_time* how often and for how long
+        **write_record** had to wait for space in the queue.
+        """
+        stats = self._stats.copy()
+        stats["threaded"] = self._threaded
+        if self._threaded:
+            stats["queue_depth"] = len(self._queue)
+            stats["queue_size"] = self._queue_size
+        return stats
+
     def write_record(self, data):
         """Call this funciton to write a single row to the .slog file.
 
@@ -48,18 +385,733 @@ class LogWriter(object):
         # data must be a dict
         if not isinstance(data, dict):
             raise ValueError("data to log must be a dict instance.")
-        self._pickler.dump(data)
-        self._pickler.memo.clear()
+        if not self._threaded:
+            self._write(data)
+            return
+
+        # copy so the caller is free to reuse the dict
+        self._put(dict(data))
+
+    def request_flush(self):
+        """Ask for written records to be synced, as a *Log* state with
+        flush=True does.
+
+        Only the 'log' flush policy honors explicit requests; the other
+        policies decide for themselves when to sync.
+        """
+        if self._policy.mode == "log":
+            self.flush()
+
+    def idle(self):
+        """Tell the writer the frame loop has time to spare.
+
+        Unthreaded writers run any 'group' or 'idle' syncs that are due.
+        Threaded writers sync on their own thread, so this does nothing.
+        """
+        if self._threaded or not self._unsynced:
+            return
+        if self._policy.mode == "idle" or (self._policy.mode == "group" and
+                                           self._group_due()):
+            self._flush(True)
+
+    def flush(self, sync=True):
+        """Push all written records to disk.
+
+        Parameters
+        ----------
+        sync : boolean
+            If True, also fsync the file. For a threaded writer the flush
+            happens on the writer thread once the records queued before it
+            have been written.
+        """
+        if not self._threaded:
+            self._flush(sync)
+        else:
+            self._put((_FLUSH, sync))
 
     def close(self):
+        """Write any queued records and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._threaded:
+            self._queue.append(_CLOSE)
+            self._has_data.set()
+            self._thread.join()
+            _open_writers.discard(self)
+        if self._block is None and not self._blocks:
+            # an empty log still gets its header
+            self._start_block()
+        self._end_block(checkpoint=False)
+        if self._indexed:
+            self._write_index(footer=True)
+        if self._unsynced and self._policy.mode != "log":
+            self._flush(True)
         self._file.close()
+        self._raise_error()
+
+    def _start_block(self):
+        self._block = [self._file.tell(), self._stats["records"], 0,
+                       None, None]
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        if not self._blocks and self._version > 1:
+            self._file.write(self._compressor.compress(
+                self._encode((_HEADER_TAG, self._version))))
+
+    def _encode(self, entry):
+        self._pickler.dump(entry)
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if self._framed:
+            data = _frame(data)
+            self._check_crc = zlib.crc32(data, self._check_crc)
+            self._check_entries += 1
+        return data
+
+    def _write_check(self):
+        if self._framed and self._check_entries:
+            self._file.write(self._compressor.compress(_encode_entry(
+                (_CHECK_TAG, self._check_crc, self._check_entries), True)))
+            self._check_crc = 0
+            self._check_entries = 0
+
+    def _end_block(self, checkpoint=True):
+        if self._block is None:
+            return
+        self._write_check()
+        self._file.write(self._compressor.flush(zlib.Z_FINISH))
+        offset, first, count, tmin, tmax = self._block
+        self._blocks.append((offset, self._file.tell() - offset, first, count,
+                             tmin, tmax))
+        self._block = None
+        self._compressor = None
+        self._stats["blocks"] += 1
+        if (checkpoint and self._indexed and
+                len(self._blocks) % self._checkpoint_blocks == 0):
+            self._write_index()
+
+    def _write_index(self, footer=False):
+        offset = self._file.tell()
+        schemas = dict((schema_id, keys)
+                       for keys, schema_id in self._schemas.items())
+        self._file.write(_gzip_member(_encode_entry(
+            (_INDEX_TAG, tuple(self._blocks), schemas), self._framed)))
+        if footer:
+            self._file.write(_footer(offset, self._framed))
+
+    def _write(self, data):
+        if self._block is None:
+            self._start_block()
+        if self._version == 1:
+            encoded = self._encode(data)
+        else:
+            keys = tuple(data)
+            schema_id = self._schemas.get(keys)
+            if schema_id is None:
+                # new set of keys, so write the schema before the row
+                schema_id = len(self._schemas)
+                self._schemas[keys] = schema_id
+                encoded = self._encode((_SCHEMA_TAG, schema_id, keys))
+            else:
+                encoded = b""
+            encoded += self._encode((schema_id,) + tuple(data.values()))
+        self._file.write(self._compressor.compress(encoded))
+        self._stats["records"] += 1
+        if self._indexed:
+            block = self._block
+            block[2] += 1
+            t = _record_time(data)
+            if t is not None:
+                if block[3] is None or t < block[3]:
+                    block[3] = t
+                if block[4] is None or t > block[4]:
+                    block[4] = t
+            if block[2] >= self._block_records:
+                self._end_block()
+        self._unsynced += 1
+        self._since_sync_point += 1
+        if self._sync_records and \
+           self._since_sync_point >= self._sync_records:
+            self._flush(False)
+        if self._policy.mode == "record" or (self._threaded and
+                                             self._policy.mode == "group" and
+                                             self._group_due()):
+            self._flush(True)
+
+    def _group_due(self):
+        return (self._unsynced >= self._policy.max_records or
+                (time.perf_counter() - self._last_sync >=
+                 self._policy.interval))
+
+    def _flush(self, sync):
+        if self._compressor is not None:
+            # make everything written so far readable without ending the
+            # block
+            self._write_check()
+            self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._file.flush()
+        self._since_sync_point = 0
+        if sync:
+            os.fsync(self._file.fileno())
+            self._stats["syncs"] += 1
+            self._unsynced = 0
+            self._last_sync = time.perf_counter()
+
+    def _put(self, item):
+        self._raise_error()
+        if self._closed:
+            raise ValueError("write to closed LogWriter %r" % self._filename)
+        if len(self._queue) >= self._queue_size:
+            # back-pressure: wait for the writer thread to make room
+            start = time.perf_counter()
+            self._stats["blocked_writes"] += 1
+            while (len(self._queue) >= self._queue_size and
+                   self._thread.is_alive()):
+                self._has_space.clear()
+                self._has_data.set()
+                self._has_space.wait(0.01)
+            self._stats["blocked_time"] += time.perf_counter() - start
+        self._queue.append(item)
+        depth = len(self._queue)
+        if depth > self._stats["max_queue_depth"]:
+            self._stats["max_queue_depth"] = depth
+        if not self._has_data.is_set():
+            self._has_data.set()
+
+    def _writer_loop(self):
+        while True:
+            # wake up in time to sync a partial group
+            timeout = None
+            if self._unsynced and self._policy.mode == "group":
+                timeout = max(0.0, self._last_sync + self._policy.interval -
+                              time.perf_counter())
+            self._has_data.wait(timeout)
+            # clear before draining so an append racing with the drain
+            # leaves the event set for the next pass
+            self._has_data.clear()
+            while True:
+                try:
+                    item = self._queue.popleft()
+                except IndexError:
+                    break
+                if item is _CLOSE:
+                    return
+                try:
+                    if type(item) is tuple and item[0] is _FLUSH:
+                        self._flush(item[1])
+                    elif self._error is None:
+                        self._write(item)
+                except Exception as e:
+                    # hand the error back to the next caller
+                    self._error = e
+                self._has_space.set()
+
+            # the queue is empty, so sync if the policy calls for it
+            try:
+                if self._unsynced and (
+                        self._policy.mode == "idle" or
+                        (self._policy.mode == "group" and
+                         self._group_due())):
+                    self._flush(True)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def _split_entries(data, framed):
+    """Split decompressed slog data into its entries.
+
+    Returns the entries and the number of bytes they take up, which is
+    less than len(data) if the data ends in an entry that was cut off or,
+    for framed data, one that fails its checksum.
+    """
+    entries = []
+    if framed:
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        # start of the frames the next check entry covers, and the number
+        # of entries before them
+        checked_pos = 0
+        n_checked = 0
+        while pos + _FRAME.size <= end:
+            start = pos + _FRAME.size
+            stop = start + _FRAME.unpack_from(view, pos)[0]
+            if stop > end:
+                break
+            try:
+                entry = pickle.loads(view[start:stop])
+            except Exception:
+                break
+            if type(entry) is tuple and entry and entry[0] == _CHECK_TAG:
+                if zlib.crc32(view[checked_pos:pos]) != entry[1]:
+                    # damaged since the last check
+                    del entries[n_checked:]
+                    return entries, checked_pos
+                checked_pos = stop
+                n_checked = len(entries)
+            else:
+                entries.append(entry)
+            pos = stop
+        return entries, pos
+
+    stream = io.BytesIO(data)
+    unpickler = pickle.Unpickler(stream)
+    pos = 0
+    while pos < len(data):
+        try:
+            entries.append(unpickler.load())
+        except Exception:
+            # a record cut off by a crash
+            break
+        pos = stream.tell()
+    return entries, pos
+
+
+def _entries_to_records(entries, schemas):
+    """Turn slog entries into record dicts, adding any schema entries to
+    *schemas*."""
+    records = []
+    for entry in entries:
+        if type(entry) is dict:
+            # version 1 record
+            records.append(entry)
+            continue
+        tag = entry[0]
+        if type(tag) is int:
+            records.append(dict(zip(schemas[tag], entry[1:])))
+        elif tag == _SCHEMA_TAG:
+            schemas[entry[1]] = entry[2]
+    return records
+
+
+def _load_entries(data, schemas, framed=False):
+    """Return the records in a decompressed block as a list of dicts.
+
+    Schema entries in the block are added to *schemas*.
+    """
+    return _entries_to_records(_split_entries(data, framed)[0], schemas)
+
+
+def _decode_block(args):
+    """Read and decode one block of a slog, given (filename, offset,
+    length, schemas, framed)."""
+    filename, offset, length, schemas, framed = args
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return _load_entries(zlib.decompressobj(31).decompress(data),
+                         dict(schemas), framed)
+
+
+def _read_member(buf, pos, chunk_size=1 << 20):
+    """Decompress the gzip member starting at *pos* in *buf*.
+
+    Returns the data and the offset just past the member, which is None
+    if the member is incomplete. Raises zlib.error if there is no member
+    at *pos*.
+    """
+    decompressor = zlib.decompressobj(31)
+    parts = []
+    end = len(buf)
+    while pos < end and not decompressor.eof:
+        chunk = buf[pos:pos + chunk_size]
+        parts.append(decompressor.decompress(chunk))
+        pos += len(chunk)
+    if not decompressor.eof:
+        parts.append(decompressor.flush())
+        return b"".join(parts), None
+    return b"".join(parts), pos - len(decompressor.unused_data)
+
+
+def _salvage_member(buf, pos, chunk_size=1 << 12):
+    """Decompress as much as possible of the gzip member at *pos*.
+
+    Returns the data, the offset decompression got to, and whether the
+    member was complete.
+    """
+    decompressor = zlib.decompressobj(31)
+    parts = []
+    end = len(buf)
+    while pos < end and not decompressor.eof:
+        chunk = buf[pos:pos + chunk_size]
+        try:
+            parts.append(decompressor.decompress(chunk))
+        except zlib.error:
+            # damaged, so keep what came out before this chunk
+            return b"".join(parts), pos, False
+        pos += len(chunk)
+    if not decompressor.eof:
+        parts.append(decompressor.flush())
+        return b"".join(parts), pos, False
+    return b"".join(parts), pos - len(decompressor.unused_data), True
+
+
+def _file_format(buf):
+    """Return whether a slog is framed and its version, from the start of
+    its first block."""
+    try:
+        head = zlib.decompressobj(31).decompress(buf[:4096], 256)
+    except zlib.error:
+        return False, 1
+    framed = _is_framed(head)
+    if framed:
+        head = head[_FRAME.size:]
+    try:
+        entry = pickle.loads(head)
+    except Exception:
+        return framed, 1
+    if type(entry) is tuple and len(entry) == 2 and entry[0] == _HEADER_TAG:
+        return framed, entry[1]
+    return framed, 1
+
+
+class _BlockIndex(object):
+    """The blocks of a slog and the schemas needed to decode them."""
+    def __init__(self, blocks, schemas, framed=False):
+        self.blocks = list(blocks)
+        self.schemas = schemas
+        self.framed = framed
+        self.firsts = [block[2] for block in self.blocks]
+        if self.blocks:
+            self.n_records = self.blocks[-1][2] + self.blocks[-1][3]
+        else:
+            self.n_records = 0
+
+
+def _load_index(filename):
+    """Load the block index of a slog.
+
+    The footer of a closed file points straight at the index. Otherwise
+    the last checkpointed index is found by searching back from the end
+    of the file, and any blocks after it are found by decoding them.
+    Files without an index, including version 1 files, are decoded in
+    full.
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return _BlockIndex([], {})
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            framed = _file_format(buf)[0]
+            index = _read_footer(buf, size, framed)
+            if index is None:
+                index = _scan_blocks(buf, framed,
+                                     *_find_checkpoint(buf, size, framed))
+            return index
+        finally:
+            buf.close()
+
+
+def _read_index_entry(buf, pos, framed):
+    skip = _FRAME.size if framed else 0
+    try:
+        # check the start of the member before decompressing all of it
+        peek = zlib.decompressobj(31).decompress(buf[pos:pos + 1024],
+                                                 skip + len(_INDEX_PREFIX))
+        if peek[skip:] != _INDEX_PREFIX:
+            return None, None
+        data, end = _read_member(buf, pos)
+        entry = _split_entries(data, framed)[0][0]
+    except Exception:
+        return None, None
+    if type(entry) is tuple and len(entry) == 3 and entry[0] == _INDEX_TAG:
+        return entry, end
+    return None, None
+
+
+def _read_footer(buf, size, framed):
+    footer_size = _FOOTER_SIZES[0 if framed else 1]
+    if size < footer_size:
+        return None
+    try:
+        data, end = _read_member(buf, size - footer_size)
+        tag, value = _split_entries(data, framed)[0][0]
+    except Exception:
+        return None
+    if end != size or tag != _FOOTER_TAG or \
+       value[:len(_FOOTER_MAGIC)] != _FOOTER_MAGIC:
+        return None
+    offset = struct.unpack("<Q", value[len(_FOOTER_MAGIC):])[0]
+    entry = _read_index_entry(buf, offset, framed)[0]
+    if entry is None:
+        return None
+    return _BlockIndex(entry[1], entry[2], framed)
+
+
+def _find_checkpoint(buf, size, framed):
+    """Return (blocks, schemas, offset past the index) for the last index
+    entry in the file, or an empty index at the start of the file."""
+    pos = size
+    while pos > 0:
+        pos = buf.rfind(b"\x1f\x8b\x08", 0, pos)
+        if pos < 0:
+            break
+        entry, end = _read_index_entry(buf, pos, framed)
+        if entry is not None:
+            return list(entry[1]), dict(entry[2]), end
+    return [], {}, 0
+
+
+def _block_entry(offset, length, first, records):
+    times = [t for t in map(_record_time, records) if t is not None]
+    return (offset, length, first, len(records),
+            min(times) if times else None, max(times) if times else None)
+
+
+def _scan_blocks(buf, framed, blocks, schemas, pos):
+    """Find the blocks from *pos* on by decoding them."""
+    if blocks:
+        first = blocks[-1][2] + blocks[-1][3]
+    else:
+        first = 0
+    end = len(buf)
+    while pos is not None and pos < end:
+        try:
+            data, next_pos = _read_member(buf, pos)
+        except zlib.error:
+            # trailing garbage from a crash
+            break
+        records = _load_entries(data, schemas, framed)
+        if records:
+            length = (next_pos if next_pos is not None else end) - pos
+            blocks.append(_block_entry(pos, length, first, records))
+            first += len(records)
+        pos = next_pos
+    return _BlockIndex(blocks, schemas, framed)
+
+
+def recover_slog(filename, out_filename=None):
+    """Salvage every complete record from a damaged or unclosed slog.
+
+    Intact blocks are copied to the new file without being decoded: the
+    blocks covered by the last index checkpoint are only decompressed to
+    check them, and just the blocks after it have to be decoded. The
+    records that can still be read from damaged blocks are written as new
+    blocks, and the new file is closed with a full index. Framed (version
+    3) files are checked against the checksum written at each sync point;
+    older files are salvaged up to the first record that fails to
+    unpickle.
+
+    Parameters
+    ----------
+    filename : string
+        The slog to recover.
+    out_filename : string
+        Where to write the recovered slog. Defaults to the filename with
+        '_recovered' added before the extension. Nothing is written if
+        the slog was closed properly.
+
+    Returns
+    -------
+    A dict reporting what was recovered: *complete* is True if the slog
+    was closed properly, *records* is the number of records in the
+    recovered file, of which *copied_records* came from intact blocks
+    and *salvaged_records* from damaged ones. *lost_records* counts the
+    records an index says were in damaged blocks that could not be
+    salvaged. *lost_entries* counts the records (or schemas) that were
+    cut off, failed their checksum, or depend on a lost schema, and
+    *lost_bytes* is their uncompressed size when known. *skipped_bytes* is
+    the compressed data that could not be decompressed at all.
+    """
+    if out_filename is None:
+        out_filename = os.path.splitext(filename)[0] + "_recovered.slog"
+    report = {"filename": filename, "out_filename": None, "complete": False,
+              "records": 0, "copied_records": 0, "salvaged_records": 0,
+              "lost_records": 0, "lost_entries": 0, "lost_bytes": 0,
+              "skipped_bytes": 0}
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return report
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            framed, version = _file_format(buf)
+            index = _read_footer(buf, size, framed)
+            if index is not None:
+                report["complete"] = True
+                report["records"] = index.n_records
+                return report
+            checkpointed, schemas, pos = _find_checkpoint(buf, size, framed)
+            with open(out_filename, "wb") as out:
+                recovery = _Recovery(buf, framed, schemas, out, report)
+
+                # decompressing a block checks its CRC, so the blocks the
+                # checkpoint knows about are copied in runs of intact ones
+                copied_to = 0
+                intact = []
+                for block in checkpointed:
+                    offset, length = block[:2]
+                    if _salvage_member(buf, offset, 1 << 20)[1:] == \
+                       (offset + length, True):
+                        intact.append(block)
+                        continue
+                    recovery.copy(copied_to, offset, intact)
+                    intact = []
+                    n_salvaged = recovery.recover_block(offset)[1]
+                    report["lost_records"] += max(0, block[3] - n_salvaged)
+                    copied_to = offset + length
+                recovery.copy(copied_to, pos, intact)
+
+                # then the blocks written since
+                while pos < size:
+                    pos = recovery.recover_block(pos)[0]
+                recovery.write_salvaged()
+
+                if version > 1 and recovery.blocks:
+                    index_offset = out.tell()
+                    out.write(_gzip_member(_encode_entry(
+                        (_INDEX_TAG, tuple(recovery.blocks), schemas),
+                        framed)))
+                    out.write(_footer(index_offset, framed))
+        finally:
+            buf.close()
+    report["out_filename"] = out_filename
+    report["records"] = report["copied_records"] + report["salvaged_records"]
+    return report
+
+
+class _Recovery(object):
+    """Writes the intact blocks and salvaged records of a slog to a new
+    file, keeping track of the new block index."""
+    def __init__(self, buf, framed, schemas, out, report):
+        self.buf = buf
+        self.framed = framed
+        self.schemas = schemas
+        self.out = out
+        self.report = report
+        self.blocks = []
+        self.n_records = 0
+        # salvaged entries waiting to be written as a block
+        self.salvaged = []
+
+    def copy(self, start, stop, blocks=()):
+        """Copy buf[start:stop], holding *blocks*, to the new file."""
+        if start >= stop:
+            return
+        self.write_salvaged()
+        shift = self.out.tell() - start
+        for block in blocks:
+            self.blocks.append((block[0] + shift, block[1], self.n_records) +
+                               tuple(block[3:]))
+            self.n_records += block[3]
+            self.report["copied_records"] += block[3]
+        self.out.write(self.buf[start:stop])
+
+    def write_salvaged(self):
+        if not self.salvaged:
+            return
+        records = _entries_to_records(self.salvaged, dict(self.schemas))
+        member = _gzip_member(b"".join(_encode_entry(entry, self.framed)
+                                       for entry in self.salvaged))
+        if records:
+            self.blocks.append(_block_entry(self.out.tell(), len(member),
+                                            self.n_records, records))
+            self.n_records += len(records)
+            self.report["salvaged_records"] += len(records)
+        self.out.write(member)
+        del self.salvaged[:]
+
+    def recover_block(self, pos):
+        """Copy the block at *pos* if it is intact, or keep what can be
+        read of it.
+
+        Returns the offset to carry on from and the number of records
+        kept.
+        """
+        report = self.report
+        data, stop, complete = _salvage_member(self.buf, pos)
+        entries, used = _split_entries(data, self.framed)
+        head = data[used + (_FRAME.size if self.framed else 0):][:9]
+        if used < len(data) and not (len(head) > 2 and any(
+                prefix.startswith(head) for prefix in
+                (_INDEX_PREFIX, _FOOTER_PREFIX, _CHECK_PREFIX))):
+            # a cut off record rather than an index or check
+            report["lost_entries"] += 1
+            report["lost_bytes"] += len(data) - used
+
+        # keep the header, schemas, and rows whose schema is known
+        kept = []
+        n_rows = 0
+        lost_rows = 0
+        for entry in entries:
+            if type(entry) is not dict:
+                tag = entry[0]
+                if tag == _SCHEMA_TAG:
+                    self.schemas[entry[1]] = entry[2]
+                elif type(tag) is int:
+                    if tag not in self.schemas:
+                        lost_rows += 1
+                        continue
+                    n_rows += 1
+                elif tag != _HEADER_TAG:
+                    continue
+            else:
+                n_rows += 1
+            kept.append(entry)
+        report["lost_entries"] += lost_rows
+
+        if complete and used == len(data) and not lost_rows:
+            # an intact block, so copy it as it is
+            records = _entries_to_records(entries, self.schemas)
+            self.copy(pos, stop, [_block_entry(pos, stop - pos, 0, records)]
+                      if records else [])
+            return stop, len(records)
+
+        self.salvaged.extend(kept)
+        if not complete:
+            # look for the next block after the damage
+            next_pos = self.buf.find(b"\x1f\x8b\x08", max(stop, pos + 1))
+            if next_pos < 0:
+                next_pos = len(self.buf)
+            report["skipped_bytes"] += next_pos - stop
+            stop = next_pos
+        return stop, n_rows
+
+
+def _pool(max_workers, processes=True):
+    """A pool for work that doesn't depend on the experiment.
+
+    On Linux this is a pool of forked processes; elsewhere, where a new
+    process would have to re-run the experiment script, it is a pool of
+    threads. It is also a pool of threads if *processes* is False, for a
+    process running other threads, where a forked child can hang on a
+    lock one of them held.
+    """
+    if processes and sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork").Pool(max_workers)
+    return ThreadPool(max_workers)
+
+
+class _DamagedEntry(Exception):
+    pass
 
 
 class LogReader(object):
     """An object that handles reading from .slog files.
 
     Passing in a filename, by calling **ReadRecord** you can read one
-    row from the .slog file.
+    row from the .slog file. Version 1, 2 and 3 .slog files are read, and
+    records are always returned as dicts.
+
+    In a version 3 file each entry is framed by its length and each group
+    of frames is followed by its CRC-32. Reading stops at the first entry
+    that is cut off or fails its check, such as at the end of a log that
+    was never closed, with a warning, and **damaged** is set. The records
+    before it are returned as usual; **recover_slog** salvages the rest.
+
+    Records can also be read out of order: ``len(reader)`` is the number
+    of records, ``reader[i]`` and ``reader[i:j]`` return records by
+    position, **seek** moves the position **read_record** reads from, and
+    **time_range** returns the records logged within a span of time.
+    With the block index of a version 2 or 3 file these only decompress the
+    blocks they need; older files are decoded in full the first time.
 
     Parameters
     ----------
@@ -72,6 +1124,7 @@ class LogReader(object):
     """
     def __init__(self, filename, unwrap=False, **append_columns):
         # set the file
+        self._filename = filename
         self._file = gzip.open(filename, "rb")
 
         # save whether we should unwrap when reading
@@ -83,22 +1136,282 @@ class LogReader(object):
         # set up the unpickler
         self._unpickler = pickle.Unpickler(self._file)
 
+        # format version and schemas (filled in as they are read), and
+        # whether entries are framed, found when the first one is read
+        self._version = 1
+        self._schemas = {}
+        self._framed = None
+        self._damaged = False
+        # decoded entries not read yet, the data of the frame after them,
+        # and the CRC of the frames decoded since the last check entry
+        self._entries = deque()
+        self._pending = b""
+        self._check_crc = 0
+        self._damaged_next = False
+
+        # number of the next record to read, and the block index and last
+        # decoded block once there has been a random access
+        self._position = 0
+        self._seeked = False
+        self._index = None
+        self._cached_block = (None, None)
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def damaged(self):
+        """Whether reading stopped at a damaged record or the end of a log
+        that was never closed. Only framed (version 3) logs can tell."""
+        return self._damaged
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = _load_index(self._filename)
+        return self._index
+
+    def _get_block(self, block_num):
+        if self._cached_block[0] != block_num:
+            index = self._get_index()
+            offset, length = index.blocks[block_num][:2]
+            self._cached_block = (block_num, _decode_block(
+                (self._filename, offset, length, index.schemas,
+                 index.framed)))
+        return self._cached_block[1]
+
+    def _finish_record(self, rec):
+        # unwrap it
+        if self._unwrap:
+            rec = _flatten(rec)
+        else:
+            # leave the cached record alone
+            rec = dict(rec)
+
+        # append additional cols
+        rec.update(self._append_columns)
+        return rec
+
+    def _get_record(self, record_num):
+        index = self._get_index()
+        block_num = bisect.bisect_right(index.firsts, record_num) - 1
+        records = self._get_block(block_num)
+        return records[record_num - index.firsts[block_num]]
+
+    def __len__(self):
+        return self._get_index().n_records
+
+    def __getitem__(self, key):
+        n_records = len(self)
+        if isinstance(key, slice):
+            return [self._finish_record(self._get_record(i))
+                    for i in range(*key.indices(n_records))]
+        if key < 0:
+            key += n_records
+        if not 0 <= key < n_records:
+            raise IndexError("record index out of range")
+        return self._finish_record(self._get_record(key))
+
+    def tell(self):
+        """Return the number of the next record **read_record** will
+        read."""
+        return self._position
+
+    def seek(self, record_num):
+        """Move to a record, so that **read_record** reads it next.
+
+        Parameters
+        ----------
+        record_num : int
+            The record to move to. Negative numbers count back from the
+            end of the log.
+        """
+        n_records = len(self)
+        if record_num < 0:
+            record_num = max(0, record_num + n_records)
+        self._position = min(record_num, n_records)
+        self._seeked = True
+
+    def time_range(self, start=None, stop=None):
+        """Iterate over the records logged from *start* up to, but not
+        including, *stop*.
+
+        The time of a record is its *log_time*, *record_time*, or
+        *start_time* field, whichever comes first. Blocks with no records
+        in the range are never decompressed.
+
+        Parameters
+        ----------
+        start : float
+            Earliest time to include. None for no lower bound.
+        stop : float
+            Time to stop at. None for no upper bound.
+        """
+        index = self._get_index()
+        for block_num, block in enumerate(index.blocks):
+            tmin, tmax = block[4:6]
+            if tmin is None or (start is not None and tmax < start) or \
+               (stop is not None and tmin >= stop):
+                continue
+            for rec in self._get_block(block_num):
+                t = _record_time(rec)
+                if t is not None and (start is None or t >= start) and \
+                   (stop is None or t < stop):
+                    yield self._finish_record(rec)
+
+    def read_all(self, max_workers=None):
+        """Return all the records, decoding the blocks in parallel.
+
+        The blocks are read and decompressed on a pool of threads. Turning
+        them back into dicts holds the GIL, so this mostly helps large
+        logs on slow disks.
+
+        Parameters
+        ----------
+        max_workers : int
+            Maximum number of blocks to decode at once. Defaults to the
+            number of CPUs.
+        """
+        index = self._get_index()
+        args = [(self._filename, block[0], block[1], index.schemas,
+                 index.framed) for block in index.blocks]
+        if len(args) < 2 or max_workers == 1:
+            blocks = [_decode_block(arg) for arg in args]
+        else:
+            pool = ThreadPool(max_workers)
+            try:
+                blocks = pool.map(_decode_block, args)
+            finally:
+                pool.close()
+                pool.join()
+        records = []
+        for block in blocks:
+            if self._unwrap:
+                block = [_flatten(rec) for rec in block]
+            if self._append_columns:
+                for rec in block:
+                    rec.update(self._append_columns)
+            records.extend(block)
+        return records
+
+    def _load_entry(self):
+        if not self._framed:
+            return self._unpickler.load()
+        if not self._entries:
+            self._read_entries()
+        return self._entries.popleft()
+
+    def _read_entries(self):
+        """Decode the complete frames in the next chunk of the file."""
+        entries = self._entries
+        while not entries:
+            if self._damaged_next:
+                raise _DamagedEntry()
+            try:
+                # read1 so data before a truncated end is not lost
+                chunk = self._file.read1(1 << 16)
+            except (EOFError, IOError, zlib.error):
+                raise _DamagedEntry()
+            if not chunk:
+                if self._pending:
+                    raise _DamagedEntry()
+                # the end of a complete log
+                raise EOFError()
+
+            data = self._pending + chunk
+            view = memoryview(data)
+            pos = 0
+            end = len(data)
+            # the frames from checked_pos on are covered by the next check
+            checked_pos = 0
+            n_checked = 0
+            while pos + _FRAME.size <= end:
+                start = pos + _FRAME.size
+                stop = start + _FRAME.unpack_from(view, pos)[0]
+                if stop > end:
+                    break
+                try:
+                    entry = pickle.loads(view[start:stop])
+                except Exception:
+                    self._damaged_next = True
+                    break
+                if type(entry) is tuple and entry and type(entry[0]) is str:
+                    if entry[0] == _CHECK_TAG:
+                        if zlib.crc32(view[checked_pos:pos],
+                                      self._check_crc) != entry[1]:
+                            # damaged since the last check
+                            del entries[n_checked:]
+                            self._damaged_next = True
+                            break
+                        self._check_crc = 0
+                        checked_pos = stop
+                        n_checked = len(entries)
+                    elif entry[0] in (_INDEX_TAG, _FOOTER_TAG):
+                        # written between checks, so not covered by them
+                        checked_pos = stop
+                    else:
+                        entries.append(entry)
+                else:
+                    entries.append(entry)
+                pos = stop
+            if not self._damaged_next:
+                self._check_crc = zlib.crc32(view[checked_pos:pos],
+                                             self._check_crc)
+            self._pending = data[pos:]
+
+    def _load_record(self):
+        """Load entries until the next record and return it as a dict."""
+        if self._framed is None:
+            try:
+                self._framed = _is_framed(self._file.peek(64))
+            except EOFError:
+                # cut off before the first record
+                raise _DamagedEntry()
+        while True:
+            entry = self._load_entry()
+            if type(entry) is dict:
+                # version 1 record
+                return entry
+            tag = entry[0]
+            if type(tag) is int:
+                return dict(zip(self._schemas[tag], entry[1:]))
+            elif tag == _SCHEMA_TAG:
+                self._schemas[entry[1]] = entry[2]
+            elif tag == _HEADER_TAG:
+                self._version = entry[1]
+
     def read_record(self):
         """Returns a dicitionary with the field names as keys.
         """
+        if self._seeked:
+            # read from the blocks once we have moved around
+            if self._position >= len(self):
+                return None
+            rec = self._get_record(self._position)
+            self._position += 1
+            return self._finish_record(rec)
         try:
             # get the dict
-            rec = self._unpickler.load()
+            rec = self._load_record()
 
             # unwrap it
             if self._unwrap:
-                rec = _unwrap(rec)
+                rec = _flatten(rec)
 
             # append additional cols
             rec.update(self._append_columns)
 
             # return it
+            self._position += 1
             return rec
+        except _DamagedEntry:
+            if not self._damaged:
+                self._damaged = True
+                warnings.warn("%s is damaged or was never closed, so reading "
+                              "stopped after %d records. Run smile-recover "
+                              "on it to salvage the rest." %
+                              (self._filename, self._position))
+            return None
         except (EOFError, IOError):
             return None
 
@@ -143,6 +1456,98 @@ def _unwrap(d, prefix=''):
     return new_item
 
 
+class _ShapeChanged(Exception):
+    pass
+
+
+# flattening plans, keyed by the keys and value types of a record
+_flatten_plans = {}
+_MAX_SHAPES = 1024
+# nested containers can change shape without changing the key, so keep a
+# few plans per key before giving up and using _unwrap
+_MAX_PLANS_PER_SHAPE = 8
+
+
+def _compile_plan(d):
+    """Return a function that flattens records shaped like *d* exactly as
+    **_unwrap** does, or None if *d* can't be flattened that way.
+
+    The function indexes straight into the record. Its top level is
+    checked by the plan key, and it raises _ShapeChanged if a nested dict
+    or sequence doesn't match *d*.
+    """
+    lines = ["def _plan(d):"]
+    env = {"_ShapeChanged": _ShapeChanged, "_type": type, "_tuple": tuple,
+           "_map": map}
+    fields = []
+    nested = [0]
+
+    def walk(var, value, prefix):
+        if isinstance(value, dict):
+            if not all(isinstance(k, str) for k in value):
+                return False
+            items = [(prefix + k, v, "%s[%r]" % (var, k))
+                     for k, v in value.items()]
+        else:
+            items = [(prefix + str(j), v, "%s[%d]" % (var, j))
+                     for j, v in enumerate(value)]
+        for key, v, expr in items:
+            if not isinstance(v, (dict, tuple, list)):
+                fields.append((key, expr))
+                continue
+            # the type of the container itself was already checked with
+            # its parent, so only its keys and value types are left
+            nested[0] += 1
+            n = nested[0]
+            lines.append("    v%d = %s" % (n, expr))
+            if isinstance(v, dict):
+                env["_K%d" % n] = tuple(v)
+                env["_T%d" % n] = tuple(map(type, v.values()))
+                lines.append("    if (_tuple(v%d) != _K%d or\n"
+                             "            _tuple(_map(_type, v%d.values()))"
+                             " != _T%d):" % (n, n, n, n))
+            else:
+                env["_T%d" % n] = tuple(map(type, v))
+                lines.append("    if _tuple(_map(_type, v%d)) != _T%d:" %
+                             (n, n))
+            lines.append("        raise _ShapeChanged")
+            if not walk("v%d" % n, v, key + "_"):
+                return False
+        return True
+
+    if not walk("d", d, ""):
+        return None
+    if nested[0] == 0:
+        # nothing to unwrap, so a copy will do
+        return dict
+    lines.append("    return {%s}" % ", ".join("%r: %s" % field
+                                             for field in fields))
+    exec("\n".join(lines), env)
+    return env["_plan"]
+
+
+def _flatten(d):
+    """Unwrap a record like **_unwrap**, using a cached plan for records
+    of the same shape."""
+    key = (tuple(d), tuple(map(type, d.values())))
+    plans = _flatten_plans.get(key)
+    if plans is None:
+        if len(_flatten_plans) >= _MAX_SHAPES:
+            _flatten_plans.clear()
+        plans = _flatten_plans[key] = []
+    for plan in plans:
+        try:
+            return plan(d)
+        except _ShapeChanged:
+            pass
+    if len(plans) < _MAX_PLANS_PER_SHAPE:
+        plan = _compile_plan(d)
+        if plan is not None:
+            plans.append(plan)
+            return plan(d)
+    return _unwrap(d)
+
+
 def _root_to_files(log_filename):
     """Get set of slogs from root."""
     if os.path.exists(log_filename):
@@ -211,6 +1616,10 @@ def log2dl(log_filename, unwrap=True, **append_columns):
 def log2csv(log_filename, csv_filename=None, **append_columns):
     """Convert slog files to a CSV.
 
+    The slogs are read only once: rows are written to a temporary file as
+    the columns are discovered, and the header is put in front of them at
+    the end.
+
     Parameters
     ----------
     log_filename : string
@@ -242,38 +1651,565 @@ def log2csv(log_filename, csv_filename=None, **append_columns):
     if len(log_files) == 0:
         raise IOError("No matching slog files found.")
 
-    # get the set of colnames
-    colnames = []
-    for i, slog in enumerate(log_files):
-        # update the append_columns
-        append_columns.update({'log_num': i})
-        for record in LogReader(slog, unwrap=True, **append_columns):
-            for fieldname in record:
-                if fieldname not in colnames:
-                    colnames.append(fieldname)
-
     if csv_filename is None:
         # try making one out of the log_filename root
         csv_filename = os.path.splitext(log_filename)[0] + '.csv'
 
-    # loop again and write out to file
-    with open(csv_filename, 'wb') as fout:
-        # open CSV and write header
-        dw = csv.DictWriter(fout, fieldnames=list(colnames))
-        dw.writeheader()
-
-        # loop over log entries
+    # write the rows out while discovering the columns. New columns are
+    # only ever added at the end, so earlier rows are just missing the
+    # trailing fields.
+    colnames = []
+    colset = set()
+    nrows = 0
+    grew = False
+    spill_filename = csv_filename + ".tmp"
+    with open(spill_filename, 'w', newline='', encoding='utf-8') as spill:
+        writer = csv.writer(spill)
         for i, slog in enumerate(log_files):
             # update the append_columns
             append_columns.update({'log_num': i})
-
-            # loop over all records
             for record in LogReader(slog, unwrap=True, **append_columns):
-                # handle unicode
-                record = dict((k, v.encode('utf-8')
-                               if isinstance(v, unicode)
-                               else v)
-                              for k, v in record.items())
-
-                # write it out
-                dw.writerow(record)
+                if not colset.issuperset(record):
+                    for fieldname in record:
+                        if fieldname not in colset:
+                            colset.add(fieldname)
+                            colnames.append(fieldname)
+                            grew = grew or nrows > 0
+                writer.writerow([record.get(name, '') for name in colnames])
+                nrows += 1
+
+    # write the header and then the rows
+    try:
+        with open(csv_filename, 'w', newline='', encoding='utf-8') as fout, \
+             open(spill_filename, newline='', encoding='utf-8') as spill:
+            writer = csv.writer(fout)
+            writer.writerow(colnames)
+            if not grew:
+                # every row is complete, so just copy them
+                shutil.copyfileobj(spill, fout)
+            else:
+                ncols = len(colnames)
+                for row in csv.reader(spill):
+                    row.extend([''] * (ncols - len(row)))
+                    writer.writerow(row)
+    finally:
+        os.remove(spill_filename)
+
+
+def logs2csv(log_filenames, max_workers=None, processes=True):
+    """Convert several slogs to CSV files at the same time.
+
+    Each slog is converted with **log2csv** to a CSV of the same name.
+    On Linux the conversions run in a pool of forked processes; elsewhere
+    (where a new process would have to re-run the experiment script) they
+    run in a pool of threads.
+
+    Parameters
+    ----------
+    log_filenames : list of strings
+        The slogs to convert.
+    max_workers : int
+        Maximum number of conversions to run at once. Defaults to the
+        number of CPUs.
+    processes : boolean
+        Whether the conversions may run in forked processes. Pass False
+        from a process running other threads, such as a running
+        experiment, to use threads instead.
+    """
+    log_filenames = list(log_filenames)
+    if len(log_filenames) < 2 or max_workers == 1:
+        for filename in log_filenames:
+            log2csv(filename)
+        return
+
+    pool = _pool(max_workers, processes)
+    try:
+        # any conversion error is raised here
+        pool.map(log2csv, log_filenames, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# data files are named <title>_<n>.<ext> by Experiment.reserve_data_filename
+_SLOG_NAME = re.compile(r"^(.+)_(\d+)\.slog$")
+
+
+def _name_matches(name, pattern):
+    if pattern is None:
+        return True
+    if isinstance(pattern, str):
+        return fnmatch.fnmatchcase(name, pattern)
+    return any(fnmatch.fnmatchcase(name, p) for p in pattern)
+
+
+def _sorted_dirs(path, pattern):
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return []
+    return [name for name in names
+            if _name_matches(name, pattern) and
+            os.path.isdir(os.path.join(path, name))]
+
+
+def find_slogs(data_dir, experiment=None, subject=None, session=None,
+               title=None):
+    """Find the slogs in a data directory laid out by *Experiment*.
+
+    Experiments save their logs as
+    data_dir/<experiment>/<subject>/<session>/<title>_<n>.slog. Each
+    filter is either a name, a shell-style pattern such as 'log_*', or a
+    list of them, and None matches everything.
+
+    Parameters
+    ----------
+    data_dir : string
+        The top data directory, usually 'data'.
+    experiment : string or list of strings
+        Experiment names to include.
+    subject : string or list of strings
+        Subjects to include.
+    session : string or list of strings
+        Sessions to include.
+    title : string or list of strings
+        Log titles to include, such as 'log_study' for the log_study_0.slog,
+        log_study_1.slog, ... files.
+
+    Returns
+    -------
+    A list of (experiment, subject, session, title, log_num, filename)
+    tuples, sorted in that order.
+    """
+    found = []
+    for exp_name in _sorted_dirs(data_dir, experiment):
+        exp_dir = os.path.join(data_dir, exp_name)
+        for subj in _sorted_dirs(exp_dir, subject):
+            subj_dir = os.path.join(exp_dir, subj)
+            for sess in _sorted_dirs(subj_dir, session):
+                sess_dir = os.path.join(subj_dir, sess)
+                for name in os.listdir(sess_dir):
+                    match = _SLOG_NAME.match(name)
+                    if match is None or not _name_matches(match.group(1),
+                                                          title):
+                        continue
+                    found.append((exp_name, subj, sess, match.group(1),
+                                  int(match.group(2)),
+                                  os.path.join(sess_dir, name)))
+    found.sort()
+    return found
+
+
+def _load_slog(args):
+    filename, unwrap, append_columns = args
+    return list(LogReader(filename, unwrap=unwrap, **append_columns))
+
+
+def _load_indexed_slog(item):
+    return item[0], _load_slog(item[1])
+
+
+def load_slogs(data_dir, experiment=None, subject=None, session=None,
+               title=None, unwrap=True, max_workers=None, progress=None,
+               **append_columns):
+    """Load the slogs from many subjects and sessions as one dict-list.
+
+    The slogs are found with **find_slogs** and decoded in a pool of
+    processes (of threads where processes can't be forked). Every row is
+    tagged with its *subject*, *session*, and *log_num*, and the rows are
+    returned in the order of **find_slogs**, whatever order the files
+    finish loading in.
+
+    Parameters
+    ----------
+    data_dir : string
+        The top data directory, usually 'data'.
+    experiment, subject, session, title : string or list of strings
+        Filters passed on to **find_slogs**.
+    unwrap : boolean
+        Whether to unwrap logged lists and dictionaries into a
+        single row.
+    max_workers : int
+        Maximum number of slogs to load at once. Defaults to the number
+        of CPUs.
+    progress : callable
+        Called as progress(n_done, n_total, filename) each time a slog
+        has been loaded.
+    append_columns : kwargs
+        Columns to add the same value to each row.
+
+    Examples
+    --------
+    Load the study logs of every subject into a Pandas DataFrame:
+
+    ..
+        import pandas as pd
+        df = pd.DataFrame(load_slogs('data', experiment='FreeRecall',
+                                     title='log_study'))
+
+    """
+    slogs = find_slogs(data_dir, experiment=experiment, subject=subject,
+                       session=session, title=title)
+    args = []
+    for exp_name, subj, sess, log_title, log_num, filename in slogs:
+        columns = dict(append_columns)
+        columns.update({"subject": subj, "session": sess,
+                        "log_num": log_num})
+        args.append((filename, unwrap, columns))
+
+    results = [None] * len(args)
+    if len(args) < 2 or max_workers == 1:
+        for i, arg in enumerate(args):
+            results[i] = _load_slog(arg)
+            if progress is not None:
+                progress(i + 1, len(args), arg[0])
+    else:
+        pool = _pool(max_workers)
+        try:
+            # collect them as they finish and put them back in order
+            done = pool.imap_unordered(_load_indexed_slog,
+                                       list(enumerate(args)))
+            for n_done, (i, rows) in enumerate(done, 1):
+                results[i] = rows
+                if progress is not None:
+                    progress(n_done, len(args), args[i][0])
+        finally:
+            pool.close()
+            pool.join()
+
+    dl = []
+    for rows in results:
+        dl.extend(rows)
+    return dl
+
+
+class Categorical(object):
+    """A column of strings stored as integer codes into a list of
+    categories. A code of -1 marks a missing value.
+
+    Parameters
+    ----------
+    codes : array.array
+        The category index of each row.
+    categories : list of strings
+        The distinct values, in order of first appearance.
+    """
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __repr__(self):
+        return "Categorical(%d rows, %d categories)" % (len(self.codes),
+                                                        len(self.categories))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        return None if code < 0 else self.categories[code]
+
+    def __iter__(self):
+        categories = self.categories
+        for code in self.codes:
+            yield None if code < 0 else categories[code]
+
+
+# placeholder for a column that is not in a record
+_MISSING = object()
+
+
+class _ColumnBuilder(object):
+    """Accumulate the values of one column in a typed buffer.
+
+    The column type is taken from the first real value and promoted as
+    needed: int -> float when floats or missing values show up, and
+    anything that does not fit becomes a plain list of objects. Fields
+    ending in _time are always float.
+    """
+    def __init__(self, name, nmissing=0):
+        self.name = name
+        self.kind = None
+        self.data = None
+        self.categories = None
+        self._category_codes = None
+        self._nmissing = nmissing
+        self._force_float = name.endswith("_time")
+
+    def __len__(self):
+        if self.data is None:
+            return self._nmissing
+        return len(self.data)
+
+    def append(self, value):
+        # fast paths for the common cases
+        kind = self.kind
+        vtype = type(value)
+        if kind == "float":
+            if vtype is float or vtype is int:
+                try:
+                    self.data.append(value)
+                    return
+                except OverflowError:
+                    # an int too big for a float
+                    pass
+            elif value is None or value is _MISSING:
+                self.data.append(_NAN)
+                return
+        elif kind == "category":
+            if vtype is str:
+                code = self._category_codes.get(value)
+                if code is None:
+                    code = self._add_category(value)
+                self.data.append(code)
+                return
+            elif value is None or value is _MISSING:
+                self.data.append(-1)
+                return
+        elif kind == "int" and vtype is int:
+            try:
+                self.data.append(value)
+                return
+            except OverflowError:
+                # beyond int64, such as a hash or a time in nanoseconds
+                pass
+        elif kind == "bool" and vtype is bool:
+            self.data.append(value)
+            return
+        elif kind == "object":
+            self.data.append(None if value is _MISSING else value)
+            return
+        self._append_slow(value)
+
+    def _add_category(self, value):
+        code = len(self.categories)
+        self.categories.append(value)
+        self._category_codes[value] = code
+        return code
+
+    def _append_slow(self, value):
+        vtype = type(value)
+        missing = value is None or value is _MISSING
+        if self.kind is None:
+            if missing:
+                self._nmissing += 1
+                return
+            # pick the column type from the first value
+            nmissing = self._nmissing
+            if vtype is str:
+                self.kind = "category"
+                self.data = array.array('i', [-1] * nmissing)
+                self.categories = []
+                self._category_codes = {}
+            elif vtype in (int, float) and (self._force_float or
+                                            vtype is float or nmissing):
+                self.kind = "float"
+                self.data = array.array('d', [_NAN] * nmissing)
+            elif vtype is int:
+                self.kind = "int"
+                self.data = array.array('q')
+            elif vtype is bool and not nmissing:
+                self.kind = "bool"
+                self.data = array.array('b')
+            else:
+                self.kind = "object"
+                self.data = [None] * nmissing
+        elif self.kind == "int" and (vtype is float or missing):
+            self.kind = "float"
+            self.data = array.array('d', self.data)
+        else:
+            # the value doesn't fit, so fall back to python objects
+            self.data = self.values()
+            self.kind = "object"
+        self.append(value)
+
+    def values(self):
+        """Return the column as a list of python values."""
+        if self.data is None:
+            return [None] * self._nmissing
+        elif self.kind == "category":
+            categories = self.categories
+            return [None if code < 0 else categories[code]
+                    for code in self.data]
+        elif self.kind == "bool":
+            return [bool(v) for v in self.data]
+        return list(self.data)
+
+    def column(self):
+        """Return the finished column."""
+        if self.data is None:
+            return [None] * self._nmissing
+        elif self.kind == "category":
+            return Categorical(self.data, self.categories)
+        return self.data
+
+
+_NAN = float("nan")
+
+
+def log2columns(log_filename, unwrap=True, **append_columns):
+    """Load slog files into one typed buffer per column.
+
+    Unlike **log2dl**, no list of dicts is built: each record is streamed
+    straight into its columns, which keeps memory use low for large logs
+    such as mouse tracking records.
+
+    Parameters
+    ----------
+    log_filename : string
+        A full slog filename or the base name of a set of slogs, as for
+        **log2dl**.
+    unwrap : boolean
+        Whether to unwrap logged lists and dictionaries into separate
+        columns. e.g., 'appear_time': {'time': 10, 'error': .001} becomes
+        'appear_time_time' and 'appear_time_error'.
+    append_columns : kwargs
+        Columns to add the same value to each row.
+
+    Returns
+    -------
+    dict
+        Maps column names (in order of first appearance) to columns.
+        Numbers are in *array.array* buffers (float64 'd' or int64 'q',
+        with NaN for missing floats), booleans in 'b' buffers, strings in
+        **Categorical** columns, and anything else in lists.
+
+    """
+    log_files = _root_to_files(log_filename)
+    if len(log_files) == 0:
+        raise IOError("No matching slog files found.")
+
+    builders = {}
+    nrows = 0
+    for i, slog in enumerate(log_files):
+        append_columns.update({'log_num': i})
+        for record in LogReader(slog, unwrap=unwrap, **append_columns):
+            for name, value in record.items():
+                builder = builders.get(name)
+                if builder is None:
+                    builder = builders[name] = _ColumnBuilder(name, nrows)
+                builder.append(value)
+            nrows += 1
+
+            # pad the columns this record didn't have
+            if len(record) != len(builders):
+                for builder in builders.values():
+                    if len(builder) < nrows:
+                        builder.append(_MISSING)
+
+    return {name: builder.column() for name, builder in builders.items()}
+
+
+def log2arrays(log_filename, unwrap=True, **append_columns):
+    """Load slog files into a NumPy structured array.
+
+    Works like **log2columns**, but requires NumPy. Float columns become
+    float64 fields, integer columns int64, booleans bool, and strings and
+    everything else object fields, so the result can go straight into
+    *pandas.DataFrame*.
+
+    ..
+        import pandas as pd
+        df = pd.DataFrame(log2arrays('record_mouse', subject='exp001'))
+
+    """
+    import numpy as np
+
+    columns = log2columns(log_filename, unwrap=unwrap, **append_columns)
+    nrows = len(next(iter(columns.values()))) if len(columns) else 0
+    dtypes = {'d': 'f8', 'q': 'i8', 'b': '?'}
+    fields = []
+    for name, column in columns.items():
+        typecode = getattr(column, 'typecode', None)
+        fields.append((name, dtypes.get(typecode, 'O')))
+    result = np.empty(nrows, dtype=fields)
+    for name, column in columns.items():
+        if isinstance(column, Categorical):
+            categories = np.array(column.categories + [None], dtype=object)
+            result[name] = categories[np.frombuffer(column.codes,
+                                                    dtype=np.int32)]
+        elif isinstance(column, array.array):
+            result[name] = np.frombuffer(column, dtype=column.typecode)
+        else:
+            result[name] = column
+    return result
+
+
+def save_columns(columns, filename, compresslevel=6):
+    """Write columns from **log2columns** to a columnar file.
+
+    The file is a zip archive holding each column as a separately
+    compressed member plus a JSON manifest, so single columns can be read
+    back without decompressing the rest. Columns that are not typed
+    buffers or **Categorical** are pickled.
+
+    Parameters
+    ----------
+    columns : dict
+        Column name to column, as returned by **log2columns**.
+    filename : string
+        Where to write the file.
+    compresslevel : int
+        The zlib compression level for each column.
+    """
+    manifest = []
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for n, (name, column) in enumerate(columns.items()):
+            member = "col%d" % n
+            entry = {"name": name, "member": member}
+            if isinstance(column, Categorical):
+                entry.update(kind="category", typecode=column.codes.typecode,
+                             categories=column.categories)
+                data = column.codes.tobytes()
+            elif isinstance(column, array.array):
+                entry.update(kind="array", typecode=column.typecode)
+                data = column.tobytes()
+            else:
+                entry.update(kind="pickle")
+                data = pickle.dumps(list(column), protocol=3)
+            _zip_write(zf, member, data, compresslevel)
+            manifest.append(entry)
+        zf.writestr("manifest.json", json.dumps({"version": 1,
+                                                 "byteorder": sys.byteorder,
+                                                 "columns": manifest}))
+
+
+def _zip_write(zf, member, data, compresslevel):
+    info = zipfile.ZipInfo(member)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    try:
+        zf.writestr(info, data, compresslevel=compresslevel)
+    except TypeError:
+        # compresslevel needs python 3.7
+        zf.writestr(info, data)
+
+
+def load_columns(filename, names=None):
+    """Read columns written by **save_columns**.
+
+    Parameters
+    ----------
+    filename : string
+        The columnar file.
+    names : list of strings
+        Only read these columns. Defaults to all of them.
+    """
+    columns = {}
+    with zipfile.ZipFile(filename) as zf:
+        manifest = json.loads(zf.read("manifest.json").decode('utf-8'))
+        swap = manifest["byteorder"] != sys.byteorder
+        for entry in manifest["columns"]:
+            if names is not None and entry["name"] not in names:
+                continue
+            data = zf.read(entry["member"])
+            if entry["kind"] == "pickle":
+                columns[entry["name"]] = pickle.loads(data)
+                continue
+            column = array.array(entry["typecode"])
+            column.frombytes(data)
+            if swap:
+                column.byteswap()
+            if entry["kind"] == "category":
+                column = Categorical(column, entry["categories"])
+            columns[entry["name"]] = column
+    return columns
@@ -0,0 +1,494 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import os
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from .log import FlushPolicy, _flatten, _open_writers, _FLUSH, _CLOSE
+
+
+# A session database has one table per log title. The rows of a table are
+# the unwrapped records of every log with that title, in the order they
+# were written, plus a log_num column telling the logs apart:
+#
+#   log_study                   Log(name="study") records
+#   state_Label                 Label state records
+#   record_mouse                Record(name="mouse") records
+#
+# Columns are added as new record keys show up, declared with the type of
+# their first value, or no type if it is None. Values sqlite has no type
+# for, such as numpy arrays, are stored as JSON, and db2dl decodes those
+# in columns declared JSON. Numpy scalars are stored as the numbers they
+# hold. Every column whose name ends in "_time" is indexed as it is added.
+
+# values sqlite stores as they are, and the declared type of their columns
+_SQL_TYPES = ((bool, "INTEGER"),
+              (int, "INTEGER"),
+              (float, "REAL"),
+              (str, "TEXT"),
+              (bytes, "BLOB"),
+              (type(None), ""))
+
+
+def _sql_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _plain(value):
+    # numpy scalars and arrays as the numbers and lists they hold
+    tolist = getattr(value, "tolist", None)
+    if tolist is None or isinstance(value, (str, bytes)):
+        return value
+    return tolist()
+
+
+def _sql_type(value):
+    value = _plain(value)
+    for value_type, declared in _SQL_TYPES:
+        if isinstance(value, value_type):
+            return declared
+    return "JSON"
+
+
+def _json_default(value):
+    value = _plain(value)
+    if isinstance(value, list):
+        return value
+    return str(value)
+
+
+def _sql_value(value, declared):
+    value = _plain(value)
+    if value is None:
+        return None
+    if declared != "JSON":
+        if isinstance(value, bool):
+            return int(value)
+        if _sql_type(value) != "JSON":
+            return value
+    # a column of another type that gets such a value stores it as JSON
+    # too, but reads it back as text
+    return json.dumps(value, default=_json_default)
+
+
+def _time_columns(columns):
+    return [c for c in columns if c == "time" or c.endswith("_time")]
+
+
+class SQLiteStore(object):
+    """A SQLite database that holds every log of a session.
+
+    Records are unwrapped like **log2dl** does and inserted in batches by
+    a writer thread, one transaction per batch, with the database in WAL
+    mode so it can be read while the experiment is still writing it. If
+    inserting a batch fails, the records after it are dropped and the
+    error is raised by **close**, rather than by a write in the middle of
+    the experiment.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the database. An existing database is added to.
+    flush_policy : FlushPolicy
+        With the 'log' and 'record' modes every committed batch is synced
+        to disk. The other modes leave syncing to SQLite's WAL
+        checkpoints, so a power failure can lose the last few batches,
+        but a crash of the experiment can not.
+    queue_size : int
+        The most records that can wait on the writer thread before
+        **write_record** blocks.
+    """
+    def __init__(self, filename, flush_policy=None, queue_size=65536):
+        if flush_policy is None:
+            flush_policy = FlushPolicy()
+        self._filename = filename
+        self._policy = flush_policy
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._has_data = threading.Event()
+        self._has_space = threading.Event()
+        self._closed = False
+        self._error = None
+        self._stats = {"records": 0,
+                       "batches": 0,
+                       "max_queue_depth": 0,
+                       "blocked_writes": 0,
+                       "blocked_time": 0.0}
+
+        # only the writer thread uses these
+        self._columns = {}
+        self._types = {}
+        self._inserts = {}
+
+        # connect here so a bad path fails in the caller
+        self._conn = sqlite3.connect(filename, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=%s" %
+                           ("FULL" if flush_policy.mode in ("log", "record")
+                            else "NORMAL"))
+        for (table,) in self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"):
+            info = self._conn.execute(
+                "PRAGMA table_info(%s)" % _sql_name(table)).fetchall()
+            self._columns[table] = [row[1] for row in info]
+            self._types[table] = {row[1]: row[2] for row in info}
+            self._set_insert(table)
+
+        self._thread = threading.Thread(
+            target=self._writer_loop,
+            name="SQLiteStore(%s)" % os.path.basename(filename))
+        self._thread.daemon = True
+        self._thread.start()
+        _open_writers.add(self)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def stats(self):
+        """Dict of counters for this database.
+
+        *records* is the number of records inserted, *batches* the number
+        of transactions they were inserted in, and *max_queue_depth*,
+        *blocked_writes* and *blocked_time* are as for a threaded
+        **LogWriter**.
+        """
+        stats = self._stats.copy()
+        stats["queue_depth"] = len(self._queue)
+        stats["queue_size"] = self._queue_size
+        return stats
+
+    def log_writer(self, title, log_num=0):
+        """Return a writer for the records of one log.
+
+        Parameters
+        ----------
+        title : string
+            Name of the table the records go into.
+        log_num : int
+            Stored with every record to tell apart logs with the same
+            title.
+        """
+        return SQLiteLogWriter(self, title, log_num)
+
+    def flush(self):
+        """Commit the records written so far once the writer thread gets
+        to them."""
+        self._put((_FLUSH, None))
+
+    def close(self):
+        """Insert any queued records and close the database, raising the
+        error of an insert that failed, if there was one."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.append(_CLOSE)
+        self._has_data.set()
+        self._thread.join()
+        _open_writers.discard(self)
+        self._conn.close()
+        self._raise_error()
+
+    def _put(self, item):
+        if self._closed:
+            raise ValueError("write to closed SQLiteStore %r" %
+                             self._filename)
+        if len(self._queue) >= self._queue_size:
+            start = time.perf_counter()
+            self._stats["blocked_writes"] += 1
+            while (len(self._queue) >= self._queue_size and
+                   self._thread.is_alive()):
+                self._has_space.clear()
+                self._has_data.set()
+                self._has_space.wait(0.01)
+            self._stats["blocked_time"] += time.perf_counter() - start
+        self._queue.append(item)
+        depth = len(self._queue)
+        if depth > self._stats["max_queue_depth"]:
+            self._stats["max_queue_depth"] = depth
+        if not self._has_data.is_set():
+            self._has_data.set()
+
+    def _writer_loop(self):
+        while True:
+            self._has_data.wait()
+            self._has_data.clear()
+            batch = []
+            closing = False
+            while True:
+                try:
+                    item = self._queue.popleft()
+                except IndexError:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                if item[0] is not _FLUSH:
+                    batch.append(item)
+            self._has_space.set()
+
+            # every commit is a flush, so flush requests only need to
+            # wake the thread
+            if batch and self._error is None:
+                try:
+                    self._insert(batch)
+                except Exception as e:
+                    # raised by close, and nothing more is inserted
+                    self._error = e
+            if closing:
+                return
+
+    def _insert(self, batch):
+        # rows of each table keep their order, and rows missing some of
+        # the table's columns get NULLs
+        rows = {}
+        for table, log_num, record in batch:
+            row = _flatten(record)
+            row["log_num"] = log_num
+            insert = self._inserts.get(table)
+            if insert is None or not all(key in insert[1] for key in row):
+                # new table or new keys
+                self._add_columns(table, row)
+            rows.setdefault(table, []).append(row)
+
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            for table, table_rows in rows.items():
+                columns = self._columns[table]
+                types = self._types[table]
+                conn.executemany(
+                    self._inserts[table][0],
+                    [tuple(_sql_value(row.get(column), types[column])
+                           for column in columns)
+                     for row in table_rows])
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._stats["records"] += len(batch)
+        self._stats["batches"] += 1
+
+    def _add_columns(self, table, row):
+        conn = self._conn
+        columns = self._columns.get(table)
+        types = self._types.setdefault(table, {})
+        new = [key for key in row if key not in types]
+        for key in new:
+            types[key] = _sql_type(row[key])
+        if columns is None:
+            columns = self._columns[table] = []
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (%s)" %
+                         (_sql_name(table),
+                          ", ".join("%s %s" % (_sql_name(key), types[key])
+                                    for key in new)))
+        else:
+            for key in new:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                             (_sql_name(table), _sql_name(key), types[key]))
+        columns.extend(new)
+        for column in _time_columns(new):
+            conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" %
+                         (_sql_name("%s_%s" % (table, column)),
+                          _sql_name(table), _sql_name(column)))
+        self._set_insert(table)
+
+    def _set_insert(self, table):
+        columns = self._columns[table]
+        self._inserts[table] = (
+            "INSERT INTO %s (%s) VALUES (%s)" %
+            (_sql_name(table), ", ".join(map(_sql_name, columns)),
+             ", ".join("?" * len(columns))),
+            set(columns))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class SQLiteLogWriter(object):
+    """Writes the records of one log into a table of a **SQLiteStore**.
+
+    It takes the place of a **LogWriter**, so *Log*, *Record* and the
+    state logs can write to either one.
+    """
+    def __init__(self, store, title, log_num=0):
+        self._store = store
+        self._title = title
+        self._log_num = log_num
+        self._closed = False
+
+    @property
+    def filename(self):
+        return self._store.filename
+
+    @property
+    def title(self):
+        return self._title
+
+    def write_record(self, data):
+        """Queue a single row for the log's table.
+
+        Parameters
+        ----------
+        data : dict
+            This is a dictionary where the keys are the
+            field names that you are writing out to the table.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("data to log must be a dict instance.")
+        if self._closed:
+            raise ValueError("write to closed log %r" % self._title)
+        # copy so the caller is free to reuse the dict
+        self._store._put((self._title, self._log_num, dict(data)))
+
+    def request_flush(self):
+        """Ask for written records to be committed, as a *Log* state with
+        flush=True does."""
+        if self._store._policy.mode == "log":
+            self._store.flush()
+
+    def idle(self):
+        """Inserts happen on the store's thread, so this does nothing."""
+        pass
+
+    def flush(self, sync=True):
+        """Commit the records written so far."""
+        self._store.flush()
+
+    def close(self):
+        """Stop writing to this log. The records are inserted when the
+        store gets to them, and the store itself stays open."""
+        self._closed = True
+
+
+def _connect(db_filename):
+    if not os.path.exists(db_filename):
+        raise IOError("no such database: %r" % db_filename)
+    # read-only, so a database still being written is left alone
+    uri = pathlib.Path(os.path.abspath(db_filename)).as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True)
+
+
+def db_titles(db_filename):
+    """Return the titles of the logs in a session database."""
+    conn = _connect(db_filename)
+    try:
+        return [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "ORDER BY name")]
+    finally:
+        conn.close()
+
+
+def db_query(db_filename, sql, params=()):
+    """Run a SQL query on a session database and return the rows as a
+    list of dicts.
+
+    Tables are named after the log titles, so logs can be joined on their
+    columns, for example to line up responses with the stimuli before
+    them::
+
+        db_query("session_0.sqlite",
+                 'SELECT * FROM "log_test" JOIN "record_key" '
+                 'ON "record_key"."press_time_time" BETWEEN '
+                 '"log_test"."appear_time_time" AND '
+                 '"log_test"."disappear_time_time"')
+
+    Values stored as JSON, such as lists, come back as text.
+
+    Parameters
+    ----------
+    db_filename : string
+        Path of the database.
+    sql : string
+        The query.
+    params : sequence or dict
+        Values for the placeholders in *sql*.
+    """
+    conn = _connect(db_filename)
+    try:
+        cursor = conn.execute(sql, params)
+        keys = [d[0] for d in cursor.description]
+        return [dict(zip(keys, row)) for row in cursor]
+    finally:
+        conn.close()
+
+
+def db2dl(db_filename, title, start=None, stop=None, time_column=None,
+          **append_columns):
+    """Return the records of the logs with a title as a list of dicts.
+
+    This is **log2dl** for a session database. The records come back
+    unwrapped, with a *log_num* column and None for columns a record did
+    not have. Values stored as JSON, such as lists, are decoded.
+
+    Parameters
+    ----------
+    db_filename : string
+        Path of the database.
+    title : string
+        Title of the logs, such as "log_study" or "state_Label".
+    start, stop : float
+        Only return records whose *time_column* is in [start, stop), which
+        uses the column's index.
+    time_column : string
+        The column *start* and *stop* apply to. Defaults to the first of
+        "log_time", "record_time_time" and "start_time" in the table.
+    append_columns : keyword arguments
+        Columns to add to every record.
+    """
+    conn = _connect(db_filename)
+    try:
+        info = conn.execute("PRAGMA table_info(%s)" %
+                            _sql_name(title)).fetchall()
+        columns = [row[1] for row in info]
+        json_columns = [row[1] for row in info if row[2] == "JSON"]
+        if not columns:
+            raise ValueError("no log %r in %r" % (title, db_filename))
+        sql = "SELECT * FROM %s" % _sql_name(title)
+        params = []
+        if start is not None or stop is not None:
+            if time_column is None:
+                for name in ("log_time", "record_time_time", "start_time"):
+                    if name in columns:
+                        time_column = name
+                        break
+                else:
+                    raise ValueError("log %r has no time column" % title)
+            conditions = []
+            if start is not None:
+                conditions.append("%s >= ?" % _sql_name(time_column))
+                params.append(start)
+            if stop is not None:
+                conditions.append("%s < ?" % _sql_name(time_column))
+                params.append(stop)
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY rowid"
+        rows = []
+        for values in conn.execute(sql, params):
+            row = dict(zip(columns, values))
+            for column in json_columns:
+                # numbers come back as numbers, as the column's affinity
+                # is numeric
+                if isinstance(row[column], str):
+                    row[column] = json.loads(row[column])
+            row.update(append_columns)
+            rows.append(row)
+        return rows
+    finally:
+        conn.close()
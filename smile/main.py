@@ -35,6 +35,7 @@ from packaging import version
 # local imports
 from .event import event_time
 from .clock import clock
+from .ref import propagation
 from .video import normalize_color_spec
 from .scale import scale
 
@@ -351,15 +352,23 @@ class SmileApp(App):
         # record the time range
         self._new_time = clock.now()
 
-        # call any of our scheduled events that are ready
-        clock.tick()
+        # Ref changes made by the scheduled events and the input are
+        # delivered together before drawing, if the experiment coalesces
+        # them
+        with propagation.batch():
+            # call any of our scheduled events that are ready, leaving
+            # background work for later if it would hold up the draw
+            if self.exp._tick_margin is None:
+                clock.tick()
+            else:
+                clock.tick(self._next_draw_time - self.exp._tick_margin)
 
-        # dispatch input events
-        time_err = (clock.now() - self._post_dispatch_time) / 2.0
-        self.dispatch_input_event_time = event_time(self._post_dispatch_time +
-                                                    time_err, time_err)
-        event_loop.dispatch_input()
-        self._post_dispatch_time = clock.now()
+            # dispatch input events
+            time_err = (clock.now() - self._post_dispatch_time) / 2.0
+            self.dispatch_input_event_time = event_time(
+                self._post_dispatch_time + time_err, time_err)
+            event_loop.dispatch_input()
+            self._post_dispatch_time = clock.now()
 
         # processing video and drawing can only happen if we have
         # not already drawn
@@ -457,6 +466,9 @@ class SmileApp(App):
             # reset for next flip
             self.pending_flip_time = None
 
+            # we just flipped, so this is the best time to sync logs
+            self.exp._idle_flush_logs()
+
         # exit if experiment done
         if not self.exp._root_executor._active:
             if self.exp._root_executor._enter_time:
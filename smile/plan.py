@@ -0,0 +1,341 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import os
+import random
+import shutil
+import tempfile
+
+from .clock import clock
+from .ref import Ref, propagation, interning, profiler
+from .state import Loop, LeadTimes, clone_pool
+from .video import VisualState
+from .audio import Beep, SoundFile
+from .keyboard import KeyPress
+from .headless import run_headless
+
+# Dry runs an experiment before anyone sits in front of it. **plan** runs
+# the experiment, already built, several times in virtual time with
+# run_headless, each with different jitter, shuffles and response times,
+# pressing keys for the subject, and reports how long it takes, how many
+# states it enters, and how much time each stimulus had to spare between
+# being ready and its start time. Its logs go to a temporary directory
+# that is removed afterwards:
+#
+#   exp = Experiment(name="Stroop")
+#   ... build the experiment ...
+#   print(plan(exp, runs=20).report())
+#   exp.run()
+#
+# The dry runs iterate over what each Loop loops over for real, so a Loop
+# over an iterator, such as a generator, would be used up before the real
+# run; plan refuses those. What the runs leave behind in the clock, the
+# propagation of changes, the clone pool and the state builders is put
+# back as it was after each run.
+
+
+# states presenting stimuli, which need to be ready before they start
+_STIMULUS_STATES = (VisualState, Beep, SoundFile)
+
+
+class _PlanRecorder(LeadTimes):
+    """Records lead times, as **Experiment(lead_time=...)** does, and
+    for each run the number of states entered and the slack of each loop
+    trial: the least lead time of the stimuli in it."""
+    def __init__(self):
+        super(_PlanRecorder, self).__init__()
+        self.entered = 0
+        # loop original -> [name, filename, lineno, {(loop clone, i): slack}]
+        self.trials = {}
+
+    def record(self, state, lead):
+        super(_PlanRecorder, self).record(state, lead)
+        self.entered += 1
+        if not isinstance(state, _STIMULUS_STATES):
+            return
+        loop = state._parent
+        while loop is not None and not isinstance(loop, Loop):
+            loop = loop._parent
+        if loop is None:
+            return
+        trials = self.trials.get(loop.original_builder)
+        if trials is None:
+            if loop._name is None:
+                name = "Loop"
+            else:
+                name = "Loop (%s)" % (loop._name,)
+            trials = self.trials[loop.original_builder] = [
+                name, loop._instantiation_filename,
+                loop._instantiation_lineno, {}]
+        trial = (id(loop), loop._i)
+        slack = trials[3].get(trial)
+        if slack is None or lead < slack:
+            trials[3][trial] = lead
+
+
+def _iter_states(state):
+    yield state
+    for child in getattr(state, "_children", ()):
+        for descendant in _iter_states(child):
+            yield descendant
+
+
+def _is_iterator(obj):
+    # an iterator is its own iterator, so iterating it uses it up; the
+    # type is checked rather than calling iter, which may start a read
+    if isinstance(obj, Ref):
+        return any(_is_iterator(arg)
+                   for arg in obj.pargs + tuple(obj.kwargs.values()))
+    return hasattr(type(obj), "__next__")
+
+
+def _check_iterables(exp):
+    for state in _iter_states(exp._root_state):
+        if (isinstance(state, Loop) and
+            _is_iterator(state._refs_for_init_attrs.get("_iterable"))):
+            raise ValueError(
+                "Loop at %s:%s loops over an iterator, which the dry runs "
+                "would use up before the experiment runs; pass a list, or "
+                "a TrialSource, which reads its trials afresh each time" %
+                (state._instantiation_filename,
+                 state._instantiation_lineno))
+
+
+def _save_globals(exp):
+    """Return the state of the singletons and state builders a run of
+    *exp* changes, for **_restore_globals**. The run records the lateness
+    of its events, if the clock does, in a record of its own."""
+    builders = [(state, state._State__most_recently_entered_clone,
+                 list(state._clone_pool))
+                for state in _iter_states(exp._root_state)]
+    lateness = clock.lateness
+    if lateness is not None:
+        clock.record_lateness(lateness.size)
+    return {"clock": (list(clock._immediate), list(clock._heap),
+                      {func: list(events)
+                       for func, events in clock._by_func.items()},
+                      list(clock._unhashable), list(clock._deferred),
+                      clock._n_cancelled, clock._stats.copy(), lateness),
+            # the version only ever goes up, as the Refs cached during
+            # the runs are stamped with it
+            "propagation": (propagation.coalesce, propagation._batch_depth,
+                            propagation._pending.copy(),
+                            propagation._stats.copy()),
+            "interning": (interning.enabled, interning._stats.copy()),
+            "profiler": (profiler.enabled, profiler.current_state,
+                         profiler._entries.copy(),
+                         profiler._descriptions.copy()),
+            "clone_pool": (clone_pool.enabled, clone_pool.size,
+                           clone_pool._stats.copy()),
+            "builders": builders}
+
+
+def _restore_globals(saved):
+    (immediate, heap, by_func, unhashable, deferred, n_cancelled, stats,
+     lateness) = saved["clock"]
+    clock._immediate.clear()
+    clock._immediate.extend(immediate)
+    clock._heap[:] = heap
+    clock._by_func = by_func
+    clock._unhashable[:] = unhashable
+    clock._deferred.clear()
+    clock._deferred.extend(deferred)
+    clock._n_cancelled = n_cancelled
+    clock._stats = stats
+    clock.lateness = lateness
+    (propagation.coalesce, propagation._batch_depth, propagation._pending,
+     propagation._stats) = saved["propagation"]
+    interning.enabled, interning._stats = saved["interning"]
+    enabled, profiler.current_state, profiler._entries, \
+        profiler._descriptions = saved["profiler"]
+    if enabled:
+        profiler.enable()
+    else:
+        profiler.disable()
+    clone_pool.enabled, clone_pool.size, clone_pool._stats = \
+        saved["clone_pool"]
+    for state, clone, pool in saved["builders"]:
+        state._State__most_recently_entered_clone = clone
+        state._clone_pool[:] = pool
+
+
+def _percentiles(values, percents=(5, 50, 95)):
+    values = sorted(values)
+    return [values[min(len(values) - 1,
+                       int(round(percent / 100. * (len(values) - 1))))]
+            for percent in percents]
+
+
+class Plan(object):
+    """What the dry runs of an experiment by **plan** found.
+
+    Properties
+    ----------
+    durations : list of float
+        How long each run took, in seconds.
+    entered : list of int
+        How many states each run entered.
+    """
+    def __init__(self, durations, entered, states, loops):
+        self.durations = durations
+        self.entered = entered
+        self._states = states
+        self._loops = loops
+
+    def summary(self):
+        """Return a dict with the number of runs and the mean, min, max
+        and 5th, 50th and 95th percentile of their durations, and the mean
+        number of states they entered."""
+        p5, p50, p95 = _percentiles(self.durations)
+        return {"runs": len(self.durations),
+                "mean_duration": sum(self.durations) / len(self.durations),
+                "min_duration": min(self.durations),
+                "max_duration": max(self.durations),
+                "p5_duration": p5,
+                "p50_duration": p50,
+                "p95_duration": p95,
+                "mean_entered": sum(self.entered) / float(len(self.entered))}
+
+    def states(self):
+        """Return a list of dicts, one per state, as in the lead_time log of
+        **Experiment(lead_time=...)**, over all the runs, the states with
+        the least lead time first."""
+        return sorted(self._states, key=lambda row: row["min_lead"])
+
+    def loops(self):
+        """Return a list of dicts, one per *Loop* with stimuli, with the
+        number of trials over all the runs, the min, mean and 5th
+        percentile of the slack of their trials, and how many trials had
+        a stimulus with no slack at all."""
+        rows = []
+        for name, filename, lineno, slacks in self._loops:
+            rows.append({"loop": name,
+                         "filename": filename,
+                         "lineno": lineno,
+                         "trials": len(slacks),
+                         "min_slack": min(slacks),
+                         "mean_slack": sum(slacks) / len(slacks),
+                         "p5_slack": _percentiles(slacks, (5,))[0],
+                         "no_slack": sum(1 for slack in slacks
+                                         if slack <= 0.0)})
+        return rows
+
+    def report(self):
+        """Return the summary, loops and the states with the least lead
+        time as text."""
+        summary = self.summary()
+        lines = ["%d runs: %.1f s on average (%.1f to %.1f s, 5-95%%: "
+                 "%.1f to %.1f s), %.0f states entered" %
+                 (summary["runs"], summary["mean_duration"],
+                  summary["min_duration"], summary["max_duration"],
+                  summary["p5_duration"], summary["p95_duration"],
+                  summary["mean_entered"])]
+        for row in self.loops():
+            lines.append("%s at %s:%s: %d trials, slack min %.4f s, mean "
+                         "%.4f s, %d with none" %
+                         (row["loop"], row["filename"], row["lineno"],
+                          row["trials"], row["min_slack"], row["mean_slack"],
+                          row["no_slack"]))
+        for row in self.states()[:10]:
+            lines.append("%s at %s:%s: lead min %.4f s, mean %.4f s, late "
+                         "%d of %d" %
+                         (row["state"], row["filename"], row["lineno"],
+                          row["min_lead"], row["mean_lead"], row["late"],
+                          row["enters"]))
+        return "\n".join(lines)
+
+
+def plan(exp, runs=20, seed=None, respond=None, response_time=(0.3, 1.0),
+         frame_rate=60., max_time=None):
+    """Dry run an experiment, already built, to see how long it will take
+    and how much time its stimuli have to spare.
+
+    Parameters
+    ----------
+    exp : Experiment
+        The experiment, built but not run.
+    runs : int
+        How many times to run it. Each run draws its own jitter, shuffles
+        and response times.
+    seed : int
+        Seeds the random numbers of the runs, so they can be repeated.
+        Python's random number generator is put back as it was afterwards.
+    respond : function
+        As for *run_headless*. By default, every *KeyPress* is answered
+        with the first key it accepts, or the spacebar, after a response
+        time drawn uniformly from *response_time*.
+    response_time : (float, float)
+        The range of the default response times, in seconds.
+    frame_rate : float
+        How often the simulated screen flips.
+    max_time : float
+        If given, stop with a RuntimeError if a run takes longer than
+        this many seconds.
+
+    Returns a **Plan**. The lead time of a stimulus is how long before its
+    start time it finished entering; with none to spare, it may miss its
+    flip. States waiting for input other than keys, such as a *MousePress*
+    without a duration, need a *respond* function or a duration to be
+    planned.
+
+    A ValueError is raised if a *Loop* loops over an iterator, such as a
+    generator, which the dry runs would use up. The clock, the clone pool
+    and the other singletons a run changes are put back as they were
+    after each run.
+    """
+    _check_iterables(exp)
+    rng = random.Random(seed)
+    if respond is None:
+        def respond(state):
+            if not isinstance(state, KeyPress):
+                return None
+            keys = state._keys
+            key = keys[0] if keys else "SPACEBAR"
+            return (key, rng.uniform(*response_time))
+
+    random_state = random.getstate()
+    saved = {name: getattr(exp, name) for name in
+             ("_session_dir", "_sysinfo_slog", "_reserved_data_filenames",
+              "_lead_times", "_sysinfo")}
+    saved_app = getattr(exp, "_app", None)
+    plan_dir = tempfile.mkdtemp(prefix="smile_plan_")
+    durations = []
+    entered = []
+    states = LeadTimes()
+    loops = {}
+    try:
+        for run in range(runs):
+            random.seed(rng.random())
+            recorder = _PlanRecorder()
+            exp._session_dir = tempfile.mkdtemp(dir=plan_dir)
+            exp._sysinfo_slog = os.path.join(exp._session_dir,
+                                            "sysinfo.slog")
+            exp._reserved_data_filenames = set()
+            exp._sysinfo = saved["_sysinfo"].copy()
+            exp._lead_times = recorder
+            saved_globals = _save_globals(exp)
+            try:
+                durations.append(run_headless(exp, respond=respond,
+                                              frame_rate=frame_rate,
+                                              max_time=max_time))
+            finally:
+                _restore_globals(saved_globals)
+            entered.append(recorder.entered)
+            states.merge(recorder)
+            for original, (name, filename, lineno,
+                           slacks) in recorder.trials.items():
+                loops.setdefault(original, [name, filename, lineno, []])[
+                    3].extend(slacks.values())
+    finally:
+        for name, value in saved.items():
+            setattr(exp, name, value)
+        exp._app = saved_app
+        random.setstate(random_state)
+        shutil.rmtree(plan_dir, ignore_errors=True)
+    return Plan(durations, entered, states.summary(), list(loops.values()))
@@ -9,7 +9,7 @@
 
 import sys
 from .state import Wait, State, Loop, Done, Log, Subroutine
-from .clock import clock
+from .clock import clock, CRITICAL
 from .event import event_time
 from .ref import NotAvailable
 
@@ -229,7 +229,8 @@ class Pulse(State):
             self._code_num = ncode
 
     def _schedule_start(self):
-        clock.schedule(self._callback, event_time=self._start_time)
+        clock.schedule(self._callback, event_time=self._start_time,
+                       priority=CRITICAL)
 
     def _unschedule_start(self):
         clock.unschedule(self._callback)
@@ -283,7 +284,8 @@ class Pulse(State):
             if self._width > 0.0:
                 # we're gonna turn off ourselves
                 clock.schedule(self._pulse_off_callback,
-                               event_time=self._pulse_on['time']+self._width)
+                               event_time=self._pulse_on['time']+self._width,
+                               priority=CRITICAL)
             else:
                 # we're gonna leave it
                 self._pulse_off = None
@@ -0,0 +1,80 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import argparse
+import os
+import sys
+
+from .log import recover_slog
+
+
+def main(argv=None):
+    """Salvage the complete records from damaged or unclosed .slog files.
+
+    Installed as the *smile-recover* command.
+    """
+    parser = argparse.ArgumentParser(
+        prog="smile-recover",
+        description="Salvage every complete record from .slog files left "
+                    "damaged or unclosed by a crash.")
+    parser.add_argument("slogs", nargs="+", help=".slog files to recover")
+    parser.add_argument("-o", "--output",
+                        help="where to write the recovered slog (only with "
+                             "a single slog); defaults to adding "
+                             "'_recovered' to the name")
+    parser.add_argument("--in-place", action="store_true",
+                        help="replace each slog with its recovered version, "
+                             "keeping the original as <name>.slog.bak")
+    args = parser.parse_args(argv)
+    if args.output is not None and (len(args.slogs) > 1 or args.in_place):
+        parser.error("--output needs a single slog and no --in-place")
+
+    status = 0
+    for filename in args.slogs:
+        out_filename = args.output
+        if args.in_place:
+            out_filename = filename + ".tmp"
+        try:
+            report = recover_slog(filename, out_filename)
+        except (IOError, OSError) as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            status = 1
+            continue
+
+        if report["complete"]:
+            print("%s: complete, %d records" % (filename, report["records"]))
+            continue
+        print("%s: recovered %d records (%d from intact blocks, %d salvaged)"
+              % (filename, report["records"], report["copied_records"],
+                 report["salvaged_records"]))
+        if report["lost_records"]:
+            print("  lost %d records in damaged blocks" %
+                  report["lost_records"])
+        if report["lost_entries"] or report["skipped_bytes"]:
+            print("  lost %d cut off or damaged entries (%d bytes) and %d "
+                  "unreadable compressed bytes" %
+                  (report["lost_entries"], report["lost_bytes"],
+                   report["skipped_bytes"]))
+        if not (report["lost_records"] or report["lost_entries"] or
+                report["skipped_bytes"]):
+            print("  nothing lost before the end of the file")
+        if report["out_filename"] is None:
+            continue
+        if args.in_place:
+            os.rename(filename, filename + ".bak")
+            os.rename(report["out_filename"], filename)
+            print("  replaced %s, original kept as %s.bak" %
+                  (filename, filename))
+        else:
+            print("  written to %s" % report["out_filename"])
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
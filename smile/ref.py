@@ -9,6 +9,12 @@
 
 import random
 import operator
+import keyword
+import types
+import weakref
+from functools import partial
+from contextlib import contextmanager
+from time import perf_counter as _perf_counter
 
 class NotAvailable(object):
     """Special value for indicating a variable is not available yet.
@@ -42,7 +48,149 @@ def _apply(function, pargs, kwargs):
     return function(*pargs, **kwargs)
 
 
-class Ref(object):
+def _cond(cnd, tv, fv):
+    return tv if cnd else fv
+
+
+# shared by the Refs without keyword arguments or change callbacks, neither
+# of which is ever changed in place
+_NO_KWARGS = {}
+_NO_CALLBACKS = frozenset()
+
+
+# values that are interned by what they are rather than their identity
+_VALUE_TYPES = frozenset((int, str, bytes, bool, type(None)))
+
+
+def _intern_key(obj):
+    t = type(obj)
+    if t in _VALUE_TYPES:
+        return (t, obj)
+    elif t is float or t is complex:
+        # so 0.0 and -0.0 stay apart
+        return (t, repr(obj))
+    elif t is tuple:
+        return (tuple,) + tuple(_intern_key(value) for value in obj)
+    elif t is types.MethodType:
+        # bound methods are made anew on every attribute access
+        return (t, id(obj.__self__), id(obj.__func__))
+    # the Ref holds on to the object, so its id stays unique
+    return (id, id(obj))
+
+
+# values that never change in place
+_FIXED_TYPES = frozenset((int, float, complex, str, bytes, bool, type(None),
+                          type))
+
+
+def _is_fixed(obj):
+    """Whether *obj* is a value that can't change, or a Ref."""
+    t = type(obj)
+    if t in _FIXED_TYPES or isinstance(obj, Ref):
+        return True
+    elif t is types.BuiltinFunctionType:
+        # builtins are fine, but not builtin methods of some object
+        owner = getattr(obj, "__self__", None)
+        return owner is None or isinstance(owner, types.ModuleType)
+    elif t is tuple or t is frozenset:
+        return all(_is_fixed(value) for value in obj)
+    elif t is slice:
+        return (_is_fixed(obj.start) and _is_fixed(obj.stop) and
+                _is_fixed(obj.step))
+    return False
+
+
+def _is_fixed_call(func, pargs, kwargs):
+    """Whether calling *func* on *pargs* and *kwargs* gives the same result
+    for the same values of the Refs among them."""
+    if isinstance(func, Ref) or func is _apply or func is _cond:
+        pass
+    elif not _is_fixed(func):
+        # a python function may read globals or draw random numbers
+        return False
+    if func is _apply and len(pargs) == 3 and type(pargs[2]) is dict:
+        # Ref.__call__ made the kwargs dict, so nobody else can change it
+        pargs = pargs[:2] + (tuple(pargs[2].values()),)
+    return (all(_is_fixed(value) for value in pargs) and
+            all(_is_fixed(value) for value in kwargs.values()))
+
+
+def _stamp(ref):
+    """The highest version among *ref* and the Refs it depends on,
+    worked out once per version of the whole graph."""
+    version = propagation.version
+    if ref._stamp_version != version:
+        stamp = ref._version
+        for dep in ref._deps:
+            dep_stamp = _stamp(dep)
+            if dep_stamp > stamp:
+                stamp = dep_stamp
+        ref._stamp = stamp
+        ref._stamp_version = version
+    return ref._stamp
+
+
+class _Interning(object):
+    """Shares one Ref between structurally identical Ref expressions.
+
+    While *enabled*, building a Ref with the same function and the same
+    arguments as a Ref that still exists returns that Ref instead of a new
+    one. Arguments match if they are the same Ref or other object, or
+    equal numbers, strings, None or tuples of those. Every use of an
+    expression such as `exp.screen.center_x` then shares one cache and
+    one set of dependency callbacks.
+
+    A shared Ref is cached whenever anything watches it, so a value that
+    changes without telling its Ref, such as an item of a plain list, can
+    be read stale in places that used to evaluate it afresh. That is why
+    it is off unless the experiment asks for it.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._refs = weakref.WeakValueDictionary()
+        self._stats = {"created": 0,
+                       "reused": 0}
+
+    @property
+    def stats(self):
+        """Dict of counters.
+
+        *created* is the number of Refs built while interning, *reused*
+        the number of times an existing Ref was returned instead of a
+        duplicate, and *live* the number of interned Refs still around.
+        """
+        stats = self._stats.copy()
+        stats["live"] = len(self._refs)
+        return stats
+
+    def reset_stats(self):
+        for key in self._stats:
+            self._stats[key] = 0
+
+    def ref(self, cls, func, pargs, kwargs):
+        key = (cls, _intern_key(func), _intern_key(pargs),
+               tuple((name, _intern_key(value))
+                     for name, value in kwargs.items()))
+        ref = self._refs.get(key)
+        if ref is not None:
+            self._stats["reused"] += 1
+            return ref
+        ref = type.__call__(cls, func, *pargs, **kwargs)
+        self._refs[key] = ref
+        self._stats["created"] += 1
+        return ref
+
+
+class RefClass(type):
+    """A metaclass for Refs that interns them when **interning** is
+    enabled."""
+    def __call__(cls, func, *pargs, **kwargs):
+        if not interning.enabled:
+            return type.__call__(cls, func, *pargs, **kwargs)
+        return interning.ref(cls, func, pargs, kwargs)
+
+
+class Ref(object, metaclass=RefClass):
     """Delayed function call.
 
     The basis of the SMILE state machine. This is the object that makes the
@@ -87,29 +235,61 @@ class Ref(object):
 
 
     """
+    # Refs are built by the thousand, so keep them small. __getattr__ still
+    # turns any other attribute into a delayed getattr.
+    __slots__ = ("func", "pargs", "kwargs", "use_cache", "_parent_state",
+                 "cache_value", "cache_valid", "change_callbacks", "_deps",
+                 "_evaluator", "_source", "_versioned", "_version", "_stamp",
+                 "_stamp_version", "_cache_stamp", "__weakref__")
+
     def __init__(self, func, *pargs, **kwargs):
         # store the arguments
         self.func = func
         self.pargs = pargs
         self.use_cache = kwargs.pop("use_cache", True)
         self._parent_state = kwargs.pop("_parent_state", None)
-        self.kwargs = kwargs
+        # a source is a Ref whose dep_changed is called on every change
+        self._source = kwargs.pop("_source", False)
+        self.kwargs = kwargs if kwargs else _NO_KWARGS
 
         # initialize cached values
         self.cache_value = None
         self.cache_valid = False
 
-        # init callbacks for changes
+        # evaluator made by compile_ref
+        self._evaluator = None
+
+        # init callbacks for changes, with a set made for the first one
         # ***Must be a set to support proper boolean comparisons***
-        self.change_callbacks = set()
+        self.change_callbacks = _NO_CALLBACKS
 
-        # recursively find Refs this Ref depends on
-        for dep in iter_deps((pargs, kwargs)):
+        # find the Refs this Ref depends on once
+        deps = tuple(iter_deps((pargs, kwargs)))
+        for dep in deps:
             # see if dep doesn't use cache
             if not dep.use_cache:
                 # override our cache state
                 self.use_cache = False
                 break
+        if isinstance(func, Ref):
+            deps += (func,)
+        if len(deps) > 1:
+            # each only once
+            deps = tuple(dict((id(dep), dep) for dep in deps).values())
+        self._deps = deps
+
+        # A Ref that only depends on sources and values that can't change,
+        # through builtins and types, keeps its cached value until the
+        # version of one of its sources changes, whether or not anything
+        # watches it. A source whose value can change in place, such as a
+        # list, gets a new version each time it is read instead.
+        self._versioned = self.use_cache and (self._source or (
+            len(deps) > 0 and all(dep._versioned for dep in deps) and
+            _is_fixed_call(func, pargs, kwargs)))
+        self._version = 0
+        self._stamp = 0
+        self._stamp_version = -1
+        self._cache_stamp = None
 
     def __repr__(self):
         return "Ref(%s)" % ", ".join([repr(self.func)] +
@@ -190,8 +370,7 @@ class Ref(object):
 
         """
 
-        return Ref(lambda cnd, tv, fv: (tv if cnd else fv),
-                   cond, true_val, false_val)
+        return Ref(_cond, cond, true_val, false_val)
 
     @staticmethod
     def not_(obj):
@@ -202,11 +381,21 @@ class Ref(object):
 
         .. note::
           Internal use only!!!"""
+        # a compiled Ref does the same without walking its arguments
+        if self._evaluator is not None:
+            return self._evaluator()
+
         # only return a cached value if it's valid
         # and we do have change callbacks
         if self.cache_valid and len(self.change_callbacks):
             return self.cache_value
 
+        # or if none of its sources changed since it was cached
+        if self._versioned:
+            stamp = _stamp(self)
+            if stamp == self._cache_stamp:
+                return self.cache_value
+
         # evaluate all possible Refs
         value = val(val(self.func)(*val(self.pargs), **val(self.kwargs)))
 
@@ -214,6 +403,12 @@ class Ref(object):
         if self.use_cache:
             self.cache_value = value
             self.cache_valid = True
+            if self._versioned:
+                self._cache_stamp = stamp
+                if self._source and not _is_fixed(value):
+                    # it can change in place, with no new version, so
+                    # nothing is cached on it
+                    propagation.touch(self)
 
         return value
 
@@ -226,32 +421,36 @@ class Ref(object):
             # set up dependency callbacks
             self.setup_dep_callbacks()
             self.cache_valid = False
+            self.change_callbacks = set()
         # the tuple is needed because this is a set
         self.change_callbacks.add((func, pargs, tuple(kwargs.items())))
 
     def remove_change_callback(self, func, *pargs, **kwargs):
         #print "remove_change_callback %s, %r, %r, %r" % (self, func, pargs, kwargs)
-        self.change_callbacks.discard((func, pargs, tuple(kwargs.items())))
+        if len(self.change_callbacks):
+            self.change_callbacks.discard((func, pargs,
+                                           tuple(kwargs.items())))
         # clean up if there are no more callbacks
         if not len(self.change_callbacks):
+            self.change_callbacks = _NO_CALLBACKS
             self.teardown_dep_callbacks()
 
     def setup_dep_callbacks(self):
-        for dep in iter_deps((self.func, self.pargs, self.kwargs)):
-            dep.add_change_callback(self.dep_changed)
+        dep_changed = self.dep_changed
+        for dep in self._deps:
+            dep.add_change_callback(dep_changed)
 
     def teardown_dep_callbacks(self):
         # explicitly remove all change callbacks
-        for dep in iter_deps((self.func, self.pargs, self.kwargs)):
-            dep.remove_change_callback(self.dep_changed)
+        dep_changed = self.dep_changed
+        for dep in self._deps:
+            dep.remove_change_callback(dep_changed)
 
     def dep_changed(self):
+        """Tell the Refs and callbacks that depend on this one that its
+        value changed. See **propagation** for how they are told."""
         #print "dep_changed %r, %r" % (self, self.change_callbacks)
-        # cache is not valid
-        self.cache_valid = False
-        # iter through each change callback and call them
-        for func, pargs, kwargs in list(self.change_callbacks):
-            func(*pargs, **dict(kwargs))
+        propagation.changed(self)
 
     # delayed operators...
     def __call__(self, *pargs, **kwargs):
@@ -266,8 +465,8 @@ class Ref(object):
                                                          value,
                                                          index=index)
 
-    def __hash__(self):
-        return object.__hash__(self)
+    # __eq__ builds a Ref, so hash by identity
+    __hash__ = object.__hash__
 
     def __getitem__(self, index):
         return Ref(operator.getitem, self, index)
@@ -347,12 +546,10 @@ class Ref(object):
         return Ref(lambda a, b: a // b, other, self)
 
     def __truediv__(self, other):
-        # NOTE: using lambda to be sensitive to __future__.division
-        return Ref(lambda a, b: a / b, self, other)
+        return Ref(operator.truediv, self, other)
 
     def __rtruediv__(self, other):
-        # NOTE: using lambda to be sensitive to __future__.division
-        return Ref(lambda a, b: a / b, other, self)
+        return Ref(operator.truediv, other, self)
 
     def __floordiv__(self, other):
         return Ref(operator.floordiv, self, other)
@@ -397,6 +594,378 @@ class Ref(object):
         return Ref(abs, self)
 
 
+class _Propagation(object):
+    """Delivers the changes of Refs to everything that depends on them.
+
+    A Ref that depends on another one is told about changes by the
+    other's change callbacks, and so are the callbacks of states watching
+    it. When a Ref changes, every Ref downstream of it is invalidated
+    first. Only then are the callbacks that aren't Refs called, each one
+    once, in the topological order of the Refs they watch. A callback at
+    the bottom of a diamond of Refs is called once, rather than once per
+    path to it, and whatever it evaluates is up to date.
+
+    With *coalesce* set, the changes made inside a **batch** are
+    delivered together when it ends, so each callback is called once for
+    all of them. Refs are still invalidated as soon as they change.
+    """
+    def __init__(self):
+        self.coalesce = False
+        # bumped on every change, and stamped on the Ref that changed
+        self.version = 0
+        self._batch_depth = 0
+        # id -> [source, times changed], in the order they first changed
+        self._pending = {}
+        self._stats = {"updates": 0,
+                       "notifications": 0,
+                       "saved_notifications": 0,
+                       "batches": 0}
+
+    @property
+    def stats(self):
+        """Dict of counters.
+
+        *updates* is the number of changes, *notifications* the number of
+        callbacks called for them, and *saved_notifications* how many
+        more calls delivering each change down every path separately
+        would have made. *batches* counts the coalesced batches.
+        """
+        return self._stats.copy()
+
+    def reset_stats(self):
+        for key in self._stats:
+            self._stats[key] = 0
+
+    def stamp(self, obj):
+        """The highest version among the Refs in *obj* and the Refs they
+        depend on, which only moves on when one of the sources they read
+        changes."""
+        stamp = 0
+        for dep in iter_deps(obj):
+            dep_stamp = _stamp(dep)
+            if dep_stamp > stamp:
+                stamp = dep_stamp
+        return stamp
+
+    def touch(self, ref):
+        """Mark *ref* as changed without calling anything, for a change
+        that the Refs watching it don't need to hear about."""
+        self.version += 1
+        ref._version = self.version
+
+    def changed(self, source):
+        self._stats["updates"] += 1
+        self.version += 1
+        source._version = self.version
+        if not source.change_callbacks:
+            # nothing depends on it
+            source.cache_valid = False
+            return
+        if self._batch_depth and self.coalesce:
+            for node in self._sort([source])[0]:
+                node.cache_valid = False
+            entry = self._pending.get(id(source))
+            if entry is None:
+                self._pending[id(source)] = [source, 1]
+            else:
+                entry[1] += 1
+            return
+        self._deliver([(source, 1)])
+
+    @contextmanager
+    def batch(self):
+        """Context manager that holds back the changes made inside it
+        until it ends, if *coalesce* is set."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._pending:
+                pending = list(self._pending.values())
+                self._pending.clear()
+                self._stats["batches"] += 1
+                self._deliver(pending)
+
+    def _sort(self, sources):
+        """Return the Refs downstream of *sources* in topological order,
+        and a dict of the dependent Refs and other callbacks of each."""
+        edges = {}
+        postorder = []
+
+        def visit(node):
+            children = []
+            subscribers = []
+            for callback in list(node.change_callbacks):
+                func = callback[0]
+                if getattr(func, "__func__", None) is _dep_changed:
+                    children.append(func.__self__)
+                else:
+                    subscribers.append(callback)
+            edges[id(node)] = (children, subscribers)
+            return iter(children)
+
+        # depth first, without recursion as the chains can be long
+        for source in sources:
+            if id(source) in edges:
+                continue
+            stack = [(source, visit(source))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if id(child) not in edges:
+                        stack.append((child, visit(child)))
+                        break
+                else:
+                    stack.pop()
+                    postorder.append(node)
+        postorder.reverse()
+        return postorder, edges
+
+    def _deliver(self, sources):
+        order, edges = self._sort([source for source, count in sources])
+
+        # invalidate everything first, counting the paths to each Ref
+        paths = dict((id(source), count) for source, count in sources)
+        for node in order:
+            node.cache_valid = False
+            n_paths = paths.get(id(node), 0)
+            for child in edges[id(node)][0]:
+                paths[id(child)] = paths.get(id(child), 0) + n_paths
+
+        calls = 0
+        seen = set()
+        subscribers = []
+        for node in order:
+            for callback in edges[id(node)][1]:
+                calls += paths[id(node)]
+                if callback not in seen:
+                    seen.add(callback)
+                    subscribers.append((node, callback))
+        self._stats["notifications"] += len(subscribers)
+        self._stats["saved_notifications"] += calls - len(subscribers)
+
+        for node, callback in subscribers:
+            # an earlier callback may have stopped watching
+            if callback in node.change_callbacks:
+                func, pargs, kwargs = callback
+                func(*pargs, **dict(kwargs))
+
+
+# how some functions read in a profile report
+_OPERATOR_SYMBOLS = {
+    operator.add: "+", operator.sub: "-", operator.mul: "*",
+    operator.truediv: "/", operator.floordiv: "//", operator.mod: "%",
+    operator.pow: "**", operator.lt: "<", operator.le: "<=",
+    operator.eq: "==", operator.ne: "!=", operator.gt: ">",
+    operator.ge: ">=", operator.and_: "&", operator.or_: "|",
+    operator.xor: "^"}
+
+
+def _describe(obj, depth=0):
+    """A short, address-free description of an expression, so that the
+    same expression reads the same from one session to the next."""
+    if depth > 6:
+        return "..."
+    if isinstance(obj, Ref):
+        args = [_describe(arg, depth + 1) for arg in obj.pargs]
+        func = obj.func
+        if func is getattr and len(args) == 2 and isinstance(obj.pargs[1],
+                                                              str):
+            return "%s.%s" % (args[0], obj.pargs[1])
+        if func is operator.getitem and len(args) == 2:
+            return "%s[%s]" % (args[0], args[1])
+        if func is pass_thru and len(args) == 1:
+            return args[0]
+        symbol = _OPERATOR_SYMBOLS.get(func)
+        if symbol is not None and len(args) == 2:
+            return "(%s %s %s)" % (args[0], symbol, args[1])
+        args.extend("%s=%s" % (name, _describe(value, depth + 1))
+                    for name, value in obj.kwargs.items())
+        return "%s(%s)" % (_describe(func, depth + 1), ", ".join(args))
+    if isinstance(obj, (tuple, list)):
+        text = ", ".join(_describe(value, depth + 1) for value in obj)
+        return "(%s)" % text if isinstance(obj, tuple) else "[%s]" % text
+    if isinstance(obj, dict):
+        return "{%s}" % ", ".join("%s: %s" % (_describe(key, depth + 1),
+                                              _describe(value, depth + 1))
+                                  for key, value in obj.items())
+    if obj is None or type(obj) in (int, float, complex, str, bytes, bool):
+        return repr(obj)
+    name = getattr(obj, "__qualname__", None) or getattr(obj, "__name__", None)
+    if isinstance(name, str) and callable(obj):
+        return name
+    return "<%s>" % type(obj).__name__
+
+
+class _Profiler(object):
+    """Counts and times the evaluations of Refs.
+
+    While *enabled*, every evaluation of a Ref is counted against the
+    state that owns it and the expression it stands for, with how long it
+    took, whether its cache answered it, and how many callbacks were
+    watching it. Compiled evaluators are not used in the meantime, so
+    that each Ref of an expression is seen on its own.
+
+    States pass themselves to **compile_ref** as the owner of the Refs
+    they evaluate. Anything else evaluated is counted against what
+    *current_state*, a function of no arguments, returns.
+    """
+    # name of each column of the report, and how to print it
+    _columns = (("evals", "%d"), ("hits", "%d"), ("hit_rate", "%.3f"),
+                ("time", "%.6f"), ("self_time", "%.6f"),
+                ("mean_time", "%.9f"), ("fan_out", "%d"))
+
+    def __init__(self):
+        self.enabled = False
+        self.current_state = None
+        self._state = None
+        # (filename, lineno, state name, expression) -> [evals, hits,
+        # time, self time, most callbacks]
+        self._entries = {}
+        # id -> (weakref, description) of the Refs seen
+        self._descriptions = {}
+        # time spent evaluating the Refs under each Ref being evaluated
+        self._child_time = []
+
+    def enable(self):
+        self.enabled = True
+        Ref.eval = _profiled_eval
+
+    def disable(self):
+        self.enabled = False
+        Ref.eval = _plain_eval
+
+    def reset(self):
+        self._entries.clear()
+        self._descriptions.clear()
+
+    def evaluate(self, owner, obj):
+        """Evaluate *obj* like **val**, counting its Refs against the
+        state *owner*."""
+        state = self._state
+        self._state = owner
+        try:
+            return val(obj)
+        finally:
+            self._state = state
+
+    def _entry(self, ref):
+        entry = self._descriptions.get(id(ref))
+        if entry is None or entry[0]() is not ref:
+            entry = (weakref.ref(ref), _describe(ref))
+            self._descriptions[id(ref)] = entry
+        state = self._state
+        if state is None and self.current_state is not None:
+            state = self.current_state()
+        if state is None:
+            key = ("", 0, "", entry[1])
+        else:
+            key = (state._instantiation_filename,
+                   state._instantiation_lineno,
+                   state._name or type(state).__name__, entry[1])
+        counts = self._entries.get(key)
+        if counts is None:
+            counts = self._entries[key] = [0, 0, 0.0, 0.0, 0]
+        return counts
+
+    def eval(self, ref):
+        counts = self._entry(ref)
+        counts[0] += 1
+        fan_out = len(ref.change_callbacks)
+        if fan_out > counts[4]:
+            counts[4] = fan_out
+
+        # the same caches Ref.eval answers from
+        if ref.cache_valid and fan_out:
+            counts[1] += 1
+            return ref.cache_value
+        if ref._versioned:
+            stamp = _stamp(ref)
+            if stamp == ref._cache_stamp:
+                counts[1] += 1
+                return ref.cache_value
+
+        child_time = self._child_time
+        child_time.append(0.0)
+        start = _perf_counter()
+        try:
+            value = val(val(ref.func)(*val(ref.pargs), **val(ref.kwargs)))
+        finally:
+            elapsed = _perf_counter() - start
+            counts[2] += elapsed
+            counts[3] += elapsed - child_time.pop()
+            if child_time:
+                child_time[-1] += elapsed
+
+        if ref.use_cache:
+            ref.cache_value = value
+            ref.cache_valid = True
+            if ref._versioned:
+                ref._cache_stamp = stamp
+                if ref._source and not _is_fixed(value):
+                    propagation.touch(ref)
+        return value
+
+    def report(self):
+        """Return a list of dicts, one per state and expression, with the
+        most time spent first.
+
+        *time* includes the Refs an expression is made of, *self_time*
+        leaves them out. *hits* counts the evaluations answered from the
+        cache, and *fan_out* is the most callbacks seen watching the
+        expression.
+        """
+        rows = []
+        for (filename, lineno, name, expr), counts in self._entries.items():
+            evals, hits, elapsed, self_time, fan_out = counts
+            computed = evals - hits
+            rows.append({"filename": filename,
+                         "lineno": lineno,
+                         "state": name,
+                         "expression": expr,
+                         "evals": evals,
+                         "hits": hits,
+                         "hit_rate": hits / float(evals),
+                         "time": elapsed,
+                         "self_time": self_time,
+                         "mean_time": elapsed / computed if computed else 0.0,
+                         "fan_out": fan_out})
+        rows.sort(key=lambda row: (-row["time"], -row["evals"]))
+        return rows
+
+    def write_report(self, filename):
+        """Write the **report** to *filename* as tab separated text."""
+        names = [name for name, fmt in self._columns]
+        with open(filename, "w") as f:
+            f.write("\t".join(names + ["state", "where", "expression"]) +
+                    "\n")
+            for row in self.report():
+                where = ("%s:%d" % (row["filename"], row["lineno"])
+                         if row["filename"] else "")
+                f.write("\t".join([fmt % row[name]
+                                   for name, fmt in self._columns] +
+                                  [row["state"], where, row["expression"]]) +
+                        "\n")
+
+
+_dep_changed = Ref.dep_changed
+_plain_eval = Ref.eval
+
+
+def _profiled_eval(self):
+    return profiler.eval(self)
+
+# delivers the changes of every Ref
+propagation = _Propagation()
+
+# shares Refs between identical expressions, if enabled
+interning = _Interning()
+
+# counts and times Ref evaluations, if enabled
+profiler = _Profiler()
+
+
 def jitter(lower, jitter_mag):
     return Ref(random.uniform, lower, lower + jitter_mag, use_cache=False)
 
@@ -433,6 +1002,166 @@ def val(obj):
                                 repr(obj))
 
 
+# types val returns as they are, so results of these types skip the walk
+_LEAF_TYPES = frozenset((int, float, complex, str, bytes, bool, type(None)))
+
+
+class _RefCompiler(object):
+    """Turns the tree of Refs, tuples and slices under an object into the
+    source of a function that evaluates it like **val**.
+
+    Each Ref becomes a block that checks the Ref's cache and otherwise
+    calls its function on the values of its arguments, computed by the
+    blocks before it. Values without Refs are computed once, here. Lists
+    and dicts can change after they are passed in, so they are still
+    walked by **val** on every call.
+    """
+    # Refs nested deeper than this get an evaluator of their own, to stay
+    # under the parser's limit on indentation
+    max_depth = 40
+
+    def __init__(self, obj):
+        self.env = {"_val": val, "_stamp": _stamp, "_type": type,
+                    "_fixed": _is_fixed, "_touch": propagation.touch,
+                    "_LEAF": _LEAF_TYPES,
+                    "_slice": slice, "_NAE": NotAvailableError,
+                    "_repr": repr, "_obj": obj}
+        self.lines = ["def _evaluate():",
+                      "    try:"]
+        self.n = 0
+        value, const = self.expr(obj, 2, 0)
+        self.lines.extend([
+            "        return %s" % value,
+            "    except _NAE:",
+            "        raise _NAE(\"val(%r) produced NotAvailable result\" %",
+            "                   _repr(_obj))"])
+
+    def name(self, prefix):
+        self.n += 1
+        return "%s%d" % (prefix, self.n)
+
+    def bind(self, prefix, value):
+        name = self.name(prefix)
+        self.env[name] = value
+        return name
+
+    def const(self, value):
+        return self.bind("_c", value), True
+
+    def expr(self, obj, indent, depth):
+        """Emit the lines that compute val(obj) and return an expression
+        for the value and whether it is a constant."""
+        if type(obj) is Ref:
+            if depth >= self.max_depth:
+                return "%s()" % self.bind("_e", compile_ref(obj)), False
+            return self.ref(obj, indent, depth), False
+        elif isinstance(obj, Ref):
+            # subclasses may evaluate differently
+            return "%s.eval()" % self.bind("_r", obj), False
+        elif isinstance(obj, (list, dict)):
+            return "_val(%s)" % self.bind("_c", obj), False
+        elif isinstance(obj, tuple):
+            items = [self.expr(value, indent, depth) for value in obj]
+            if all(const for value, const in items):
+                return self.const(val(obj))
+            return "(%s)" % "".join("%s, " % value
+                                    for value, const in items), False
+        elif isinstance(obj, slice):
+            items = [self.expr(value, indent, depth)
+                     for value in (obj.start, obj.stop, obj.step)]
+            if all(const for value, const in items):
+                return self.const(val(obj))
+            return "_slice(%s)" % ", ".join(value
+                                            for value, const in items), False
+        elif obj is NotAvailable:
+            self.lines.append("    " * indent + "raise _NAE(\"'val' produced "
+                              "NotAvailable result.\")")
+            return "None", False
+        return self.const(obj)
+
+    def ref(self, ref, indent, depth):
+        r = self.bind("_r", ref)
+        v = self.name("v")
+        pad = "    " * indent
+        self.lines.extend([
+            pad + "if %s.cache_valid and %s.change_callbacks:" % (r, r),
+            pad + "    %s = %s.cache_value" % (v, r)])
+        if ref._versioned:
+            self.lines.extend([
+                pad + "elif _stamp(%s) == %s._cache_stamp:" % (r, r),
+                pad + "    %s = %s.cache_value" % (v, r)])
+        self.lines.append(pad + "else:")
+        # same order as Ref.eval: func, pargs, then kwargs
+        func = self.expr(ref.func, indent + 1, depth + 1)[0]
+        args = [self.expr(value, indent + 1, depth + 1)[0]
+                for value in ref.pargs]
+        kwargs = []
+        for key, value in ref.kwargs.items():
+            value = self.expr(value, indent + 1, depth + 1)[0]
+            if key.isidentifier() and not keyword.iskeyword(key):
+                args.append("%s=%s" % (key, value))
+            else:
+                kwargs.append("%r: %s" % (key, value))
+        if kwargs:
+            args.append("**{%s}" % ", ".join(kwargs))
+        pad += "    "
+        self.lines.extend([
+            pad + "%s = %s(%s)" % (v, func, ", ".join(args)),
+            pad + "if _type(%s) not in _LEAF:" % v,
+            pad + "    %s = _val(%s)" % (v, v),
+            pad + "if %s.use_cache:" % r,
+            pad + "    %s.cache_value = %s" % (r, v),
+            pad + "    %s.cache_valid = True" % r])
+        if ref._versioned:
+            # _stamp was worked out before the evaluation
+            self.lines.append(pad + "    %s._cache_stamp = %s._stamp" % (r, r))
+            if ref._source:
+                self.lines.extend([
+                    pad + "    if not _fixed(%s):" % v,
+                    pad + "        _touch(%s)" % r])
+        return v
+
+
+def _has_refs(obj):
+    if isinstance(obj, (tuple, slice)):
+        return any(_has_refs(value) for value in
+                   (obj if isinstance(obj, tuple) else
+                    (obj.start, obj.stop, obj.step)))
+    return isinstance(obj, Ref)
+
+
+def compile_ref(obj, owner=None):
+    """Return a function of no arguments that evaluates *obj* like
+    **val** does, with the same caching and NotAvailable errors.
+
+    The Refs under *obj* are laid out in the order they are evaluated in
+    a single generated function, so an evaluation no longer has to find
+    its way through the tree with **val**. A Ref keeps its evaluator, and
+    **Ref.eval** uses it from then on.
+
+    While the **profiler** is enabled, *obj* is left uncompiled and its
+    evaluations are counted against the state *owner*.
+
+    .. note::
+      Internal use only!!!
+    """
+    if profiler.enabled:
+        return partial(profiler.evaluate, owner, obj)
+    if type(obj) is Ref and obj._evaluator is not None:
+        return obj._evaluator
+    if not _has_refs(obj):
+        if isinstance(obj, (list, dict, tuple, slice)) or obj is NotAvailable:
+            return partial(val, obj)
+        return partial(pass_thru, obj)
+
+    compiler = _RefCompiler(obj)
+    exec("\n".join(compiler.lines), compiler.env)
+    evaluator = compiler.env["_evaluate"]
+    if type(obj) is Ref:
+        obj._evaluator = evaluator
+    return evaluator
+
+
 def iter_deps(obj):
     """Generator to find all Ref dependencies of an object."""
     if isinstance(obj, Ref):
@@ -16,16 +16,16 @@ import inspect
 import weakref
 import sys
 
-from os import fsync, remove
+from os import remove
 import os.path
 from . import kivy_overrides
-from .ref import Ref, val, NotAvailable, NotAvailableError
+from .ref import Ref, val, NotAvailable, NotAvailableError, compile_ref, \
+    iter_deps, propagation, profiler
 # Due to namespace issues, ref.jitter is imported as ref_jitter
 from .ref import jitter as ref_jitter
 # Due to namespace issues, ref.shuffle is imported as ref_shuffle
 from .ref import shuffle as ref_shuffle
-from .log import LogWriter, log2csv
-from .clock import clock
+from .clock import clock, BACKGROUND
 
 
 class StateConstructionError(RuntimeError):
@@ -35,6 +35,148 @@ class StateConstructionError(RuntimeError):
     pass
 
 
+class _ClonePool(object):
+    """Lets state builders reuse their finalized clones.
+
+    While *enabled*, a clone that has finalized is put back in its
+    builder's pool once nothing can read it any more, which is when its
+    parent has heard it finalized and a newer clone of the same builder
+    has entered in its place. The next
+    clone the builder makes is that clone, reset in place to the
+    builder's attributes, rather than a new state. A Loop then runs each
+    trial with the clones of two trials back instead of making new ones.
+
+    Before a clone goes into the pool, its **_recycle** method lets go of
+    what it refers to. States that hold on to anything beyond their
+    attributes, such as a widget, extend it. A state that keeps using a
+    clone of another state after that clone finalized, and after a newer
+    clone of it entered, sees the newer run's values once the clone is
+    reused, which is why it is off unless the experiment asks for it.
+    """
+    def __init__(self):
+        self.enabled = False
+        # the most clones each builder keeps
+        self.size = 2
+        self._stats = {"created": 0,
+                       "reused": 0,
+                       "recycled": 0}
+
+    @property
+    def stats(self):
+        """Dict of counters.
+
+        *created* is the number of new clones made while enabled, *reused*
+        the number of clones taken from a pool instead, and *recycled* the
+        number put into one.
+        """
+        return self._stats.copy()
+
+    def reset_stats(self):
+        for key in self._stats:
+            self._stats[key] = 0
+
+    def recycle(self, clone, original):
+        """Put *clone*, a clone of the builder *original*, in the builder's
+        pool if nothing can read it any more."""
+        pool = original._clone_pool
+        if (not clone._recyclable or len(pool) >= self.size or
+            original._State__most_recently_entered_clone is clone):
+            return
+        ancestor = clone._parent
+        while ancestor is not None:
+            if (ancestor._active and
+                ancestor._ref_context.get(original) is clone):
+                return
+            ancestor = ancestor._parent
+
+        # the clones of its descendants it was still holding on to may be
+        # free now too
+        for descendant_original, descendant in list(
+                clone._ref_context.items()):
+            if descendant is not clone:
+                self.recycle(descendant, descendant_original)
+
+        clone._recycle()
+        clone._recyclable = False
+        pool.append(clone)
+        self._stats["recycled"] += 1
+
+
+    def release(self, clone, original):
+        """Let go of *clone*, a clone of the builder *original* that was
+        made ahead but will never enter, putting it in the builder's pool
+        if there is room."""
+        clone._recycle()
+        pool = original._clone_pool
+        if self.enabled and len(pool) < self.size:
+            pool.append(clone)
+            self._stats["recycled"] += 1
+
+
+# reuses finalized clones of states, if enabled
+clone_pool = _ClonePool()
+
+
+class LeadTimes(object):
+    """Records how long before their start times states were ready to
+    start, per state.
+
+    The lead time of a clone is its start time less the time it finished
+    entering. Visual states need it to be positive to appear on the
+    intended flip.
+    """
+    def __init__(self):
+        # original state -> [name, filename, lineno, enters, prepared,
+        #                    late, min lead, total lead]
+        self._states = {}
+
+    def record(self, state, lead):
+        original = state.original_builder
+        totals = self._states.get(original)
+        if totals is None:
+            if state._name is None:
+                name = type(state).__name__
+            else:
+                name = "%s (%s)" % (type(state).__name__, state._name)
+            totals = self._states[original] = [
+                name, state._instantiation_filename,
+                state._instantiation_lineno, 0, 0, 0, lead, 0.0]
+        totals[3] += 1
+        if state._prepare_time is not None:
+            totals[4] += 1
+        if lead < 0.0:
+            totals[5] += 1
+        if lead < totals[6]:
+            totals[6] = lead
+        totals[7] += lead
+
+    def merge(self, other):
+        """Add the lead times recorded by the **LeadTimes** *other*."""
+        for original, totals in other._states.items():
+            merged = self._states.get(original)
+            if merged is None:
+                self._states[original] = list(totals)
+                continue
+            for n in (3, 4, 5, 7):
+                merged[n] += totals[n]
+            merged[6] = min(merged[6], totals[6])
+
+    def summary(self):
+        """Return a list of dicts, one per state, with the number of times
+        it entered, how many of those it was prepared ahead, how many it
+        entered after its start time, and its min and mean lead time."""
+        return [{"state": name,
+                 "filename": filename,
+                 "lineno": lineno,
+                 "enters": enters,
+                 "prepared": prepared,
+                 "late": late,
+                 "min_lead": min_lead,
+                 "mean_lead": total / enters}
+                for (name, filename, lineno, enters, prepared, late, min_lead,
+                     total) in self._states.values()]
+
+
 class StateBuilder(object):
     """A Mixin class that gives States Ref-based attribute access for state
     machine construction.
@@ -45,10 +187,28 @@ class StateBuilder(object):
         state class with the specified parent.
 
         """
-        # Make a shallow copy of self.
-        state_class = type(self)._state_class
-        new_clone = state_class.__new__(state_class, use_state_class=True)
-        new_clone.__dict__.update(self.__dict__)
+        # Make a shallow copy of self, reusing a finalized clone if there
+        # is one.
+        pool = self._clone_pool
+        if pool:
+            new_clone = pool.pop()
+            clone_dict = new_clone.__dict__
+            ref_context = clone_dict["_ref_context"]
+            clone_dict.update(self.__dict__)
+            if len(clone_dict) != len(self.__dict__):
+                # drop what the last run added
+                for name in [name for name in clone_dict
+                             if name not in self.__dict__]:
+                    del clone_dict[name]
+            ref_context.clear()
+            clone_pool._stats["reused"] += 1
+        else:
+            state_class = type(self)._state_class
+            new_clone = state_class.__new__(state_class, use_state_class=True)
+            new_clone.__dict__.update(self.__dict__)
+            ref_context = {}
+            if clone_pool.enabled:
+                clone_pool._stats["created"] += 1
 
         # Delete the __most_recently_entered_clone attribute from the new clone
         # to avoid a chain of clones resulting in a memory leak.
@@ -65,7 +225,8 @@ class StateBuilder(object):
         new_clone._parent = parent
 
         # Prepare the Ref context for the clone.
-        new_clone._ref_context = {self: new_clone}
+        ref_context[self] = new_clone
+        new_clone._ref_context = ref_context
 
         return new_clone
 
@@ -201,6 +362,10 @@ class State(object, metaclass=StateClass):
         # Dict of initial Ref values to evaluate at enter time
         self._refs_for_init_attrs = {}
 
+        # Compiled evaluators for those values, made at the first enter and
+        # shared with the clones
+        self._compiled_init_attrs = {}
+
         # This is a convenience argument for automatically setting the end time
         # relative to the start time.  If it evaluates to None, it has no
         # effect.
@@ -256,7 +421,8 @@ class State(object, metaclass=StateClass):
         self._instantiation_filename = "Turn on Debug Mode for this information"
         self._instantiation_lineno = 0
 
-        if self._debug:
+        # the profiler reports where each state was made
+        if self._debug or profiler.enabled:
             self.set_instantiation_context()
 
         # Determine the parent for this state...
@@ -321,6 +487,16 @@ class State(object, metaclass=StateClass):
         # Initialize with empty Ref context.
         self._ref_context = {}
 
+        # Finalized clones waiting to be reused, if clone_pool is enabled,
+        # and whether this clone is done with, as far as its parent goes.
+        self._clone_pool = []
+        self._recyclable = False
+
+        # when this clone was prepared ahead of entering, if it was, and the
+        # stamps of the initial values it evaluated then
+        self._prepare_time = None
+        self._prepared_stamps = None
+
     def __repr__(self):
         """String representation.
         """
@@ -366,17 +542,22 @@ class State(object, metaclass=StateClass):
         # Find the highest frame on the call stack whose function is not an
         # "__init__" for a parent class
 
+        # Walk the frames themselves, as inspect.stack() reads the source
+        # of every frame and would make building a long experiment slow.
         mro = inspect.getmro(type(obj))
-        for (frame, filename, lineno,
-             fname, fcode, index) in inspect.stack()[1:]:
-            if fname == "__init__" and type(frame.f_locals["self"]) in mro:
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if (code.co_name == "__init__" and
+                type(frame.f_locals.get("self")) in mro):
+                frame = frame.f_back
                 continue
 
             # Record the filename and line number found.  This will be the
             # place where this state was instantiated by the user because it
             # excludes calls to constructors State subclasses.
-            self._instantiation_filename = filename
-            self._instantiation_lineno = lineno
+            self._instantiation_filename = code.co_filename
+            self._instantiation_lineno = frame.f_lineno
             break
         else:
             raise StateConstructionError(
@@ -389,16 +570,11 @@ class State(object, metaclass=StateClass):
         """
         # Get the desired frame from the call stack.
         if self._debug:
-            (frame,
-             filename,
-             lineno,
-             function,
-             code_context,
-             index) = inspect.stack()[depth + 2]
+            frame = sys._getframe(depth + 2)
 
             # Record the source filename and line number from the stack frame.
-            self._instantiation_filename = filename
-            self._instantiation_lineno = lineno
+            self._instantiation_filename = frame.f_code.co_filename
+            self._instantiation_lineno = frame.f_lineno
 
     def begin_log(self):
         """Prepare the per-class state logs.
@@ -553,6 +729,20 @@ class State(object, metaclass=StateClass):
     def original_builder(self):
         return self.__original_state
 
+    def _recycle(self):
+        # Let go of what this finalized clone refers to before it waits in
+        # its builder's clone pool. Subclasses holding on to more than
+        # their attributes, such as a widget, extend this.
+        self._parent = None
+        self._ref_context.clear()
+
+    def _touch_issued_refs(self):
+        # Bump the versions of the Refs issued for this state, so cached
+        # values read from a previous clone aren't used for this one. The
+        # attributes that change notify the Refs as they are set.
+        for ref in list(self.__issued_refs.values()):
+            propagation.touch(ref)
+
     def get_current_attribute_value(self, name):
         """Get the value of an attribute from the current clone of this state.
 
@@ -570,7 +760,7 @@ class State(object, metaclass=StateClass):
         except KeyError:
             # Otherwise, create the Ref, store it, and return it.
             ref = Ref(self.get_current_attribute_value, "_" + name,
-                      _parent_state=self)
+                      _parent_state=self, _source=True)
             self.__issued_refs[name] = ref
             return ref
 
@@ -599,6 +789,71 @@ class State(object, metaclass=StateClass):
         """
         pass
 
+    def _eval_init_attrs(self, stamps=None):
+        # With *stamps*, a value whose stamp is the one in there was
+        # already evaluated, and no source it reads changed since, so it is
+        # left as it is. The stamps of the others are put in there.
+        evaluators = self._compiled_init_attrs
+        for name, value in self._refs_for_init_attrs.items():
+            if stamps is not None:
+                stamp = propagation.stamp(value)
+                if stamps.get(name) == stamp:
+                    continue
+            compiled = evaluators.get(name)
+            if compiled is None or compiled[0] is not value:
+                compiled = evaluators[name] = (value,
+                                              compile_ref(value, self))
+            try:
+                setattr(self, name, compiled[1]())
+            except NotAvailableError:
+                raise NotAvailableError(
+                    ("Attempting to use unavailable value (%r) "
+                     "for attribute %r of %r.  Do you need to use a Done "
+                     "state?") % (value, name, self))
+            if stamps is not None:
+                stamps[name] = stamp
+
+    def _prepare(self):
+        """Custom method to call at prepare time.  Optionally overridden in
+        subclasses to do ahead of time the work *_enter* would otherwise
+        do, such as building a widget.
+        """
+        pass
+
+    def prepare(self):
+        """Get ready to enter, ahead of time.
+
+        Called on a clone that hasn't entered yet, some time before its
+        start time, when the experiment has a *lead_time*. Its attributes
+        are evaluated as they would be on entering, and the work in
+        *_prepare* done with them. *enter* keeps the values evaluated
+        here, unless a state attribute or variable they read has changed
+        since, so each Ref is evaluated once. States with values that are
+        evaluated anew each time, such as *jitter*, *shuffle* or
+        **Ref.object**, aren't prepared. If a value isn't available yet,
+        enter evaluates it and does the rest.
+        """
+        self.claim_exceptions()
+
+        if self._exp is None:
+            from .experiment import Experiment
+            self._exp = Experiment._last_instance()
+
+        for value in self._refs_for_init_attrs.values():
+            for dep in iter_deps(value):
+                if not dep.use_cache:
+                    # evaluating it here would draw it twice
+                    return
+
+        stamps = self._prepared_stamps = {}
+        try:
+            self._eval_init_attrs(stamps)
+        except NotAvailableError:
+            # it depends on something still to happen
+            return
+        self._prepare()
+        self._prepare_time = clock.now()
+
     def enter(self, start_time):
         """This function is called by our back end.  It does everything
         that needs to be done before the state even starts.  The back end will
@@ -632,8 +887,9 @@ class State(object, metaclass=StateClass):
         self._finalize_time = NotAvailable
 
         # set self as the most recently entered clone of the original
-        self.__original_state.__dict__[
-            "_State__most_recently_entered_clone"] = self
+        original_dict = self.__original_state.__dict__
+        previous_clone = original_dict["_State__most_recently_entered_clone"]
+        original_dict["_State__most_recently_entered_clone"] = self
 
         # say we're active
         self._active = True
@@ -648,15 +904,8 @@ class State(object, metaclass=StateClass):
             from .experiment import Experiment
             self._exp = Experiment._last_instance()
 
-        # evaluate the '_init_' Refs...
-        for name, value in self._refs_for_init_attrs.items():
-            try:
-                setattr(self, name, val(value))
-            except NotAvailableError:
-                raise NotAvailableError(
-                    ("Attempting to use unavailable value (%r) "
-                     "for attribute %r of %r.  Do you need to use a Done "
-                     "state?") % (value, name, self))
+        # evaluate the '_init_' Refs, unless prepare already did...
+        self._eval_init_attrs(self._prepared_stamps)
 
         # propagate self to ancestors' ref contexts...
         ancestor = self._parent
@@ -664,6 +913,14 @@ class State(object, metaclass=StateClass):
             ancestor._ref_context[self.__original_state] = self
             ancestor = ancestor._parent
 
+        # the issued Refs now read this clone
+        self._touch_issued_refs()
+
+        # the clone this one replaced may be reusable now
+        if (clone_pool.enabled and previous_clone is not self and
+            previous_clone is not self.__original_state):
+            clone_pool.recycle(previous_clone, self.__original_state)
+
         # apply the duration, if supplied...
         if self._duration is None:
             self._end_time = None
@@ -680,6 +937,11 @@ class State(object, metaclass=StateClass):
         if self._end_time is not None:
             self._schedule_end()
 
+        lead_times = self._exp._lead_times
+        if lead_times is not None:
+            # how long before its start the state was ready
+            lead_times.record(self, self._start_time - clock.now())
+
         if self.__tracing:
             # print trace line, if tracing...
             call_time = self._enter_time - self._exp._root_executor._start_time
@@ -811,6 +1073,8 @@ class State(object, metaclass=StateClass):
         for func, pargs, kwargs in self.__finalize_callbacks:
             clock.schedule(partial(func, *pargs, **kwargs))
         self.__finalize_callbacks = []
+        if not self._parent:
+            self._recyclable = True
         if self.__tracing:
             call_time = (self._finalize_time -
                          self._exp._root_executor._start_time)
@@ -890,6 +1154,12 @@ class ParentState(State):
         # cancel time (None if not cancelled)
         self._cancel_time = None
 
+    def _touch_issued_refs(self):
+        super(ParentState, self)._touch_issued_refs()
+        # a new clone starts with its own variables
+        for ref in list(self.__issued_refs.values()):
+            propagation.touch(ref)
+
     def get_attribute_ref(self, name):
         """Return a Ref for a user variable of this ParentState.
         """
@@ -901,7 +1171,8 @@ class ParentState(State):
             try:
                 return self.__issued_refs[name]
             except KeyError:
-                ref = Ref(self.get_var, name, _parent_state=self)
+                ref = Ref(self.get_var, name, _parent_state=self,
+                          _source=True)
                 self.__issued_refs[name] = ref
                 return ref
 
@@ -990,6 +1261,9 @@ class ParentState(State):
         """Notify this state that one of its children has finalized.
         """
         self.__unfinalized_children.discard(child)
+        child._recyclable = True
+        if clone_pool.enabled:
+            clone_pool.recycle(child, child.original_builder)
         if self._following_may_run and not len(self.__unfinalized_children):
             # we have no more unfinalized children,
             # so this parent can finalize
@@ -1407,10 +1681,16 @@ class SequentialState(ParentState):
                                               name=name,
                                               blocking=blocking)
 
+    # whether the next child can be cloned and prepared ahead, before the
+    # current one leaves, which needs a child iterator that does nothing
+    # else as it advances
+    _look_ahead = False
+
     def _enter(self):
         super(SequentialState, self)._enter()
         self.__child_iterator = self._get_child_iterator()
         self.__current_child = None
+        self.__next_child = None
         try:
             # clone the children as they come, so just clone the first
             self.__current_child = (
@@ -1426,6 +1706,54 @@ class SequentialState(ParentState):
     def _get_child_iterator(self):
         raise NotImplementedError
 
+    def _leave(self):
+        super(SequentialState, self)._leave()
+        next_child = self.__next_child
+        if next_child is not None:
+            # prepared for a run cut short, so it will never enter
+            self.__next_child = None
+            clone_pool.release(next_child, next_child.original_builder)
+        # no more children will come, so let the iterator clean up, as a
+        # Loop's does when it ends early
+        close = getattr(self.__child_iterator, "close", None)
+        if close is not None:
+            close()
+
+    def _clone_next_child(self):
+        # the next child's clone, if it was made ahead, or a new one
+        next_child = self.__next_child
+        if next_child is None:
+            return next(self.__child_iterator)._clone(self)
+        self.__next_child = None
+        return next_child
+
+    def child_enter_callback(self, child):
+        super(SequentialState, self).child_enter_callback(child)
+        lead_time = self._exp._lead_time
+        if (lead_time is not None and self._look_ahead and
+            not child._following_may_run):
+            # The next child enters once this one leaves, which may be
+            # close to its start, so prepare it lead_time before this one
+            # ends, or now, if that isn't known.
+            if child._end_time is None:
+                prepare_time = None
+            else:
+                prepare_time = child._end_time - lead_time
+            clock.schedule(partial(self._prepare_next_child, child),
+                           event_time=prepare_time, priority=BACKGROUND)
+
+    def _prepare_next_child(self, child):
+        if (child is not self.__current_child or child._following_may_run or
+            not self._active or self._cancel_time is not None or
+            self.__next_child is not None):
+            # too late, or there's nothing to prepare
+            return
+        try:
+            self.__next_child = next(self.__child_iterator)._clone(self)
+        except StopIteration:
+            return
+        self.__next_child.prepare()
+
     def child_leave_callback(self, child):
         # gets called anytime a child leaves
         super(SequentialState, self).child_leave_callback(child)
@@ -1445,8 +1773,7 @@ class SequentialState(ParentState):
         else:
             try:
                 # clone the next child and schedule it
-                self.__current_child = (
-                    next(self.__child_iterator)._clone(self))
+                self.__current_child = self._clone_next_child()
                 clock.schedule(partial(self.__current_child.enter, next_time))
             except StopIteration:
                 # there are no more children, so set our end time and leave
@@ -1548,6 +1875,8 @@ class Serial(SequentialState):
     the eye it will look like they are taking turns.
 
     """
+    _look_ahead = True
+
     def _get_child_iterator(self):
         return iter(self._children)
 
@@ -1829,6 +2158,11 @@ def Else(name="ELSE BODY"):
     return false_state
 
 
+def _is_sequence(iterable):
+    # whether a Loop can index iterable by i, rather than iterate over it
+    return hasattr(iterable, "__len__") and hasattr(iterable, "__getitem__")
+
+
 class Loop(SequentialState):
     """Repeat section of state-machine.
 
@@ -1842,9 +2176,15 @@ class Loop(SequentialState):
         This is any iterable class. i.e. List, Seq, String, Tuple.  If this
         variable is set, then it will be looped over. *iterable* can also
         be an integer. If so, the *Loop* will loop a set number of times.
+        Iterables without a length, such as generators or a
+        *TrialSource* streaming trials from a file, are looped over one
+        item at a time, as they run out, without being read in first. A
+        generator can only be looped over once.
     shuffle : Boolean (default = False, optional)
         If shuffle is set to True, then your passed in iterable will be
-        shuffled before it is presented.
+        shuffled before it is presented. This reads all of an iterable
+        without a length into a list; a *TrialSource* can shuffle within
+        blocks instead.
     conditional : Boolean (default = True, optional)
         At the beginning of each iteration of the loop, it checks that
         conditional evaluates to true. In conjunction with an iterable, it
@@ -1966,8 +2306,16 @@ class Loop(SequentialState):
 
             if isinstance(self._iterable, int):
                 count = self._iterable
-            else:
+            elif _is_sequence(self._iterable):
                 count = len(self._iterable)
+            else:
+                # it ends when the iterable runs out
+                i = 0
+                while self._outcome:
+                    yield i
+                    i += 1
+                    self._outcome = val(self._cond)
+                return
 
             for i in range(count):
                 self._outcome = val(self._cond)
@@ -1977,13 +2325,35 @@ class Loop(SequentialState):
 
     def _get_child_iterator(self):
         self._outcome = NotAvailable
-        for i in self.iter_i():
-            self._i = i
-            if self._iterable is None or isinstance(self._iterable, int):
-                self._current = i
-            else:
-                self._current = self._iterable[i]
-            yield self.__body_state
+        iterable = self._iterable
+        items = iterator = None
+        if iterable is None or isinstance(iterable, int):
+            pass
+        elif _is_sequence(iterable):
+            items = iterable
+        else:
+            iterator = iter(iterable)
+        try:
+            for i in self.iter_i():
+                if items is not None:
+                    current = items[i]
+                elif iterator is not None:
+                    try:
+                        current = next(iterator)
+                    except StopIteration:
+                        return
+                else:
+                    current = i
+                self._i = i
+                self._current = current
+                yield self.__body_state
+        finally:
+            # an iterator made for this run, such as a TrialSource's, may
+            # hold a file or a thread; one passed in belongs to the caller
+            if iterator is not None and iterator is not iterable:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
 
     def __enter__(self):
         # push self.__body_state as current parent
@@ -2048,6 +2418,8 @@ class Record(State):
                                      blocking=blocking)
 
         self.__refs = kwargs
+        self.__evaluators = [(name, compile_ref(ref, self))
+                             for name, ref in kwargs.items()]
         self.__triggers = triggers
         self.__log_filename = None
         self.__log_writer = None
@@ -2064,13 +2436,15 @@ class Record(State):
         else:
             title = "record_%s" % self._name
 
-        if self.__log_filename is not None:
+        # the 'sqlite' log sink never creates the file
+        if self.__log_filename is not None and \
+           os.path.exists(self.__log_filename):
             remove(self.__log_filename)
         self.__log_filename = self._exp.reserve_data_filename(title, "slog")
 
         if self.__log_writer is not None:
             self.__log_writer.close()
-        self.__log_writer = LogWriter(self.__log_filename)
+        self.__log_writer = self._exp.create_log_writer(self.__log_filename)
 
     def end_log(self, to_csv=False):
         """Close logs.
@@ -2080,9 +2454,8 @@ class Record(State):
             self.__log_writer.close()
             self.__log_writer = None
             if to_csv:
-                csv_filename = (os.path.splitext(self.__log_filename)[0] +
-                                ".csv")
-                log2csv(self.__log_filename, csv_filename)
+                # converted along with the other logs once all are closed
+                self._exp._queue_log2csv(self.__log_filename)
 
     def _schedule_start(self):
         clock.schedule(self.leave, event_time=self._start_time)
@@ -2135,7 +2508,7 @@ class Record(State):
         """
         # if anything (or just triggers) changed, write everything
         try:
-            record = val(self.__refs)
+            record = {name: evaluate() for name, evaluate in self.__evaluators}
         except NotAvailableError:
             raise NotAvailableError(
                 "One or more recorded values not available!")
@@ -2166,6 +2539,10 @@ class Log(AutoFinalizeState):
         Experiment automatically.
     name : string (optional)
         The unique name of this state
+    flush : boolean (optional, default = True)
+        If True, sync this log and every state log to disk after writing.
+        Only honored by the default 'log' flush policy of the
+        *Experiment*; other policies decide when to sync on their own.
     kwargs : (keyword = argument)
         As many arguments as you would like to pass in. Use the format
         `keyword = variable_name` and *Log* will log the value of
@@ -2239,11 +2616,13 @@ class Log(AutoFinalizeState):
 
         if self.__log_writer is not None:
             self.__log_writer.close()
-        if self.__log_filename is not None:
+        # the 'sqlite' log sink never creates the file
+        if self.__log_filename is not None and \
+           os.path.exists(self.__log_filename):
             remove(self.__log_filename)
 
         self.__log_filename = self._exp.reserve_data_filename(title, "slog")
-        self.__log_writer = LogWriter(self.__log_filename)
+        self.__log_writer = self._exp.create_log_writer(self.__log_filename)
 
     def end_log(self, to_csv=False):
         """Close logs.
@@ -2253,9 +2632,8 @@ class Log(AutoFinalizeState):
             self.__log_writer.close()
             self.__log_writer = None
             if to_csv:
-                csv_filename = (os.path.splitext(self.__log_filename)[0] +
-                                ".csv")
-                log2csv(self.__log_filename, csv_filename)
+                # converted along with the other logs once all are closed
+                self._exp._queue_log2csv(self.__log_filename)
 
     def _enter(self):
         record = self._log_items.copy()
@@ -2275,8 +2653,7 @@ class Log(AutoFinalizeState):
         else:
             raise ValueError("Invalid log_dict value: %r" % self._log_dict)
         if self._flush:
-            self.__log_writer._file.flush()
-            fsync(self.__log_writer._file)
+            self.__log_writer.request_flush()
             self._exp._flush_state_loggers()
         self._started = True
         self._ended = True
@@ -2443,6 +2820,8 @@ class Wait(State):
                                    blocking=blocking)
 
         self.__until = until  # TODO: make sure until is Ref or None
+        if until is not None:
+            self.__evaluate_until = compile_ref(until, self)
         self._until_value = None
         self._event_time = {"time": None, "error": None}
 
@@ -2495,7 +2874,7 @@ class Wait(State):
         self.claim_exceptions()
         self._started = True
         try:
-            self._until_value = self.__until.eval()
+            self._until_value = self.__evaluate_until()
         except NotAvailableError:
             self._until_value = NotAvailable
         if self._until_value:
@@ -2508,7 +2887,7 @@ class Wait(State):
         """
         self.claim_exceptions()
         try:
-            self._until_value = self.__until.eval()
+            self._until_value = self.__evaluate_until()
         except NotAvailableError:
             self._until_value = NotAvailable
         if self._until_value:
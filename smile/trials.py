@@ -0,0 +1,190 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import csv
+import json
+import os
+import queue
+import random
+import threading
+
+# Trial lists that are too long to build in memory before the experiment
+# starts are better read as they are needed. A *TrialSource* reads them
+# from a file on a thread of its own, a little ahead of the *Loop* looping
+# over it:
+#
+#   with Loop(TrialSource("trials.csv", converters={"dur": float})) as trial:
+#       Label(text=trial.current["word"], duration=trial.current["dur"])
+
+
+# sentinel put on the queue once the source runs out
+_END = object()
+
+
+class _Error(object):
+    """An exception raised reading the source, for the loop to raise."""
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class TrialSource(object):
+    """Streams the trials of a *Loop* from a file, without reading it all
+    into memory first.
+
+    Each time the *Loop* starts looping over it, a background thread reads
+    the rows of the file onto a queue, staying at most *prefetch* rows
+    ahead, and the *Loop* takes them off the queue one trial at a time.
+    *i* and *current* are set as for a list of dicts: *i* counts the
+    trials from 0 and *current* is the row.
+
+    Parameters
+    ----------
+    source : string or function
+        The name of a .csv, .tsv or .jsonl file, with one trial per row
+        (per line, for .jsonl). A .csv or .tsv file has a header naming
+        the columns, and each row becomes a dict. Each line of a .jsonl
+        file is read as JSON. Can also be a function returning an iterable
+        of trials, called each time the *Loop* starts, such as a generator
+        function.
+    format : string (optional)
+        'csv', 'tsv' or 'jsonl', if not given by the extension of *source*.
+    prefetch : int (default = 256)
+        The most rows read ahead of the *Loop*.
+    shuffle_block : int (optional)
+        If given, the rows are shuffled within successive blocks of this
+        many rows, so a long list can be shuffled without holding all of
+        it in memory.
+    seed : int (optional)
+        Seeds the shuffling, so it can be repeated.
+    converters : dict (optional)
+        Functions to apply to the columns of each row, by name, such as
+        `{"dur": float}` for a column of numbers in a .csv file.
+
+    Properties
+    ----------
+    stats : dict
+        *rows* is the number of rows the *Loop* has taken, and *waits* the
+        number of times it had to wait for the thread to read one.
+    """
+    def __init__(self, source, format=None, prefetch=256, shuffle_block=None,
+                 seed=None, converters=None):
+        if format is None and not callable(source):
+            format = os.path.splitext(source)[1][1:].lower()
+            if format == "ndjson":
+                format = "jsonl"
+        if not callable(source) and format not in ("csv", "tsv", "jsonl"):
+            raise ValueError("Can't tell how to read %r. Give format as "
+                             "'csv', 'tsv' or 'jsonl'." % (source,))
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        self._source = source
+        self._format = format
+        self._prefetch = prefetch
+        self._shuffle_block = shuffle_block
+        self._seed = seed
+        self._converters = converters
+        self._stats = {"rows": 0, "waits": 0}
+
+    def __repr__(self):
+        return "TrialSource(%r)" % (self._source,)
+
+    @property
+    def stats(self):
+        return self._stats.copy()
+
+    def _rows(self):
+        # the rows of the source, in order
+        if callable(self._source):
+            for row in self._source():
+                yield row
+        elif self._format == "jsonl":
+            with open(self._source, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            delimiter = "\t" if self._format == "tsv" else ","
+            with open(self._source, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f, delimiter=delimiter):
+                    yield row
+
+    def _trials(self):
+        # the rows, converted and shuffled within blocks
+        converters = self._converters
+        rows = self._rows()
+        if converters:
+            rows = (self._convert(row) for row in rows)
+        if not self._shuffle_block:
+            for row in rows:
+                yield row
+            return
+        rng = random.Random(self._seed)
+        block = []
+        for row in rows:
+            block.append(row)
+            if len(block) == self._shuffle_block:
+                rng.shuffle(block)
+                for trial in block:
+                    yield trial
+                block = []
+        rng.shuffle(block)
+        for trial in block:
+            yield trial
+
+    def _convert(self, row):
+        for name, func in self._converters.items():
+            if name in row:
+                row[name] = func(row[name])
+        return row
+
+    def _read(self, rows, stop):
+        # runs on the reading thread
+        try:
+            for row in self._trials():
+                while not stop.is_set():
+                    try:
+                        rows.put(row, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                else:
+                    return
+            item = _END
+        except Exception as exc:
+            item = _Error(exc)
+        while not stop.is_set():
+            try:
+                rows.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        rows = queue.Queue(self._prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._read, args=(rows, stop),
+                                  name="TrialSource(%s)" % (self._source,))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                try:
+                    row = rows.get_nowait()
+                except queue.Empty:
+                    self._stats["waits"] += 1
+                    row = rows.get()
+                if row is _END:
+                    return
+                if isinstance(row, _Error):
+                    raise row.exc
+                self._stats["rows"] += 1
+                yield row
+        finally:
+            # stops the thread if the loop ends before the rows do
+            stop.set()
@@ -549,6 +549,7 @@ class WidgetState(VisualState):
         self._init_rotate_origin = rotate_origin
         self._widget = None
         self.__parent_widget = None
+        self.__prepared_params = None
         self._constructor_param_names = list(params)
 
         #self._init_constructor_params = params
@@ -719,6 +720,13 @@ class WidgetState(VisualState):
         self.__parent_widget.remove_widget(self._widget)
         self.__parent_widget = None
 
+    def _recycle(self):
+        # the widget is built anew each time the state enters, so don't
+        # hold on to it while waiting to be reused
+        super(WidgetState, self)._recycle()
+        self._widget = None
+        self.__rotate_inst = None
+
     def live_change(self, **params):
         # first remove rotation params b/c they don't go to widget
         rot_params = {rp: params.pop(rp)
@@ -899,13 +907,32 @@ class WidgetState(VisualState):
         anim.override_instantiation_context()  # PBS: Is this line needed (see animate)?
         return anim
 
-    def _enter(self):
+    def _prepare(self):
+        # build the widget ahead, to use if enter finds the same params
         self.__x_pos_mode = None
         self.__y_pos_mode = None
 
         params = self.eval_init_refs()
         params = self.resolve_params(params)
         self.construct(params)
+        # as enter will find them, with what building the widget filled in,
+        # such as the rotate origin
+        self.__prepared_params = self.resolve_params(self.eval_init_refs())
+
+    def _enter(self):
+        params = self.eval_init_refs()
+        params = self.resolve_params(params)
+        prepared_params = self.__prepared_params
+        self.__prepared_params = None
+        try:
+            prepared = prepared_params == params
+        except (ValueError, TypeError):
+            # such as numpy arrays, which don't compare to a bool
+            prepared = False
+        if not prepared:
+            self.__x_pos_mode = None
+            self.__y_pos_mode = None
+            self.construct(params)
 
         # We do this after because self.construct might modify self._end_time.
         super(WidgetState, self)._enter()
@@ -3196,6 +3223,11 @@ class Video(WidgetState.wrap(kivy.uix.video.Video)):
     Kivy documentation for 'kivy.uix.video. <https://kivy.org/docs/api-kivy.uix.Video.html>'_
 
     """
+    def _prepare(self):
+        # the video needs its start time to set its end time, and starts
+        # updating once it loads, so it is only built on entering
+        pass
+
     def _set_widget_defaults(self):
         # force video to load immediately so that duration is available...
         _kivy_clock.unschedule(self._widget._do_video_load)
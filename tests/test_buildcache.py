@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+from smile.buildcache import build_cache, cached
+
+build_cache.directory = tempfile.mkdtemp()
+calls = []
+
+@cached
+def make_trials(n, seed=0):
+    calls.append((n, seed))
+    return [{"i": i, "seed": seed} for i in range(n)]
+
+# made once, then loaded, for the same arguments
+trials = make_trials(5)
+assert make_trials(5) == trials and calls == [(5, 0)]
+make_trials(5, seed=1)
+assert calls == [(5, 0), (5, 1)]
+print(build_cache.stats, os.listdir(build_cache.directory))
+assert build_cache.stats["hits"] == 1 and build_cache.stats["misses"] == 2
+
+# results that can't be pickled are just returned
+@cached
+def make_func():
+    return lambda: 1
+assert make_func()() == 1 and build_cache.stats["uncacheable"] == 1
+
+build_cache.clear()
+make_trials(5)
+assert calls[-1] == (5, 0) and len(calls) == 3
+
+# a cache file that no longer loads, here one naming a module that is
+# gone, is made again
+filename = build_cache._filename(make_trials.__wrapped__, (5,), {})
+with open(filename, "wb") as f:
+    f.write(b"\x80\x04\x95\x13\x00\x00\x00\x00\x00\x00\x00\x8c\x0bgone_module"
+            b"\x94\x8c\x01X\x94\x93\x94.")
+assert make_trials(5) == trials and len(calls) == 4
+assert make_trials(5) == trials and len(calls) == 4
+
+# files listed in depends are part of the key
+words = os.path.join(build_cache.directory, "words.txt")
+with open(words, "w") as f:
+    f.write("cat\ndog\n")
+
+@cached(depends=[words])
+def read_words():
+    calls.append("words")
+    with open(words) as f:
+        return f.read().split()
+
+assert read_words() == ["cat", "dog"] and read_words() == ["cat", "dog"]
+with open(words, "w") as f:
+    f.write("cow\n")
+assert read_words() == ["cow"] and calls.count("words") == 2
+
+# a failed write leaves no temporary file behind
+import smile.buildcache
+def failing_replace(src, dst):
+    raise OSError("disk full")
+smile.buildcache.os.replace, replace = failing_replace, os.replace
+try:
+    make_trials(6)
+except OSError:
+    pass
+finally:
+    smile.buildcache.os.replace = replace
+assert not [name for name in os.listdir(build_cache.directory)
+            if name.endswith(".tmp")]
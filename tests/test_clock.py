@@ -0,0 +1,143 @@
+from functools import partial
+
+from smile.clock import Clock, BACKGROUND, CRITICAL
+
+now = [0.0]
+clock = Clock()
+clock.now = lambda: now[0]
+calls = []
+
+# immediate events first, then timed ones in time order, ties in the
+# order they were scheduled
+for name, event_time in (("a", 0.2), ("b", None), ("c", 0.1), ("d", 0.2),
+                         ("e", None), ("f", 0.1)):
+    clock.schedule(partial(calls.append, name), event_time=event_time)
+now[0] = 0.15
+clock.tick()
+print(calls, len(clock))
+assert calls == ["b", "e", "c", "f"] and len(clock) == 2
+now[0] = 0.3
+clock.tick()
+assert calls[4:] == ["a", "d"] and len(clock) == 0
+
+# a repeating event, unscheduled by the function it calls
+def beat():
+    calls.append(now[0])
+    if len(calls) == 10:
+        clock.unschedule(beat)
+del calls[:]
+clock.schedule(beat, event_time=0.0, repeat_interval=1.0)
+for i in range(20):
+    now[0] = float(i)
+    clock.tick()
+print(calls)
+assert calls == [float(i) for i in range(10)] and len(clock) == 0
+
+# cancelling one event leaves the others for the same function alone
+del calls[:]
+func = partial(calls.append, "x")
+first = clock.schedule_event(func, event_time=1.0)
+clock.schedule(func, event_time=2.0)
+first.cancel()
+now[0] = 5.0
+clock.tick()
+assert calls == ["x"]
+
+# lots of unscheduled events are dropped from the heap
+funcs = [partial(calls.append, i) for i in range(1000)]
+for i, func in enumerate(funcs):
+    clock.schedule(func, event_time=10.0 + i)
+for func in funcs[:900]:
+    clock.unschedule(func)
+print(len(clock), len(clock._heap))
+assert len(clock) == 100 and len(clock._heap) < 1000
+
+# past the deadline, background events wait for a tick with time for them
+clock = Clock()
+clock.now = lambda: now[0]
+now[0] = 0.0
+calls = []
+clock.schedule(partial(calls.append, "enter"))
+clock.schedule(partial(calls.append, "log 1"), priority=BACKGROUND)
+clock.schedule(partial(calls.append, "appear"), priority=CRITICAL)
+clock.schedule(partial(calls.append, "log 2"), priority=BACKGROUND)
+clock.schedule(partial(calls.append, "leave"))
+clock.tick(deadline=-1.0)
+print(calls, clock.stats)
+assert calls == ["enter", "appear", "leave"]
+assert clock.stats["deferred"] == 2 and clock.stats["late_critical"] == 1
+clock.tick(deadline=1.0)
+assert calls[3:] == ["log 1", "log 2"] and len(clock) == 0
+
+# how late each event was called, per owner
+class Trial(object):
+    _name = "trial"
+
+    def appear(self):
+        calls.append("appear")
+
+clock = Clock()
+clock.now = lambda: now[0]
+clock.record_lateness(size=4)
+trial = Trial()
+for i in range(6):
+    now[0] = i + 0.003
+    clock.schedule(trial.appear, event_time=float(i))
+    clock.schedule(partial(calls.append, "immediate"))
+    clock.tick()
+summary = clock.lateness.summary()
+print(summary)
+assert [row["owner"] for row in summary] == ["list", "Trial (trial)"]
+assert summary[1]["events"] == 6 and summary[1]["lateness_hist"][3] == 6
+events = clock.lateness.events()
+assert len(events) == 4 and events[-1]["due_time"] == 5.0
+
+# cancelling an event that was already called does nothing, whether or
+# not another event for the same function is still scheduled
+clock = Clock()
+clock.now = lambda: now[0]
+now[0] = 0.0
+del calls[:]
+func = partial(calls.append, "y")
+done = clock.schedule_event(func, event_time=0.0)
+clock.schedule(func, event_time=1.0)
+clock.tick()
+done.cancel()
+assert len(clock) == 1
+now[0] = 1.0
+clock.tick()
+assert calls == ["y", "y"] and len(clock) == 0
+done = clock.schedule_event(func)
+clock.tick()
+done.cancel()
+done.cancel()
+print(len(clock), clock._n_cancelled)
+assert len(clock) == 0 and clock._n_cancelled == 0
+
+# finalizing isn't put off, so a Record stops at its end time even in a
+# tick that overran its deadline
+import os
+import tempfile
+
+from smile.common import *
+from smile.headless import run_headless
+from smile.log import log2dl
+
+exp = Experiment(name="ClockRecord", data_dir=tempfile.mkdtemp(),
+                 show_splash=False, tick_margin=0.012)
+exp.n = 0
+with Parallel():
+    # ends 10 ms into a frame, past the deadline 4.7 ms into it
+    rec = Record(n=exp.n, duration=1.01, name="n")
+    with Loop(400) as trial:
+        Wait(0.005)
+        exp.n = trial.i
+Log(name="record", end_time=rec.end_time)
+run_headless(exp, max_time=60)
+end_time = log2dl(os.path.join(exp.session_dir,
+                               "log_record_0.slog"))[0]["end_time"]
+rows = log2dl(os.path.join(exp.session_dir, "record_n_0.slog"))
+stats = log2dl(os.path.join(exp.session_dir, "clock_0.slog"))[0]
+print(end_time, rows[-1], stats)
+assert stats["overruns"] > 0
+assert max(row["record_time_time"] for row in rows) <= end_time + 1e-9
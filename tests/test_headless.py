@@ -0,0 +1,155 @@
+import glob
+import os
+import tempfile
+import time
+
+from smile.common import *
+from smile.headless import run_headless
+from smile.log import log2dl
+from smile.state import clone_pool
+from smile.ref import propagation, profiler
+from smile.clock import clock
+
+def build(**kwargs):
+    exp = Experiment(name="Headless", data_dir=tempfile.mkdtemp(),
+                     show_splash=False, **kwargs)
+
+    with Loop(100) as trial:
+        stim = Label(text=Ref(str, trial.i), duration=1.0)
+        kp = KeyPress(keys=["J", "K"], duration=2.0,
+                      base_time=stim.appear_time["time"])
+        with Parallel():
+            Rectangle(duration=0.3)
+            Wait(0.2)
+        Log(name="trials", i=trial.i, pressed=kp.pressed, rt=kp.rt,
+            appear_time=stim.appear_time["time"])
+    return exp
+
+
+asked = []
+def respond(state):
+    # answer every other trial
+    asked.append(state)
+    if len(asked) % 2:
+        return ("J", 0.45)
+    return None
+
+exp = build()
+start = time.time()
+duration = run_headless(exp, respond=respond, max_time=3600)
+print("%.1f s of experiment in %.2f s" % (duration, time.time() - start))
+
+session_dir = exp.session_dir
+rows = log2dl(os.path.join(session_dir, "log_trials_0.slog"))
+print(rows[0], rows[-1])
+assert len(rows) == 100 and len(asked) == 100
+assert [r["pressed"] for r in rows[:4]] == ["J", "", "J", ""]
+for row in rows:
+    if row["pressed"]:
+        # the Label lasts a second, so the response comes 1.45 s after it
+        assert abs(row["rt"] - 1.45) < 1e-6
+# the Label appears on a flip, once a frame
+assert all(abs((r["appear_time"] - rows[0]["appear_time"]) * 60 -
+               round((r["appear_time"] - rows[0]["appear_time"]) * 60)) <
+           1e-6 for r in rows)
+print(sorted(os.path.basename(f)
+             for f in glob.glob(os.path.join(session_dir, "*.slog"))))
+
+# reusing the clones of finished trials logs the same trials
+del asked[:]
+exp = build(recycle_clones=True)
+run_headless(exp, respond=respond, max_time=3600)
+print(clone_pool.stats)
+for name in ("log_trials_0.slog", "state_Label_0.slog",
+             "state_KeyPress_0.slog"):
+    assert (log2dl(os.path.join(exp.session_dir, name)) ==
+            log2dl(os.path.join(session_dir, name))), name
+assert clone_pool.stats["reused"] > clone_pool.stats["created"]
+assert not clone_pool.enabled
+
+# preparing states ahead of entering them logs the same trials, too
+del asked[:]
+exp = build(lead_time=0.1)
+run_headless(exp, respond=respond, max_time=3600)
+for name in ("log_trials_0.slog", "state_Label_0.slog",
+             "state_KeyPress_0.slog"):
+    assert (log2dl(os.path.join(exp.session_dir, name)) ==
+            log2dl(os.path.join(session_dir, name))), name
+lead_times = log2dl(os.path.join(exp.session_dir, "lead_time_0.slog"))
+print([(row["state"], row["prepared"], row["min_lead"])
+       for row in lead_times])
+assert sum(row["prepared"] for row in lead_times) >= 100
+
+# a Label prepared for a trial cut short goes back to its builder's pool
+exp = Experiment(name="HeadlessCut", data_dir=tempfile.mkdtemp(),
+                 show_splash=False, lead_time=0.1, recycle_clones=True)
+with Loop(20) as trial:
+    with Serial():
+        KeyPress(keys=["J"])
+        stim = Label(text=Ref(str, trial.i), duration=0.5)
+    with UntilDone():
+        Wait(0.45)
+run_headless(exp, max_time=60)
+print(clone_pool.stats)
+assert len(stim._clone_pool) == 1 and stim._clone_pool[0]._widget is None
+assert clone_pool.stats["created"] < 20
+
+# random values are drawn once each, so a seeded session runs the same
+# trials whether or not the states are prepared ahead
+import random
+
+def build_random(**kwargs):
+    exp = Experiment(name="HeadlessRandom", data_dir=tempfile.mkdtemp(),
+                     show_splash=False, **kwargs)
+    words = ["word%d" % i for i in range(50)]
+    with Loop(30) as trial:
+        Wait(0.2, jitter=0.3)
+        KeyPress(keys=["J"])
+        stim = Label(text=Ref(random.choice, words),
+                     font_size=Ref(random.randint, 20, 40), duration=0.5)
+        Log(name="trials", text=stim.text, font_size=stim.font_size,
+            start=stim.appear_time["time"])
+    return exp
+
+trials = []
+for lead_time in (None, 0.1):
+    exp = build_random(lead_time=lead_time)
+    random.seed(7)
+    run_headless(exp, respond=lambda state: ("J", 0.3), max_time=3600)
+    trials.append(log2dl(os.path.join(exp.session_dir, "log_trials_0.slog")))
+print(trials[1][:2])
+assert len(trials[0]) == 30 and trials[0] == trials[1]
+lead_times = log2dl(os.path.join(exp.session_dir, "lead_time_0.slog"))
+assert [row["prepared"] for row in lead_times
+        if row["state"] == "Label"] == [30]
+
+# a variable changed in place is seen by the Refs reading it
+exp = Experiment(name="HeadlessVars", data_dir=tempfile.mkdtemp(),
+                 show_splash=False)
+exp.resp = []
+with Loop(5) as trial:
+    Func(lambda i: exp.get_var("resp").append(i), trial.i)
+    with If(Ref(len, exp.resp) > 2):
+        Log(name="many", n=Ref(len, exp.resp))
+run_headless(exp, max_time=60)
+rows = log2dl(os.path.join(exp.session_dir, "log_many_0.slog"))
+assert [row["n"] for row in rows] == [3, 4, 5]
+
+# the settings kept in module singletons only hold while the experiment runs
+def settings():
+    return (propagation.coalesce, profiler.enabled, clone_pool.enabled,
+            clock.lateness is not None)
+
+exp = Experiment(name="HeadlessSettings", data_dir=tempfile.mkdtemp(),
+                 show_splash=False, coalesce_changes=True, profile_refs=True,
+                 record_lateness=True, recycle_clones=True)
+seen = []
+with Loop(3) as trial:
+    Func(lambda: seen.append(settings()))
+    Wait(0.1 + trial.i / 10.)
+assert settings() == (False, False, False, False)
+run_headless(exp, max_time=60)
+assert seen == [(True, True, True, True)] * 3
+assert settings() == (False, False, False, False)
+names = os.listdir(exp.session_dir)
+assert "ref_profile_0.tsv" in names and "clock_lateness_0.slog" in names
@@ -0,0 +1,225 @@
+import os
+import tempfile
+import time
+from array import array
+
+from smile.log import LogWriter, LogReader, FlushPolicy, log2dl, log2csv, \
+    logs2csv, log2columns, save_columns, load_columns, find_slogs, \
+    load_slogs, recover_slog
+from smile.logdb import SQLiteStore, db2dl, db_query, db_titles
+
+data_dir = tempfile.mkdtemp()
+
+# write the same records synchronously and from the writer thread
+for threaded in (False, True):
+    filename = os.path.join(data_dir, "log_threaded_%d.slog" % threaded)
+    lw = LogWriter(filename, threaded=threaded, queue_size=16)
+    record = {"stim": "dog", "log_time": 0.0}
+    for i in range(500):
+        # reusing the dict must not change what was logged
+        record["i"] = i
+        record["log_time"] = i * .01
+        lw.write_record(record)
+        if i % 50 == 0:
+            lw.flush()
+    lw.close()
+    print(lw.stats)
+
+    rows = list(LogReader(filename))
+    assert [r["i"] for r in rows] == list(range(500))
+    print(rows[0], rows[-1])
+
+print(len(log2dl(os.path.join(data_dir, "log_threaded"))))
+
+# group commit syncs once per group rather than once per record
+filename = os.path.join(data_dir, "log_group_0.slog")
+lw = LogWriter(filename, threaded=True,
+               flush_policy=FlushPolicy("group", interval=10.0,
+                                        max_records=100))
+for i in range(1000):
+    lw.write_record({"i": i})
+lw.close()
+print(lw.stats)
+assert lw.stats["syncs"] <= 11
+
+# version 1 and 2 files read back the same, including schema changes
+for version in (1, 2):
+    filename = os.path.join(data_dir, "log_version_%d.slog" % version)
+    lw = LogWriter(filename, version=version)
+    lw.write_record({"a": 1, "b": {"time": 1.0, "error": 0.0}})
+    lw.write_record({"a": 2, "b": {"time": 2.0, "error": 0.0}, "c": "new"})
+    lw.write_record({"a": 3, "b": {"time": 3.0, "error": 0.0}})
+    lw.close()
+    lr = LogReader(filename, unwrap=True)
+    rows = list(lr)
+    print(lr.version, rows)
+    assert lr.version == version
+    assert rows[1]["c"] == "new" and "c" not in rows[2]
+
+# csv conversion in one pass, with a column that shows up late
+log2csv(os.path.join(data_dir, "log_version_2.slog"))
+with open(os.path.join(data_dir, "log_version_2.csv")) as f:
+    lines = f.read().splitlines()
+print(lines)
+assert lines[0] == "a,b_time,b_error,log_num,c"
+assert lines[1] == "1,1.0,0.0,0,"
+
+# several logs at once
+logs2csv([os.path.join(data_dir, "log_threaded_%d.slog" % i)
+          for i in (0, 1)])
+print(os.path.exists(os.path.join(data_dir, "log_threaded_1.csv")))
+# and in threads, as an experiment does
+for i in (0, 1):
+    os.remove(os.path.join(data_dir, "log_threaded_%d.csv" % i))
+logs2csv([os.path.join(data_dir, "log_threaded_%d.slog" % i)
+          for i in (0, 1)], processes=False)
+assert os.path.exists(os.path.join(data_dir, "log_threaded_1.csv"))
+
+# typed columns without building a list of dicts
+filename = os.path.join(data_dir, "record_mouse_0.slog")
+lw = LogWriter(filename)
+for i in range(100):
+    record = {"pos": (i, 2 * i), "button": "left" if i % 2 else None,
+              "record_time": {"time": i * .01, "error": 0.0}}
+    if i > 50:
+        record["late"] = True
+    lw.write_record(record)
+lw.close()
+columns = log2columns(filename)
+print(list(columns))
+assert columns["pos_1"].typecode == "q" and columns["pos_1"][10] == 20
+assert columns["record_time_time"].typecode == "d"
+assert columns["button"][0] is None and columns["button"][1] == "left"
+assert columns["late"][0] is None and columns["late"][99] is True
+save_columns(columns, os.path.join(data_dir, "record_mouse.zip"))
+loaded = load_columns(os.path.join(data_dir, "record_mouse.zip"))
+assert list(loaded["button"]) == list(columns["button"])
+assert loaded["record_time_time"] == columns["record_time_time"]
+
+# ints beyond int64 fall back to python objects
+filename = os.path.join(data_dir, "log_big_0.slog")
+lw = LogWriter(filename)
+for i in range(10):
+    lw.write_record({"hash": 2 ** 64 + i, "ns": i if i < 5 else 2 ** 63})
+lw.close()
+columns = log2columns(filename)
+assert columns["hash"] == [2 ** 64 + i for i in range(10)]
+assert columns["ns"] == [0, 1, 2, 3, 4] + [2 ** 63] * 5
+
+# random access through the block index
+filename = os.path.join(data_dir, "log_blocks_0.slog")
+lw = LogWriter(filename, block_records=100, checkpoint_blocks=4)
+for i in range(1050):
+    lw.write_record({"i": i, "log_time": i * .1})
+lw.close()
+print(lw.stats)
+lr = LogReader(filename)
+assert len(lr) == 1050
+assert lr[-1]["i"] == 1049 and lr[555]["i"] == 555
+assert [r["i"] for r in lr[98:203:5]] == list(range(98, 203, 5))
+assert [r["i"] for r in lr.time_range(10.0, 12.05)] == list(range(100, 121))
+lr.seek(1040)
+assert [r["i"] for r in lr] == list(range(1040, 1050))
+assert len(LogReader(filename).read_all()) == 1050
+
+# a log cut off without its final index is read up to the cut
+with open(filename, "rb") as f:
+    data = f.read()
+filename = os.path.join(data_dir, "log_cut_0.slog")
+with open(filename, "wb") as f:
+    f.write(data[:len(data) // 2])
+lr = LogReader(filename)
+print(len(lr))
+assert [r["i"] for r in lr[:]] == [r["i"] for r in LogReader(filename)]
+
+# every subject and session of an experiment at once
+for subj in ("s001", "s002"):
+    for sess in ("20200101_120000", "20200102_120000"):
+        session_dir = os.path.join(data_dir, "data", "Exp", subj, sess)
+        os.makedirs(session_dir)
+        for log_num in range(2):
+            lw = LogWriter(os.path.join(session_dir,
+                                        "log_study_%d.slog" % log_num))
+            for i in range(10):
+                lw.write_record({"i": i})
+            lw.close()
+        LogWriter(os.path.join(session_dir, "state_Wait_0.slog")).close()
+print(find_slogs(os.path.join(data_dir, "data"), subject="s002")[0])
+progress = []
+rows = load_slogs(os.path.join(data_dir, "data"), title="log_*", max_workers=2,
+                  progress=lambda *args: progress.append(args))
+print(rows[0], rows[-1])
+assert len(rows) == 80 and len(progress) == 8
+assert (rows[-1]["subject"], rows[-1]["log_num"], rows[-1]["i"]) == \
+    ("s002", 1, 9)
+
+# recover what is left of a log that was cut off
+filename = os.path.join(data_dir, "log_blocks_0.slog")
+print(recover_slog(filename))
+filename = os.path.join(data_dir, "log_cut_0.slog")
+lr = LogReader(filename)
+n_read = len(list(lr))
+assert lr.damaged
+report = recover_slog(filename)
+print(report)
+lr = LogReader(report["out_filename"])
+assert [r["i"] for r in lr] == list(range(report["records"]))
+assert not lr.damaged and report["records"] >= n_read
+
+# every log of a session in one database
+filename = os.path.join(data_dir, "session_0.sqlite")
+store = SQLiteStore(filename, queue_size=64)
+study = [store.log_writer("log_study", log_num) for log_num in range(2)]
+mouse = store.log_writer("record_mouse")
+for i in range(500):
+    study[i % 2].write_record({"i": i, "log_time": i * .1,
+                               "appear_time": {"time": i * .1,
+                                               "error": 0.0}})
+    mouse.write_record({"pos": (i, i), "record_time": {"time": i * .1 + .05,
+                                                       "error": 0.0}})
+    if i == 250:
+        # a column that shows up late
+        mouse.write_record({"pos": (0, 0), "button": "left",
+                            "record_time": {"time": 25.07, "error": 0.0}})
+store.close()
+print(store.stats, db_titles(filename))
+rows = db2dl(filename, "log_study", subject="s001")
+assert [r["i"] for r in rows] == list(range(500))
+assert rows[1]["log_num"] == 1 and rows[0]["subject"] == "s001"
+rows = db2dl(filename, "record_mouse", start=25.0, stop=25.1)
+print(rows)
+assert [r["button"] for r in rows] == [None, "left"]
+rows = db_query(filename, 'SELECT i, pos_0 FROM log_study JOIN record_mouse '
+                'ON record_time_time BETWEEN log_time AND log_time + .06')
+assert len(rows) == 500 and all(r["i"] == r["pos_0"] for r in rows)
+
+# values sqlite has no type for come back as they were, the time columns
+# are indexed as soon as they are added, and a failed insert is raised by
+# close rather than by a later write
+filename = os.path.join(data_dir, "session_1.sqlite")
+store = SQLiteStore(filename)
+trials = store.log_writer("log_trials")
+trials.write_record({"pressed": array("i", [1, 2]), "log_time": 0.0})
+trials.write_record({"pressed": None, "log_time": 0.1, "rt": 1})
+trials.write_record({"pressed": "J", "log_time": 0.2, "rt": None})
+store.flush()
+while store.stats["records"] < 3:
+    time.sleep(0.01)
+indexes = db_query(filename, "SELECT name FROM sqlite_master "
+                   "WHERE type='index'")
+assert [r["name"] for r in indexes] == ["log_trials_log_time"]
+store.log_writer("sqlite_trials").write_record({"i": 0})
+store.flush()
+while store._error is None:
+    time.sleep(0.01)
+trials.write_record({"pressed": "K", "log_time": 0.3})
+try:
+    store.close()
+except Exception as e:
+    print(repr(e))
+else:
+    raise AssertionError("the failed insert wasn't raised")
+rows = db2dl(filename, "log_trials")
+print(rows)
+assert [r["pressed"] for r in rows] == [[1, 2], None, "J"]
+assert [r["rt"] for r in rows] == [None, 1, None]
@@ -0,0 +1,66 @@
+import os
+import random
+import tempfile
+import time
+
+from smile.common import *
+from smile.headless import run_headless
+from smile.plan import plan
+from smile.clock import clock
+from smile.ref import propagation
+from smile.state import clone_pool
+
+exp = Experiment(name="Plan", data_dir=tempfile.mkdtemp(), show_splash=False)
+
+with Loop(20) as trial:
+    Wait(0.5, jitter=0.5)
+    stim = Label(text=Ref(str, trial.i), duration=0.2)
+    kp = KeyPress(keys=["J", "K"])
+    Log(name="trials", i=trial.i, pressed=kp.pressed)
+
+session_dir = exp.session_dir
+random.seed(3)
+state = random.getstate()
+start = time.time()
+result = plan(exp, runs=10, seed=1)
+print(result.report())
+print("planned in %.2f s" % (time.time() - start))
+
+summary = result.summary()
+assert summary["runs"] == 10 and len(set(result.durations)) == 10
+# each trial takes 0.5 to 1 s of wait, 0.3 to 1 s to respond, and frames
+assert 20 * 0.8 < summary["min_duration"]
+assert summary["max_duration"] < 20 * 2.0 + 1.0
+assert result.entered[0] == result.entered[-1]
+loops = result.loops()
+assert len(loops) == 1 and loops[0]["trials"] == 200
+# every label of every run is counted
+labels = [row for row in result.states() if row["state"] == "Label"]
+assert labels[0]["enters"] == 200
+# the same seed plans the same runs, and random is left as it was
+assert plan(exp, runs=10, seed=1).durations == result.durations
+assert random.getstate() == state
+
+# the runs leave the clock, the counters and the builders as they were
+before = (clock.stats, propagation.stats, clone_pool.stats, len(clock))
+plan(exp, runs=2, seed=2)
+assert (clock.stats, propagation.stats, clone_pool.stats,
+        len(clock)) == before
+assert stim._State__most_recently_entered_clone is stim
+
+# the experiment still runs, and logs where it did before
+run_headless(exp, respond=lambda state: ("J", 0.5))
+assert exp.session_dir == session_dir
+assert "log_trials_0.slog" in os.listdir(session_dir)
+
+# a Loop over a generator would be used up by the dry runs
+exp = Experiment(name="PlanGenerator", data_dir=tempfile.mkdtemp(),
+                 show_splash=False)
+with Loop((i for i in range(3)), shuffle=True) as trial:
+    Wait(0.1)
+try:
+    plan(exp, runs=2)
+except ValueError as e:
+    print(e)
+else:
+    raise AssertionError("plan used up a generator")
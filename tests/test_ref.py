@@ -1,4 +1,5 @@
-from smile.ref import Ref, val, shuffle
+from smile.ref import Ref, val, shuffle, compile_ref, NotAvailable, \
+    NotAvailableError, propagation, interning, profiler
 import math
 x = [0.0]
 r = Ref(math.cos, Ref.getitem(x, 0))
@@ -64,3 +65,89 @@ print(val(y))
 y = y + [d]
 y = y + [f]
 print(val(y))
+
+# compiled evaluators give the same values as val
+g2 = b+d+f
+evaluate = compile_ref(g2)
+print(val(g2), evaluate())
+c['y'] = 8
+print(val(g2), evaluate())
+print(compile_ref((b, Ref.object([1, 2, 3])[1:d], {"x": f}))())
+
+z = Ref.object(0)
+for i in range(100):
+    z = z + 1
+print(val(z), compile_ref(z)())
+
+a.x = NotAvailable
+try:
+    evaluate()
+except NotAvailableError:
+    print("NotAvailable")
+
+# a callback under a diamond is called once per change, with both arms
+# up to date
+a.x = 1
+src = Ref.getattr(a, 'x')
+top = (src + 1) + (src * 2)
+seen = []
+top.add_change_callback(lambda: seen.append(val(top)))
+a.x = 2
+src.dep_changed()
+print(seen, propagation.stats)
+
+# changes in a batch are delivered together
+propagation.coalesce = True
+with propagation.batch():
+    for i in range(5):
+        a.x = i
+        src.dep_changed()
+propagation.coalesce = False
+print(seen, propagation.stats)
+
+# identical expressions share a Ref when interning
+interning.enabled = True
+src = Ref.object(a)
+print(src.x + 1 is src.x + 1, src.x + 1 is src.x + 1.0, interning.stats)
+interning.enabled = False
+
+# Refs on sources keep their value until a source changes, even unwatched
+class Doubled(int):
+    calls = 0
+
+    def __new__(cls, value):
+        Doubled.calls += 1
+        return int.__new__(cls, value * 2)
+
+a.x = 1
+src = Ref(getattr, a, 'x', _source=True)
+doubled = Ref(Doubled, src) + 1
+print(val(doubled), val(doubled), Doubled.calls)
+assert val(doubled) == 3 and Doubled.calls == 1
+a.x = 5
+src.dep_changed()
+print(val(doubled), compile_ref(doubled)(), Doubled.calls)
+assert compile_ref(doubled)() == 11 and Doubled.calls == 2
+
+# but not on a source whose value can change in place, nor on python
+# functions, which may read anything
+a.x = []
+src.dep_changed()
+length = Ref(len, src)
+compiled = compile_ref(length)
+assert val(length) == 0 and compiled() == 0
+a.x.append(1)
+assert val(length) == 1 and compiled() == 1
+assert not Ref(lambda value: value, src)._versioned
+assert not Ref(a.x.count, src)._versioned
+
+# the profiler counts each Ref of an expression, and its cache hits
+profiler.enable()
+src = Ref.getattr(a, 'x')
+total = src * 2 + src
+total.add_change_callback(lambda: None)
+print(val(total), val(total), compile_ref(total)())
+profiler.disable()
+for row in profiler.report():
+    print(row["expression"], row["evals"], row["hits"], row["fan_out"])
+profiler.reset()
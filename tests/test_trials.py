@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+import threading
+
+from smile.common import *
+from smile.headless import run_headless
+from smile.log import log2dl
+
+data_dir = tempfile.mkdtemp()
+
+# a .csv file, read with converters
+csv_name = os.path.join(data_dir, "trials.csv")
+with open(csv_name, "w") as f:
+    f.write("word,dur\n")
+    for i in range(1000):
+        f.write("word%d,%f\n" % (i, i / 1000.))
+source = TrialSource(csv_name, prefetch=16, converters={"dur": float})
+rows = list(source)
+print(rows[:2], source.stats)
+assert rows[1] == {"word": "word1", "dur": 0.001} and len(rows) == 1000
+assert source.stats["rows"] == 1000
+
+# a .jsonl file, shuffled within blocks, the same way for the same seed
+jsonl_name = os.path.join(data_dir, "trials.jsonl")
+with open(jsonl_name, "w") as f:
+    for i in range(100):
+        f.write(json.dumps({"i": i}) + "\n")
+shuffled = [row["i"] for row in TrialSource(jsonl_name, shuffle_block=10,
+                                            seed=1)]
+assert shuffled == [row["i"] for row in TrialSource(jsonl_name,
+                                                    shuffle_block=10,
+                                                    seed=1)]
+assert shuffled != list(range(100))
+assert all(sorted(shuffled[n:n + 10]) == list(range(n, n + 10))
+           for n in range(0, 100, 10))
+
+# stopping early stops the thread
+n_threads = threading.active_count()
+for row in TrialSource(csv_name, prefetch=4):
+    if row["word"] == "word3":
+        break
+threading.Event().wait(0.3)
+assert threading.active_count() == n_threads
+
+# errors reading the source are raised by the loop
+def broken():
+    yield {"word": "ok"}
+    raise IOError("disk on fire")
+try:
+    list(TrialSource(broken))
+except IOError as e:
+    print("raised:", e)
+else:
+    raise AssertionError("the error wasn't raised")
+
+
+# Loops over a generator and over a TrialSource, run headless
+exp = Experiment(name="Trials", data_dir=data_dir, show_splash=False)
+
+def countdown():
+    for n in (3, 2, 1):
+        yield {"n": n}
+
+with Loop(countdown()) as trial:
+    Log(name="countdown", i=trial.i, n=trial.current["n"])
+    Wait(0.1)
+
+with Loop(TrialSource(csv_name, converters={"dur": float})) as trial:
+    Log(name="words", i=trial.i, word=trial.current["word"])
+    Wait(trial.current["dur"])
+
+run_headless(exp, max_time=3600)
+countdown_rows = log2dl(os.path.join(exp.session_dir, "log_countdown_0.slog"))
+assert [(r["i"], r["n"]) for r in countdown_rows] == [(0, 3), (1, 2), (2, 1)]
+word_rows = log2dl(os.path.join(exp.session_dir, "log_words_0.slog"))
+print(word_rows[-1])
+assert [r["word"] for r in word_rows] == ["word%d" % i for i in range(1000)]
+assert word_rows[-1]["i"] == 999
+loops = log2dl(os.path.join(exp.session_dir, "state_Loop_0.slog"))
+assert [loop["i"] for loop in loops] == [2, 999]
+
+# Loops ending before their TrialSources run out stop the reader threads,
+# whether the conditional ends them or something cancels them
+exp = Experiment(name="TrialsEarly", data_dir=data_dir, show_splash=False)
+
+exp.more = True
+with Loop(TrialSource(csv_name, prefetch=4),
+          conditional=exp.more) as trial:
+    Wait(0.01)
+    exp.more = trial.i < 5
+
+with Loop(TrialSource(csv_name, prefetch=4)) as trial:
+    Wait(0.01)
+with UntilDone():
+    Wait(0.2)
+
+run_headless(exp, max_time=3600)
+loops = log2dl(os.path.join(exp.session_dir, "state_Loop_0.slog"))
+assert loops[0]["i"] == 5 and loops[1]["i"] < 100
+
+def readers():
+    return [thread for thread in threading.enumerate()
+            if thread.name.startswith("TrialSource(")]
+
+for thread in readers():
+    thread.join(1.0)
+print(readers())
+assert not readers()